@@ -13,9 +13,13 @@ __all__ = ('DJQMap', 'XLSXMap')
 from os.path import join
 from collections import defaultdict
 from re import split
-from djq import (process_request, default_dqroot, valid_dqroot,
+from djq import (default_dqroot, valid_dqroot,
                  default_dqtag, valid_dqtag, default_dqpath,
                  ensure_dq)
+from djq.low import fluids
+from djq.variables import (cv_implementation, validate_cv_implementation,
+                           compute_variables, compute_variables_batch,
+                           cmvids_batch)
 import djq.variables.cv_invert_varmip as civ
 
 from openpyxl import load_workbook
@@ -124,34 +128,29 @@ class DJQMap(MTMap):
         self.__results = None
 
     @staticmethod
-    def jsonify(dq, cmvids):
-        # a minimal JSONifier (much faster than the default one)
-        def jc(cmvid):
-            cmv = dq.inx.uid[cmvid]
-            return {'label': cmv.label,
-                    'uid': cmvid,
-                    'miptable': cmv.mipTable}
-        return tuple(jc(cmvid) for cmvid in cmvids)
-
-    @staticmethod
-    def invert_replies(replies):
+    def invert_results(dq, results):
         table = defaultdict(lambda: defaultdict(set))
-        for reply in replies:
-            for vt in reply['reply-variables']:
-                table[vt['miptable']][vt['uid']].add(reply['mip'])
+        for ((mip, experiment), cmvids) in results.iteritems():
+            for cmvid in cmvids:
+                table[dq.inx.uid[cmvid].mipTable][cmvid].add(mip)
         # returning defaultdicts can be confusing (note we have to
         # convert two levels)
         return {mt: dict(vs) for (mt, vs) in table.iteritems()}
 
     def compute_results(self):
-        # compute results (cached by MTMap)
+        # compute results (cached by MTMap), all at once if the
+        # implementation can do that, and then get them through
+        # compute_variables so the post checks are run
         dq = self.dq
-        return self.invert_replies(
-            process_request(tuple({'mip': mip.label, 'experiment': True}
-                                  for mip in dq.coll['mip'].items),
-                            dq=dq,
-                            cvimpl=self.cvimpl,
-                            jsimpl=self.jsonify))
+        with fluids((cv_implementation,
+                     validate_cv_implementation(self.cvimpl)),
+                    (cmvids_batch, dict())):
+            batched = compute_variables_batch(
+                dq, tuple((mip.label, True) for mip in dq.coll['mip'].items))
+            return self.invert_results(
+                dq,
+                {(mip, experiment): compute_variables(dq, mip, experiment)
+                 for (mip, experiment) in batched})
 
 # Now do the same from the spreadsheet
 #
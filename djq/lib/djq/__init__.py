@@ -17,6 +17,14 @@ from .parse import *
 from . import emit
 from .emit import *
 
+# Snapshots
+from . import snapshot
+from .snapshot import *
+
+# Reply cache
+from . import reply_cache
+from .reply_cache import *
+
 # Loader
 from . import load
 from .load import *
@@ -27,3 +35,7 @@ from .toplevel import *
 
 # Variable mapping (package)
 from . import variables
+
+# Server
+from . import server
+from .server import *
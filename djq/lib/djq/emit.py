@@ -7,6 +7,20 @@
 
 # Currently this does no checking at all
 #
+# Replies are indented by default.  Compact replies have no
+# indentation and the smallest separators, which makes them about half
+# the size and quicker to write.
+#
+# Compact replies can also contain pre-encoded fragments: an object
+# with a json_fragment attribute is written as the value of that
+# attribute, which should be its compact encoding, rather than being
+# encoded again (see djq.variables.jsonify for where these come from).
+# Fragments are only looked for in a single-reply, its values, and the
+# elements of its values which are arrays, which is where variables
+# are (and in a reply, which is an array of single-replies): anything
+# deeper is just encoded.  The result is exactly what
+# encoding the reply would have produced.
+#
 
 # Package interface
 __all__ = ()
@@ -15,8 +29,9 @@ __all__ = ()
 # - EmitFailed
 # - emit_reply
 # - emit_catastrophe
+# - ReplyStream
 
-from json import dump
+from json import dump, dumps
 from low import InternalException
 
 class EmitFailed(InternalException):
@@ -24,25 +39,128 @@ class EmitFailed(InternalException):
         super(EmitFailed, self).__init__(string)
         self.wrapped = wrapped
     def __str__(self):
-        return "{}: {}".format(super(EmitComparisonFailed, self).__str__(),
+        return "{}: {}".format(super(EmitFailed, self).__str__(),
                                self.wrapped)
 
-def emit_reply(reply, fp):
+def layout(compact, indent=1):
+    # keyword arguments for dump & dumps
+    return ({'separators': (',', ':')} if compact else {'indent': indent})
+
+def compact_dumps(ob, depth=2):
+    # Return the compact encoding of ob, splicing in any fragments:
+    # depth is how many levels of containers to look inside for them
+    fragment = getattr(ob, 'json_fragment', None)
+    if fragment is not None:
+        return fragment
+    elif depth <= 0:
+        pass
+    elif (isinstance(ob, dict)
+          and all(isinstance(k, basestring) for k in ob)):
+        # (other keys get converted to strings, so leave them to dumps)
+        return ("{"
+                + ",".join(dumps(k) + ":" + compact_dumps(v, depth - 1)
+                           for (k, v) in ob.iteritems())
+                + "}")
+    elif isinstance(ob, (list, tuple)):
+        return ("["
+                + ",".join(compact_dumps(e, depth - 1) for e in ob)
+                + "]")
+    return dumps(ob, **layout(True))
+
+def emit_reply(reply, fp, compact=False):
     """Emit a reply as JSON on a stream.
 
-    No useful return value.  Raises EmitFailed if anything goes wrong.
+    If compact is true then it is not indented.  No useful return
+    value.  Raises EmitFailed if anything goes wrong.
     """
     try:
-        dump(reply, fp, indent=1)
+        if compact:
+            # a reply is an array of single-replies
+            fp.write(compact_dumps(reply, depth=3))
+        else:
+            dump(reply, fp, **layout(compact))
         fp.write("\n")          # prettier: I think it is safe JSON
     except Exception as e:
         raise EmitFailed("badness when emitting", e)
 
-def emit_catastrophe(message, fp, **others):
+def emit_catastrophe(message, fp, compact=False, **others):
     """Emit a reply indicating a catastrophe has happened.
 
-    No useful return value.  Does not wrap any exceptions.
+    If compact is true then it is not indented.  No useful return
+    value.  Does not wrap any exceptions.
     """
     dump(dict((('catastrophe', message),), **others), fp,
-         indent=2)
+         **layout(compact, indent=2))
     fp.write("\n")              # see above
+
+# Streaming replies.  Rather than building the whole reply and then
+# emitting it, a ReplyStream writes each single-reply as soon as it is
+# given one, either as an element of a JSON array (the opening bracket
+# is written before the first single-reply and the closing bracket by
+# close), or as JSON Lines, one single-reply per line with no
+# enclosing array.  Either way the output is the same JSON as
+# emit_reply would write for the same replies, although the layout
+# differs.
+#
+# If there is a catastrophe before anything has been written it is
+# emitted just as emit_catastrophe would.  If there is one after some
+# single-replies have been written that can no longer be done, so the
+# catastrophe object is written as the last element of the array (or
+# the last line), which is then closed: the output is still well-formed
+# JSON, and a reader which finds an object with a 'catastrophe' key
+# among the replies knows that the replies before it are all it is
+# going to get.
+#
+
+class ReplyStream(object):
+    """A stream of replies on fp, as a JSON array or JSON Lines.
+
+    Call emit for each single-reply, then close, or catastrophe if
+    something goes wrong.  Raises EmitFailed if a reply can not be
+    emitted.  If compact is true the array is not indented (JSON Lines
+    never are).
+    """
+
+    def __init__(self, fp, json_lines=False, compact=False):
+        self.fp = fp
+        self.json_lines = json_lines
+        self.compact = compact
+        self.started = False
+        self.closed = False
+
+    def emit(self, reply):
+        try:
+            if self.json_lines:
+                self.fp.write(compact_dumps(reply))
+                self.fp.write("\n")
+            elif self.compact:
+                self.fp.write("," if self.started else "[")
+                self.fp.write(compact_dumps(reply))
+            else:
+                self.fp.write(",\n" if self.started else "[\n")
+                self.fp.write(dumps(reply, indent=1))
+            self.started = True
+        except Exception as e:
+            raise EmitFailed("badness when emitting", e)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.json_lines:
+                pass
+            elif not self.started:
+                self.fp.write("[]\n")
+            else:
+                self.fp.write("]\n" if self.compact else "\n]\n")
+
+    def catastrophe(self, message, **others):
+        # Does not wrap any exceptions, like emit_catastrophe
+        if self.closed:
+            return
+        if not (self.started or self.json_lines):
+            self.closed = True
+            emit_catastrophe(message, self.fp, compact=self.compact,
+                             **others)
+        else:
+            self.emit(dict((('catastrophe', message),), **others))
+            self.close()
@@ -8,17 +8,23 @@
 # Package interface
 __all__ = ('default_dqroot', 'default_dqtag',
            'valid_dqroot', 'valid_dqtag',
-           'default_dqpath')
+           'default_dqpath',
+           'selective_loading',
+           'rebuild_snapshot')
 
 # Interface
 # - dqload
 # - effective_dqpath
+# - quiet_dqpath
+# - dreq_files
 
 from os import getenv
 from sys import argv
 from low import fluid, globalize
-from low import debug
+from low import debug, mutter
 from metadata import note_reply_metadata
+from snapshot import (snapshot_directory, read_snapshot, write_snapshot,
+                      SnapshotFailure)
 from os.path import isdir, join, split
 from dreqPy.dreq import loadDreq, defaultDreqPath, defaultConfigPath
 from dreqPy import __path__ as dreqPy_path
@@ -46,6 +52,13 @@ default_dqtag = globalize(fluid(),
 
 default_dqpath = globalize(fluid(), None, threaded=True)
 
+# Whether to load only the sections of the DREQ the implementations
+# need, when this is possible: see djq.snapshot.
+#
+selective_loading = globalize(fluid(),
+                              bool(getenv("DJQ_SELECTIVE_LOADING")),
+                              threaded=True)
+
 def valid_dqroot(dqroot=None):
     """Check whether dqroot smells like a dreq dqroot dir.
 
@@ -97,6 +110,10 @@ def effective_dqpath(dqtag=None, dqroot=None, dqpath=None):
     note_reply_metadata(dqroot=dqroot, default_dqroot=default_dqroot(),
                         dqtag=dqtag, default_dqtag=default_dqtag(),
                         dqpath=dqpath, default_dqpath=default_dqpath())
+    return quiet_dqpath(dqtag=dqtag, dqroot=dqroot, dqpath=dqpath)
+
+def quiet_dqpath(dqtag=None, dqroot=None, dqpath=None):
+    # effective_dqpath without noting anything
     if dqpath is None:
         dqpath = default_dqpath()
     if dqtag is None:
@@ -110,7 +127,14 @@ def effective_dqpath(dqtag=None, dqroot=None, dqpath=None):
     else:
         return join(dqroot, "trunk", "dreqPy", "docs")
 
-def dqload(dqtag=None, dqroot=None, dqpath=None):
+def dreq_files(top):
+    # The XML and configuration files for a DREQ whose XML directory is
+    # top
+    return (join(top, split(defaultDreqPath)[1]),
+            join(top, split(defaultConfigPath)[1]))
+
+def dqload(dqtag=None, dqroot=None, dqpath=None, snapshot=True,
+           sections=None):
     """Load the dreq from a dqtag and dqroot and dpath, all defaulted.
 
     Arguments:
@@ -119,21 +143,59 @@ def dqload(dqtag=None, dqroot=None, dqpath=None):
       default_dqroot()
     - dqpath -- the path to the XML directory, dynamically-defaulted from
       default_dqpath.
+    - snapshot -- if true (the default) use a snapshot if there is a
+      current one, and write one if not.  If false always load from
+      the XML (but still write a snapshot).
+    - sections -- if given, an iterable of the names of the sections
+      needed.  If a snapshot is used only these sections are read and
+      the result is a view of the DREQ: see djq.snapshot.  Otherwise
+      the whole DREQ is loaded anyway.
+
+    Snapshots are only used if snapshot_directory() is not None: see
+    djq.snapshot.
 
     This does no error checks itself : it will raise whatever
     exception the underlying dreq code does if things are bad.  If you
-    want to check for this use the valid_* functions.
+    want to check for this use the valid_* functions.  Failing to
+    write a snapshot is not an error.
 
     """
     # This replicates some code in dqi.util and dqi.low, to avoid a
     # dependency on dqi as this is the only place djq relied on it.
     note_reply_metadata(dreqpy_path=dreqPy_path)
     top = effective_dqpath(dqtag=dqtag, dqroot=dqroot, dqpath=dqpath)
-    xml = join(top, split(defaultDreqPath)[1])
-    config = join(top, split(defaultConfigPath)[1])
+    (xml, config) = dreq_files(top)
     note_reply_metadata(dreq_top=top,
                         dreq_xml=xml,
                         dreq_config=config)
-    dreq = loadDreq(dreqXML=xml, configdoc=config, manifest=None)
+    dreq = (read_snapshot(top, (xml, config), sections=sections)
+            if snapshot
+            else None)
+    if dreq is not None:
+        note_reply_metadata(dreq_snapshot=dreq.source)
+    else:
+        dreq = loadDreq(dreqXML=xml, configdoc=config, manifest=None)
+        try:
+            note_reply_metadata(dreq_snapshot=write_snapshot(dreq, top,
+                                                             (xml, config)))
+        except SnapshotFailure as e:
+            mutter("[{}: {}]", e, e.wrapped)
+            note_reply_metadata(dreq_snapshot=None)
     note_reply_metadata(dreq_loaded_version=dreq.version)
     return dreq
+
+def rebuild_snapshot(dqtag=None, dqroot=None, dqpath=None):
+    """Rebuild the snapshot for the DREQ from a dqtag, dqroot and dqpath.
+
+    The arguments are defaulted as for dqload.  This loads the DREQ
+    from the XML regardless of any existing snapshot and writes a new
+    one, returning its filename.  Raises SnapshotFailure if there is
+    no snapshot directory or the snapshot can't be written.
+    """
+    if snapshot_directory() is None:
+        raise SnapshotFailure("no snapshot directory")
+    top = effective_dqpath(dqtag=dqtag, dqroot=dqroot, dqpath=dqpath)
+    (xml, config) = dreq_files(top)
+    return write_snapshot(loadDreq(dreqXML=xml, configdoc=config,
+                                   manifest=None),
+                          top, (xml, config))
@@ -40,3 +40,7 @@ from .memoize import *
 # JSON-based feature bundles
 from . import fbundle
 from .fbundle import *
+
+# Compressed files
+from . import compress
+from .compress import *
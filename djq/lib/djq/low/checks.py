@@ -11,10 +11,40 @@
 # when running them but the default is not to.  All functions in a
 # given tree get the same arguments.  The tree is run by calling it.
 #
+# Trees are run very often (some for every single-request), so
+# running one does not walk it: the first time a tree is run for a
+# given path and minimum priority the checks to run are compiled into
+# a flat plan, which is cached until a check is added anywhere in the
+# tree.  Each tree also records, for each check, how many times it has
+# been called, how many times it failed, and how long it took in
+# total: the stats method of a tree returns these, and check_stats
+# adds them up for all the trees there are, so you can see which
+# checks are expensive and perhaps run them less (with
+# checks_minpri).
+#
+# Checks can also be sampled, so some of the safety net is kept
+# without paying for all of it.  If checks_fraction is not None each
+# check runs on that fraction of the calls to its tree, chosen at
+# random.  If checks_first is not None each check runs on the first
+# that many calls, after which it runs only on checks_fraction of
+# them (so not at all if that is None).  A tree can be made with a
+# sample_key, a function of the arguments to the checks: calls are
+# then counted for checks_first separately for each key, so, for
+# instance, the first few calls for each DREQ can be checked.  Keys
+# are held weakly, so they need to be weakly referenceable, and if
+# they are not calls are counted for the check as a whole.  Checks
+# which are skipped are counted in their statistics.
+#
 
-__all__ = ('make_checktree', 'checker', 'checks_minpri', 'checks_enabled')
+__all__ = ('make_checktree', 'checker', 'checks_minpri', 'checks_enabled',
+           'checks_fraction', 'checks_first', 'check_stats')
 
 from collections import defaultdict
+from weakref import WeakSet, WeakKeyDictionary
+from threading import Lock
+from time import time
+from random import random
+from os import getenv
 from nfluid import fluid, globalize
 from noise import chatter, mumble, debug
 from dtype import stringlike
@@ -28,6 +58,16 @@ from dtype import stringlike
 checks_minpri = globalize(fluid(), 0, threaded=True)
 checks_enabled = globalize(fluid(), True, threaded=True)
 
+# And two to control sampling (see above)
+checks_fraction = globalize(fluid(),
+                            (float(getenv("DJQ_CHECKS_FRACTION"))
+                             if getenv("DJQ_CHECKS_FRACTION") else None),
+                            threaded=True)
+checks_first = globalize(fluid(),
+                         (int(getenv("DJQ_CHECKS_FIRST"))
+                          if getenv("DJQ_CHECKS_FIRST") else None),
+                         threaded=True)
+
 class CheckNode(object):
     """An object which can run a tree of checks.
 
@@ -54,18 +94,31 @@ class CheckNode(object):
       arguments & keyword arguments, but it would be possible to
       provide a function which, for instance, decided to call only
       checks with certain names.
+
+    - sample_key is a function of the arguments & keyword arguments
+      passed to the checks which returns the key under which calls
+      are counted for checks_first.  The default is None, which
+      counts all calls to a check together.
     """
 
     def __init__(self, sprint=mumble, fprint=chatter,
                  wrap=(lambda path, pri, name, f, *args, **kwargs:
-                           f(*args, **kwargs))):
+                           f(*args, **kwargs)),
+                 sample_key=None,
+                 shared=None):
+        # shared is state shared by all the nodes of a tree: internal
+        if shared is None:
+            shared = TreeState(sample_key)
         self.subnodes = defaultdict(lambda: CheckNode(sprint=sprint,
                                                       fprint=fprint,
-                                                      wrap=wrap))
+                                                      wrap=wrap,
+                                                      shared=shared))
         self.checks = defaultdict(list)
         self.sprint = sprint
         self.fprint = fprint
         self.wrap = wrap
+        self.shared = shared
+        self.plans = {}         # (path, minpri) -> (generation, plan)
 
     def add(self, branch, priority, name, check):
         """Add a check.
@@ -88,6 +141,7 @@ class CheckNode(object):
             self.add(branch.split("."), priority, name, check)
         elif len(branch) == 0:
             self.checks[priority].append((name, check))
+            self.shared.generation += 1
         else:
             self.subnodes[branch[0]].add(branch[1:], priority, name, check)
         return check
@@ -115,18 +169,24 @@ class CheckNode(object):
             enabled = checks_enabled()
 
         if enabled:
-            node = self if path is None else self.find(path)
-            # The string here determines how paths get printed: in
-            # particular whether there is a leading dot (with () there
-            # isn't, with "" there would be).
-            if node:
-                return node.run(() if path is None else path,
-                                minpri, args, kwargs)
-            else:
-                return None
+            return self.run(self.plan(path, minpri), args, kwargs)
         else:
             return None
 
+    def stats(self):
+        """Return statistics about the checks in this tree.
+
+        This is a dict mapping (path, priority, name) for each check
+        which has been run, where path is a dotted string, to a dict
+        with the number of 'calls', 'failures' and 'skipped' calls
+        (because of sampling) and the total 'seconds' spent in it.
+        """
+        with self.shared.lock:
+            return {k: {'calls': calls, 'failures': failures,
+                        'seconds': seconds, 'skipped': skipped}
+                    for (k, (calls, failures, seconds, skipped))
+                    in self.shared.counts.iteritems()}
+
     # Everything below is implementation
     #
 
@@ -140,40 +200,141 @@ class CheckNode(object):
         else:
             return None
 
-    def run(self, path, minpri, args, kwargs):
-        if stringlike(path):
-            return self.run(path.split("."), minpri, args, kwargs)
-        else:
-            ok = None
-            # checks further up the tree run first, and higher
-            # priority checks run first
-            for pri in sorted((pri
-                               for pri in self.checks.keys()
-                               if pri >= minpri),
-                              reverse=True):
-                for (name, check) in self.checks[pri]:
-                    if self.wrap(path, pri, name, check, *args, **kwargs):
-                        self.sprint("[passed {}/{}/{}]",
-                                    ".".join(path), pri, name)
-                        ok = True
-                    else:
-                        self.fprint("[failed {}/{}/{}]",
-                                    ".".join(path), pri, name)
-                        ok = False
-            for (pathelt, subnode) in sorted(self.subnodes.iteritems(),
-                                             key=lambda i: i[0]):
-                snok = subnode.run(tuple(path) + (pathelt,), minpri,
-                                   args, kwargs)
-                if ok is not False and snok is not None:
-                    ok = snok
-            return ok
+    def plan(self, path, minpri):
+        # The plan for running the checks under path (None meaning
+        # all of them) with at least minpri, from the cache if it is
+        # still current
+        key = (() if path is None
+               else tuple(path.split(".")) if stringlike(path)
+               else tuple(path))
+        generation = self.shared.generation
+        cached = self.plans.get((key, minpri))
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        node = self.find(key)
+        # The path here determines how paths get printed: in
+        # particular whether there is a leading dot (with () there
+        # isn't, with ("",) there would be).
+        plan = tuple(node.compile(key, minpri)) if node else ()
+        self.plans[(key, minpri)] = (generation, plan)
+        return plan
+
+    def compile(self, path, minpri):
+        # Yield the steps to run the checks under this node, which is
+        # at path.  Checks further up the tree run first, and higher
+        # priority checks run first.  Each step is a tuple of (node,
+        # path, dotted path, priority, name, check, counts).
+        dotted = ".".join(path)
+        for pri in sorted((pri
+                           for pri in self.checks.keys()
+                           if pri >= minpri),
+                          reverse=True):
+            for (name, check) in self.checks[pri]:
+                yield (self, path, dotted, pri, name, check,
+                       self.shared.counter(dotted, pri, name))
+        for (pathelt, subnode) in sorted(self.subnodes.iteritems(),
+                                         key=lambda i: i[0]):
+            for step in subnode.compile(path + (pathelt,), minpri):
+                yield step
+
+    def run(self, plan, args, kwargs):
+        # Run a plan: None if it is empty, otherwise True if every
+        # check passed and False if any failed
+        ok = None
+        shared = self.shared
+        lock = shared.lock
+        fraction = checks_fraction()
+        first = checks_first()
+        sampling = fraction is not None or first is not None
+        key = (shared.sample_key(*args, **kwargs)
+               if (plan and first is not None
+                   and shared.sample_key is not None)
+               else None)
+        for (node, path, dotted, pri, name, check, counts) in plan:
+            if sampling and not shared.sampled((dotted, pri, name), key,
+                                               fraction, first):
+                with lock:
+                    counts[3] += 1
+                continue
+            start = time()
+            passed = node.wrap(path, pri, name, check, *args, **kwargs)
+            elapsed = time() - start
+            with lock:
+                counts[0] += 1
+                counts[2] += elapsed
+                if not passed:
+                    counts[1] += 1
+            if passed:
+                node.sprint("[passed {}/{}/{}]", dotted, pri, name)
+                if ok is None:
+                    ok = True
+            else:
+                node.fprint("[failed {}/{}/{}]", dotted, pri, name)
+                ok = False
+        return ok
+
+class TreeState(object):
+    # State shared by all the nodes of a tree: a generation, which
+    # changes whenever a check is added, the counts for each check, and
+    # the calls of each check for checks_first, by sample key
+    def __init__(self, sample_key=None):
+        self.generation = 0
+        # (dotted path, pri, name) -> [calls, fails, secs, skipped]
+        self.counts = {}
+        self.sample_key = sample_key
+        self.keyed = WeakKeyDictionary() # key -> check -> calls
+        self.unkeyed = {}                # check -> calls
+        self.lock = Lock()
+
+    def counter(self, dotted, pri, name):
+        # The counts for a check
+        with self.lock:
+            return self.counts.setdefault((dotted, pri, name),
+                                          [0, 0, 0.0, 0])
+
+    def sampled(self, check, key, fraction, first):
+        # Should check run this time?
+        if first is not None:
+            with self.lock:
+                seen = self.unkeyed
+                if key is not None:
+                    try:
+                        seen = self.keyed.setdefault(key, {})
+                    except TypeError:
+                        pass
+                calls = seen.get(check, 0)
+                if calls < first:
+                    seen[check] = calls + 1
+                    return True
+        return fraction is not None and random() < fraction
+
+# Every tree made by make_checktree, for check_stats
+trees = WeakSet()
 
 def make_checktree(*args, **kwargs):
     """Make a check tree.
 
     See CheckNode for details of possible arguments.
     """
-    return CheckNode(*args, **kwargs)
+    tree = CheckNode(*args, **kwargs)
+    trees.add(tree)
+    return tree
+
+def check_stats():
+    """Return statistics about all the checks in all check trees.
+
+    This is a dict like the ones CheckNode.stats returns, with the
+    numbers for checks with the same path, priority and name in
+    different trees added up.
+    """
+    stats = {}
+    for tree in tuple(trees):
+        for (k, s) in tree.stats().iteritems():
+            t = stats.setdefault(k, {'calls': 0, 'failures': 0,
+                                     'seconds': 0.0, 'skipped': 0})
+            for (field, v) in s.iteritems():
+                t[field] += v
+    return stats
 
 def checker(tree, spec, priority=0):
     """A decorator to install a check function:
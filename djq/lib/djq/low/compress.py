@@ -0,0 +1,54 @@
+# (C) British Crown Copyright 2018, Met Office.
+# See LICENSE.md in the top directory for license details.
+#
+
+"""Opening possibly-compressed files
+"""
+
+# Files whose names end in a known suffix are compressed or
+# decompressed on the fly, as they are written or read, using the
+# standard library.  xz needs the lzma module, which Python 2 only has
+# as a backport: if it is not there then .xz files can't be opened.
+#
+
+__all__ = ('open_maybe_compressed', 'compression_suffixes')
+
+from gzip import GzipFile
+from bz2 import BZ2File
+from exceptions import ExternalException
+
+try:
+    from lzma import LZMAFile
+except ImportError:
+    LZMAFile = None
+
+class NoCompression(ExternalException):
+    def __init__(self, filename, suffix):
+        super(NoCompression, self).__init__(
+            "no support for {} compression for {}".format(suffix, filename))
+
+# Suffix -> class of file object, or None if not available
+compressors = {'.gz': GzipFile,
+               '.bz2': BZ2File,
+               '.xz': LZMAFile}
+
+def compression_suffixes():
+    """Return a tuple of the suffixes of compressed files which can be opened.
+    """
+    return tuple(sorted(s for (s, c) in compressors.iteritems()
+                        if c is not None))
+
+def open_maybe_compressed(filename, mode='r'):
+    """Open filename, compressing or decompressing it if need be.
+
+    If filename ends in a known suffix (see compression_suffixes) the
+    file is compressed as it is written, or decompressed as it is
+    read.  Otherwise it is just opened.  mode is 'r' or 'w', and the
+    result can be used with with.
+    """
+    for (suffix, compressor) in compressors.iteritems():
+        if filename.endswith(suffix):
+            if compressor is None:
+                raise NoCompression(filename, suffix)
+            return compressor(filename, mode + 'b')
+    return open(filename, mode)
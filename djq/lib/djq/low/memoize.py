@@ -47,46 +47,200 @@
 # table (which can potentially be large can be disposed of
 # automagically when the stack is unwound.
 #
+# Memo tables can be bounded, so memoization can be left on in
+# long-lived processes.  A Memos object may have a max_entries bound
+# on the total number of results it holds, for all functions, and
+# memoizable has a maxsize option which bounds the number of results
+# kept for that function.  In both cases, when there are too many
+# results the least-recently-used ones are discarded.  Keeping track
+# of use costs something on every hit, so it is only done for tables
+# which are bounded: a function's table is an OrderedDict only if it
+# has a maxsize, and otherwise a plain dict.  A Memos object has a
+# lock, held while looking up and storing results but not while
+# computing them, so a bounded table can be shared between threads
+# (two threads may then both compute the same result, which is
+# harmless).
+#
+# A Memos object also keeps statistics for each function: hits,
+# misses, results discarded, and the total time spent computing
+# results on misses (which, for recursive functions, includes the
+# time spent in nested calls).  memo_stats returns these for the
+# currently-bound Memos, which tells you whether memoizing something
+# is worth it.  They are kept by name, so two functions with the same
+# module and name are counted together in the result.
+#
+# There is also a different, simpler, decorator, weakly_memoized,
+# which is for functions of one argument which compute something
+# derived from a long-lived object (an index of a DREQ, say): the
+# results are kept in a weak dictionary keyed on the argument, so
+# they last exactly as long as the object does, regardless of the
+# memos fluid.  The table has a lock, held while looking up and
+# storing results but not while computing them, so, as with Memos,
+# two threads may both compute the result for an object, which is
+# harmless, but neither waits for the other.  Arguments which can't
+# be weakly referred to are not memoized at all.
+#
 
-__all__ = ('memos', 'Memos', 'memoizable')
+__all__ = ('memos', 'Memos', 'memoizable', 'weakly_memoized',
+           'memo_stats')
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from weakref import WeakKeyDictionary, ref
+from threading import Lock, RLock
+from time import time
 from nfluid import fluid, globalize
 
 memos = globalize(fluid(), None, threaded=True)
 
 class Memos(defaultdict):
-    def __init__(self):
+    """Memo tables for memoizable functions.
+
+    This maps from functions to the tables of their results.
+    max_entries, if given, bounds the total number of results held,
+    the least recently used being discarded first.  Statistics are
+    kept for each function: see stats.
+    """
+
+    def __init__(self, max_entries=None):
         super(Memos, self).__init__(dict)
+        self.max_entries = max_entries
+        self.order = OrderedDict() # (f, k) -> None, oldest first
+        # f -> [hits, misses, discards, seconds]
+        self.counts = defaultdict(lambda: [0, 0, 0, 0.0])
+        self.lock = RLock()
+
+    def lookup(self, f, k, maxsize=None):
+        # Return (True, value) if there is a result for f under k,
+        # otherwise (False, None), noting the use if need be
+        with self.lock:
+            stash = self.stash(f, maxsize)
+            if k not in stash:
+                self.counts[f][1] += 1
+                return (False, None)
+            self.counts[f][0] += 1
+            v = stash[k]
+            if maxsize is not None:
+                del stash[k]
+                stash[k] = v
+            if self.max_entries is not None:
+                del self.order[(f, k)]
+                self.order[(f, k)] = None
+            return (True, v)
+
+    def store(self, f, k, v, maxsize=None, seconds=0.0):
+        # Store v as the result for f under k, which took seconds to
+        # compute, discarding old results if there are now too many
+        with self.lock:
+            self.counts[f][3] += seconds
+            stash = self.stash(f, maxsize)
+            if k in stash:
+                self.discard(f, k)
+            stash[k] = v
+            if self.max_entries is not None:
+                self.order[(f, k)] = None
+            if maxsize is not None:
+                while len(stash) > maxsize:
+                    self.discard(f, next(iter(stash)))
+                    self.counts[f][2] += 1
+            if self.max_entries is not None:
+                while len(self.order) > self.max_entries:
+                    (df, dk) = next(iter(self.order))
+                    self.discard(df, dk)
+                    self.counts[df][2] += 1
+
+    def stash(self, f, maxsize):
+        # The table for f, which only needs to keep the order of use
+        # if it is bounded.  Call with the lock held.
+        if f not in self:
+            self[f] = OrderedDict() if maxsize is not None else dict()
+        return self[f]
 
-def memoizable(function=None, key=None, spread=False):
+    def discard(self, f, k):
+        # Discard the result for f under k.  Call with the lock held.
+        del self[f][k]
+        if self.max_entries is not None:
+            del self.order[(f, k)]
+
+    def stats(self):
+        """Return a dict of statistics about memoized functions.
+
+        This maps from the names of functions (module.name) to dicts
+        with the number of 'hits' and 'misses', 'evictions' (results
+        discarded to stay within bounds), the number of 'entries'
+        held and the total 'seconds' spent computing results.
+        """
+        stats = {}
+        with self.lock:
+            for (f, counts) in self.counts.iteritems():
+                (hits, misses, evictions, seconds) = counts
+                s = stats.setdefault(function_name(f),
+                                     {'hits': 0, 'misses': 0,
+                                      'evictions': 0, 'entries': 0,
+                                      'seconds': 0.0})
+                s['hits'] += hits
+                s['misses'] += misses
+                s['evictions'] += evictions
+                s['entries'] += len(self.get(f, ()))
+                s['seconds'] += seconds
+        return stats
+
+def function_name(f):
+    return "{}.{}".format(getattr(f, '__module__', None),
+                          getattr(f, '__name__', f))
+
+def memo_stats():
+    """Return statistics about the currently-bound memos, or None.
+
+    See Memos.stats.
+    """
+    stashes = memos()
+    return stashes.stats() if stashes is not None else None
+
+def memoizable(function=None, key=None, spread=False, maxsize=None):
     def memoized(f):
         def memoized_single(x):
             stashes = memos()
             if stashes is not None:
-                stash = stashes[f]
                 k = x if key is None else key(x)
-                if k in stash:
-                    return stash[k]
-                else:
+                (found, v) = stashes.lookup(f, k, maxsize)
+                if not found:
+                    start = time()
                     v = f(x)
-                    stash[k] = v
-                    return v
+                    stashes.store(f, k, v, maxsize, time() - start)
+                return v
             else:
                 return f(x)
         def memoized_spread(*args):
             stashes = memos()
             if stashes is not None:
-                stash = stashes[f]
                 k = args if key is None else key(args)
-                if k in stash:
-                    return stash[k]
-                else:
+                (found, v) = stashes.lookup(f, k, maxsize)
+                if not found:
+                    start = time()
                     v = f(*args)
-                    stash[k] = v
-                    return v
+                    stashes.store(f, k, v, maxsize, time() - start)
+                return v
             else:
                 return f(*args)
         return memoized_single if not spread else memoized_spread
     return (memoized(function) if function is not None
             else lambda f: memoized(f))
+
+def weakly_memoized(f):
+    stash = WeakKeyDictionary()
+    lock = Lock()
+    def memoized(x):
+        try:
+            ref(x)
+        except TypeError:
+            # can't refer to x weakly
+            return f(x)
+        with lock:
+            if x in stash:
+                return stash[x]
+        v = f(x)
+        with lock:
+            return stash.setdefault(x, v)
+    memoized.__name__ = f.__name__
+    memoized.__doc__ = f.__doc__
+    return memoized
@@ -6,11 +6,12 @@
 """
 
 # Fluids, or dynamic variables are functions which look themselves up
-# in a stack to find or set their values.  This therefore implements
-# deeply-bound dynamic variables.  The stack has a global top, and
-# each thread has at least oner stack frame below that.  Fluids can be
-# made such that they are automagically rebound into the thread's top
-# stack frame.
+# in a stack to find or set their values.  The stack has a global
+# top, and each thread has at least one stack frame below that.
+# Fluids can be made such that they are automagically rebound into the
+# thread's top stack frame.  Each thread also keeps track of where the
+# current binding of each fluid is, so looking one up does not need to
+# search the stack (see below).
 #
 # This is not really a general-purpose implementation, and is probably
 # idiosyncractic, but it works well enough.
@@ -62,15 +63,25 @@ class Unbound(Exception):
     def __init__(self, var):
         self.var = var
 
-# Each element in the stack of bindings is a two-element tuple with
-# the first element being a dict mapping fluids to values and the
-# second element being the rest of the stack, or None.
+# Bindings live in frames, which are dicts mapping fluids to values.
+# There is a single global frame, which contains global values for
+# fluids.  Below this, all frames are per-thread: each thread has a
+# toplevel frame, and a stack of frames above that, one for each
+# active fluids context.
 #
-# This is the top of the stack, which contains global values for
-# fluids.  Below this, all stack framnes are per-thread, and each
-# thread has at least one such frame.
+# To make looking up a fluid take constant time, however deep the
+# stack is, each thread also has a map from fluids to the frame which
+# currently holds their binding: the innermost frame in its stack
+# which binds them, or its toplevel frame.  Fluids which are not in
+# the map are looked up in the global frame, which is shared between
+# threads, so changes to global values are seen by all of them.
+# Entering a fluids context points the map at its frame for the
+# fluids it binds; leaving it searches the rest of the stack for the
+# bindings which are now innermost.  So binding costs in proportion to
+# the depth of the stack, but lookup does not, and lookup happens far
+# more often.
 #
-global_frame = ({}, None)
+global_frame = {}
 
 # This is a set of fluids which get rebound when a thread is created:
 # whatever binding they have globally is copied into the thread's top
@@ -85,53 +96,84 @@ class State(local):
             raise SystemError("reinitialized")
         self.initialized = True
         try:
-            frame = ({f: global_frame[0][f]
-                      for f in thread_bound},
-                     global_frame)
+            frame = {f: global_frame[f] for f in thread_bound}
         except KeyError:
             raise Catastrophe("trying to rebind a fluid with no global value")
         self.__dict__['toplevel_frame'] = frame
-        self.__dict__['frame'] = frame
+        self.__dict__['stack'] = []
+        self.__dict__['current'] = {f: frame for f in frame}
 
 state = State()
 
+def locate(var):
+    # the frame holding var's binding, or None
+    frame = state.current.get(var)
+    if frame is not None:
+        return frame
+    elif var in global_frame:
+        return global_frame
+    else:
+        return None
+
 def getf(var):
     # get a fluid value (nothing to do with CL's GETF, I just liked
     # the name)
-    def rv(bt):
-        (car, cdr) = bt
-        if var in car:
-            return car[var]
-        elif cdr is not None:
-            return rv(cdr)
-        else:
-            raise Unbound(var)
-    return rv(state.frame)
+    frame = state.current.get(var)
+    if frame is not None:
+        return frame[var]
+    try:
+        return global_frame[var]
+    except KeyError:
+        raise Unbound(var)
 
 def setf(var, val):
     # set a fluid value (again, no relation to SETF)
-    def loc(bt):
-        (car, cdr) = bt
-        if var in car:
-            return car
-        elif cdr is not None:
-            return loc(cdr)
-        else:
-            raise Unbound(var)
-    loc(state.frame)[var] = val
+    frame = locate(var)
+    if frame is None:
+        raise Unbound(var)
+    frame[var] = val
     return val
 
 def boundp(var):
     # is a fluid bound (this *is* related to BOUNDP)
-    def bp(bt):
-        (car, cdr) = bt
-        if var in car:
-            return True
-        elif cdr is not None:
-            return bp(cdr)
+    return var in state.current or var in global_frame
+
+def push_frame(frame):
+    # push a frame onto this thread's stack
+    s = state
+    s.stack.append(frame)
+    current = s.current
+    for var in frame:
+        current[var] = frame
+
+def pop_frame():
+    # pop the innermost frame from this thread's stack, finding the
+    # bindings it shadowed
+    s = state
+    frame = s.stack.pop()
+    current = s.current
+    for var in frame:
+        for outer in reversed(s.stack):
+            if var in outer:
+                current[var] = outer
+                break
         else:
-            return False
-    return bp(state.frame)
+            if var in s.toplevel_frame:
+                current[var] = s.toplevel_frame
+            else:
+                current.pop(var, None)
+
+def rebind_toplevel(var):
+    # make var's binding in this thread right after its toplevel
+    # binding has changed: if it is bound in the stack that binding
+    # still wins
+    s = state
+    if any(var in frame for frame in s.stack):
+        return
+    if var in s.toplevel_frame:
+        s.current[var] = s.toplevel_frame
+    else:
+        s.current.pop(var, None)
 
 def fluid():
     """Make a new unbound fluid variable"""
@@ -151,15 +193,16 @@ def globalize(var, val, threaded=False):
     This makes it have a toplevel value and, if threaded is true,
     causes it to be rebound per thread.
     """
-    global_frame[0][var] = val
+    global_frame[var] = val
     if threaded:
         # Note it should be rebound, and bind at thread toplevel
         thread_bound.add(var)
-        state.toplevel_frame[0][var] = val
+        state.toplevel_frame[var] = val
     else:
         # Remove any rebinding state
         thread_bound.discard(var)
-        state.toplevel_frame[0].pop(var, None)
+        state.toplevel_frame.pop(var, None)
+    rebind_toplevel(var)
     return var
 
 def localize(var):
@@ -172,8 +215,9 @@ def localize(var):
     until the stack is unwound.
     """
     thread_bound.discard(var)
-    global_frame[0].pop(var, None)
-    state.toplevel_frame[0].pop(var, None)
+    global_frame.pop(var, None)
+    state.toplevel_frame.pop(var, None)
+    rebind_toplevel(var)
     return var
 
 class fluids(object):
@@ -185,9 +229,9 @@ class fluids(object):
             self.bindings[var] = val
 
     def __enter__(self):
-        state.frame = (self.bindings, state.frame)
+        push_frame(self.bindings)
         return self
 
     def __exit__(self, ext, exv, tb):
-        state.frame = state.frame[1]
+        pop_frame()
         return None
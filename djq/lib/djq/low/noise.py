@@ -7,7 +7,7 @@
 
 __all__ = ('verbosity_level', 'debug_level',
            'chatter', 'mutter', 'mumble', 'whisper', 'think',
-           'debug')
+           'debug', 'enabled')
 
 from sys import stderr
 from nfluid import fluid, globalize
@@ -16,6 +16,11 @@ from traceback import format_stack
 verbosity_level = globalize(fluid(), 0, threaded=True)
 debug_level = globalize(fluid(), 0, threaded=True)
 
+# Messages are only formatted if they are going to be printed, but
+# their arguments are always computed.  If computing them is expensive
+# (or if there are a lot of messages, in a loop) check enabled first.
+#
+
 def maybe_talk(level, message, *arguments):
     if level > 0:
         print >>stderr, message.format(*arguments)
@@ -40,6 +45,13 @@ def think(message, *arguments):
     """Talk if ludicrously verbose"""
     maybe_talk(verbosity_level() - 3, message, *arguments)
 
+def enabled(level=1):
+    """Would talking at level say anything?
+
+    level is 1 for mutter, 2 for mumble, 3 for whisper and 4 for think.
+    """
+    return verbosity_level() >= level
+
 def debug(message, *arguments):
     """Talk if debugging"""
     try:
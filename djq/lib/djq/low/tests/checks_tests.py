@@ -8,6 +8,7 @@
 
 from djq.low.checks import *
 from djq.low.noise import verbosity_level
+from djq.low.nfluid import fluids
 
 tree = make_checktree(fprint=lambda *a: None)
 
@@ -56,3 +57,66 @@ def nineseven():
 
 def test_passtree_checks():
     assert passtree() is True
+
+def test_check_stats():
+    stree = make_checktree(sprint=lambda *a: None, fprint=lambda *a: None)
+    @checker(stree, "a/yes")
+    def yes():
+        return True
+    @checker(stree, "a.b/no")
+    def no():
+        return False
+    assert stree() is False
+    assert stree("a.b") is False
+    stats = stree.stats()
+    assert stats[("a", 0, "yes")]['calls'] == 1
+    assert stats[("a.b", 0, "no")]['calls'] == 2
+    assert stats[("a.b", 0, "no")]['failures'] == 2
+    assert check_stats()[("a", 0, "yes")]['calls'] >= 1
+
+def test_plan_invalidation():
+    itree = make_checktree(sprint=lambda *a: None, fprint=lambda *a: None)
+    @checker(itree, "x/pass")
+    def passes():
+        return True
+    assert itree() is True
+    assert itree("x.y") is None
+    # adding a check anywhere must be seen by cached plans
+    @checker(itree, "x.y/fail")
+    def fails():
+        return False
+    assert itree() is False
+    assert itree("x.y") is False
+
+def test_fail_then_pass():
+    ftree = make_checktree(sprint=lambda *a: None, fprint=lambda *a: None)
+    @checker(ftree, "f/fail", 2)
+    def fails():
+        return False
+    @checker(ftree, "f/pass", 1)
+    def passes():
+        return True
+    assert ftree() is False
+
+def test_sampled_checks():
+    calls = []
+    class Key(object):
+        pass
+    (k1, k2) = (Key(), Key())
+    stree = make_checktree(sprint=lambda *a: None, fprint=lambda *a: None,
+                           sample_key=lambda k: k)
+    @checker(stree, "s/count")
+    def count(k):
+        calls.append(k)
+        return True
+    with fluids((checks_first, 2)):
+        for i in range(4):
+            stree(args=(k1,))
+            stree(args=(k2,))
+    assert calls.count(k1) == 2 and calls.count(k2) == 2
+    assert stree.stats()[("s", 0, "count")]['skipped'] == 4
+    with fluids((checks_fraction, 0.0)):
+        assert stree(args=(k1,)) is None
+    with fluids((checks_fraction, 1.0)):
+        assert stree(args=(k1,)) is True
+    assert calls.count(k1) == 3
@@ -0,0 +1,36 @@
+# (C) British Crown Copyright 2018, Met Office.
+# See LICENSE.md in the top directory for license details.
+#
+
+# Tests for compressed files
+#
+
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from djq.low.compress import open_maybe_compressed, compression_suffixes
+
+dirs = {}
+
+def setup():
+    dirs['tmp'] = mkdtemp()
+
+def teardown():
+    rmtree(dirs['tmp'])
+
+text = "[\n" + ",\n".join('{"n": %d}' % i for i in range(1000)) + "\n]\n"
+
+def test_round_trips():
+    def check(suffix):
+        filename = join(dirs['tmp'], "t.json" + suffix)
+        with open_maybe_compressed(filename, 'w') as output:
+            output.write(text)
+        with open_maybe_compressed(filename) as input:
+            assert input.read() == text
+        with open(filename, 'rb') as raw:
+            if suffix == "":
+                assert raw.read() == text
+            else:
+                assert len(raw.read()) < len(text)
+    for suffix in ("",) + compression_suffixes():
+        yield (check, suffix)
@@ -13,8 +13,11 @@
 #
 
 from signal import signal, alarm, SIGALRM
+from collections import OrderedDict
+from threading import Thread
 from nose.tools import raises
-from djq.low.memoize import memoizable, memos, Memos
+from djq.low.memoize import (memoizable, memos, Memos, weakly_memoized,
+                             memo_stats)
 from djq.low.nfluid import fluids
 
 class Timeout(Exception):
@@ -131,3 +134,111 @@ def test_unhashable():
         return a
     with fluids((memos, Memos())):
         f([])
+
+# Tests of weakly memoized functions
+#
+
+class Thing(object):
+    pass
+
+def test_weakly_memoized():
+    calls = []
+    @weakly_memoized
+    def ident(x):
+        calls.append(x)
+        return id(x)
+    (a, b) = (Thing(), Thing())
+    assert ident(a) == id(a)
+    assert ident(a) == id(a)
+    assert ident(b) == id(b)
+    assert len(calls) == 2
+    # things which can't be weakly referred to are just not memoized
+    assert ident(1) == id(1)
+    assert ident(1) == id(1)
+    assert len(calls) == 4
+
+def test_weakly_memoized_unlocked():
+    # the lock is not held while computing, so computing one result
+    # can wait for another thread computing a different one
+    @weakly_memoized
+    def waiting(x):
+        if x is a:
+            t = Thread(target=waiting, args=(b,))
+            t.start()
+            t.join(10)
+            assert not t.is_alive()
+        return id(x)
+    (a, b) = (Thing(), Thing())
+    assert waiting(a) == id(a)
+    assert waiting(b) == id(b)
+
+# Tests of bounded tables
+#
+
+def test_maxsize():
+    calls = []
+    @memoizable(maxsize=2)
+    def ident(x):
+        calls.append(x)
+        return x
+    with fluids((memos, Memos())):
+        for x in (1, 2, 1, 3):
+            assert ident(x) == x
+        assert calls == [1, 2, 3]
+        # 1 was used more recently than 2, so 2 was discarded
+        assert ident(1) == 1 and ident(2) == 2
+        assert calls == [1, 2, 3, 2]
+        assert all(isinstance(stash, OrderedDict)
+                   for stash in memos().itervalues())
+
+def test_unbounded_stash():
+    # unbounded tables don't keep the order of use
+    with fluids((memos, Memos(max_entries=10))):
+        assert fib(30) == f30
+        assert all(type(stash) is dict for stash in memos().itervalues())
+
+def test_max_entries():
+    calls = []
+    @memoizable
+    def double(x):
+        calls.append(x)
+        return 2 * x
+    @memoizable(spread=True)
+    def add(x, y):
+        calls.append((x, y))
+        return x + y
+    with fluids((memos, Memos(max_entries=3))):
+        assert double(1) == 2
+        assert add(1, 2) == 3
+        assert double(2) == 4
+        assert double(1) == 2
+        assert add(2, 2) == 4   # discards add(1, 2)
+        assert len(memos().order) == 3
+        assert sum(len(stash) for stash in memos().itervalues()) == 3
+        assert add(1, 2) == 3
+        assert double(1) == 2
+        assert calls == [1, (1, 2), 2, (2, 2), (1, 2)]
+
+def test_bounded_fib():
+    with fluids((memos, Memos(max_entries=10))):
+        assert fib(30) == f30
+        assert len(memos().order) <= 10
+
+# Tests of statistics
+#
+
+def test_stats():
+    @memoizable(maxsize=2)
+    def ident(x):
+        return x
+    name = "{}.ident".format(__name__)
+    assert memo_stats() is None
+    with fluids((memos, Memos())):
+        for x in (1, 1, 2, 3, 3):
+            ident(x)
+        stats = memo_stats()[name]
+        assert stats['hits'] == 2
+        assert stats['misses'] == 3
+        assert stats['evictions'] == 1
+        assert stats['entries'] == 2
+        assert stats['seconds'] >= 0
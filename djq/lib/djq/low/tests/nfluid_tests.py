@@ -5,9 +5,10 @@
 # Tests for new fluids
 #
 
-# This doesn't test localizing, as that's never used
+# localize is only tested a little, as it is never used
 
-from djq.low.nfluid import fluid, boundp, fluids, globalize, Unbound
+from djq.low.nfluid import (fluid, boundp, fluids, globalize, localize,
+                            Unbound)
 from threading import Thread
 from nose.tools import raises
 
@@ -52,3 +53,56 @@ def test_thr_binding():
         thr.join()
         assert tf() == 12
     assert tf() == 3
+
+def test_deep_binding():
+    fl = fluid()
+    others = tuple(fluid() for i in range(10))
+    def nest(i):
+        if i == len(others):
+            assert fl() == 1
+            fl(2)
+            assert all(o() == j for (j, o) in enumerate(others))
+            return
+        with fluids((others[i], i)):
+            nest(i + 1)
+            assert fl() == 2
+    with fluids((fl, 1)):
+        nest(0)
+        assert fl() == 2
+    assert not boundp(fl)
+    assert not any(boundp(o) for o in others)
+
+def test_reentry():
+    fl = fluid()
+    binding = fluids((fl, 1))
+    with binding:
+        with fluids((fl, 2)):
+            with binding:
+                assert fl() == 1
+            assert fl() == 2
+        assert fl() == 1
+    assert not boundp(fl)
+
+def test_globalize_bound():
+    fl = fluid()
+    with fluids((fl, 1)):
+        globalize(fl, 2, threaded=True)
+        assert fl() == 1
+    assert fl() == 2
+    fl(3)
+    globalize(fl, 4)            # no longer threaded
+    assert fl() == 4
+    localize(fl)
+    assert not boundp(fl)
+
+def test_global_seen_by_threads():
+    fl = globalize(fluid(), 1)
+    seen = []
+    def look():
+        seen.append(fl())
+        fl(2)
+    thr = Thread(target=look)
+    thr.start()
+    thr.join()
+    assert seen == [1] and fl() == 2
+    fl(1)
@@ -21,14 +21,19 @@ categories = {'types': {Exception: ('DJQException', 'InternalException',
                             (('arraylike', 'stringlike', 'setlike')
                              + ('verbosity_level', 'debug_level',
                                 'chatter', 'mutter', 'mumble', 'whisper',
-                                'think', 'debug')
+                                'think', 'debug', 'enabled')
                              + ('make_checktree', 'checker',
-                                'checks_enabled', 'checks_minpri')
-                             + ('validate_object', 'every_element', 'one_of',
-                                'all_of')
+                                'checks_enabled', 'checks_minpri',
+                                'checks_fraction', 'checks_first',
+                                'check_stats')
+                             + ('validate_object', 'compile_pattern',
+                                'every_element', 'one_of', 'all_of')
                              + ('fluid', 'boundp', 'globalize', 'localize')
-                             + ('memoizable', 'memos')
+                             + ('memoizable', 'memos', 'weakly_memoized',
+                                'memo_stats')
                              + ('feature_bundle',)
+                             + ('open_maybe_compressed',
+                                'compression_suffixes')
                              + ('validate_package_interface',
                                 'report_package_interface'))}}
 
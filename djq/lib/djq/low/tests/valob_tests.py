@@ -5,7 +5,8 @@
 # Tests for valob
 #
 
-from djq.low.valob import validate_object, every_element, all_of, one_of
+from djq.low.valob import (validate_object, compile_pattern,
+                           every_element, all_of, one_of)
 from djq.low import stringlike
 
 should_match = ((1, 1),
@@ -43,3 +44,21 @@ def test_should_not_match():
         assert validate_object(ob, pattern) is False, "matched unexpectedly"
     for (ob, pattern) in should_not_match:
         yield (checker, ob, pattern)
+
+def test_compiled():
+    def checker(ob, pattern, expected):
+        assert compile_pattern(pattern)(ob) is expected, "compiled mismatch"
+    for (ob, pattern) in should_match:
+        yield (checker, ob, pattern, True)
+    for (ob, pattern) in should_not_match:
+        yield (checker, ob, pattern, False)
+
+def test_compiled_eql():
+    # a custom eql is used for constants, however deep
+    def ieql(x, y):
+        return stringlike(x) and x.lower() == y.lower()
+    pattern = {'a': ["Foo", every_element("bar", eql=ieql)]}
+    ob = {'a': ["FOO", ("BAR", "bar")]}
+    assert validate_object(ob, pattern, eql=ieql) is True
+    assert compile_pattern(pattern, eql=ieql)(ob) is True
+    assert compile_pattern(pattern)(ob) is False
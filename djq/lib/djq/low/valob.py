@@ -5,7 +5,17 @@
 """Validate objects against patterns
 """
 
-__all__ = ('validate_object', 'every_element', 'one_of', 'all_of')
+# validate_object interprets its pattern each time it is called, which
+# is fine for checking an object once, but slow for checking many
+# objects against the same pattern.  compile_pattern turns a pattern,
+# once, into a function which checks an object against it, with the
+# same semantics.  every_element, one_of and all_of compile their
+# patterns when they are made, so the predicates they return are
+# fast wherever they are used.
+#
+
+__all__ = ('validate_object', 'compile_pattern',
+           'every_element', 'one_of', 'all_of')
 
 def equal(x, y):
     # Python doesn't have a proper eql predicate: '==' is pretty much
@@ -65,6 +75,63 @@ def validate_object(ob, pattern, eql=equal):
         # just use eql
         return True if eql(ob, pattern) else False
 
+def compile_pattern(pattern, eql=equal):
+    """Compile pattern into a function which checks objects against it.
+
+    The function returned takes an object and returns True if it
+    matches pattern and False otherwise, exactly as validate_object
+    would with the same pattern and eql, but without looking at the
+    pattern each time.  The pattern should not be changed after it is
+    compiled.
+    """
+    check = compile_test(pattern, eql)
+    if isinstance(pattern, (dict, list, tuple, type)):
+        # these already return True or False
+        return check
+    else:
+        return lambda ob: True if check(ob) else False
+
+def compile_test(pattern, eql):
+    # Compile pattern into a function which returns a true value if
+    # an object matches it, and a false one otherwise: only the
+    # result of compile_pattern needs to return True or False
+    if isinstance(pattern, dict):
+        tp = type(pattern)
+        size = len(pattern)
+        checks = tuple((pk, compile_test(pp, eql))
+                       for (pk, pp) in pattern.iteritems())
+        def dict_matches(ob):
+            if isinstance(ob, tp) and len(ob) == size:
+                for (pk, check) in checks:
+                    if pk not in ob or not check(ob[pk]):
+                        return False
+                return True
+            else:
+                return False
+        return dict_matches
+    elif isinstance(pattern, list) or isinstance(pattern, tuple):
+        tp = type(pattern)
+        size = len(pattern)
+        checks = tuple(enumerate(compile_test(pp, eql)
+                                 for pp in pattern))
+        def array_matches(ob):
+            if isinstance(ob, tp) and len(ob) == size:
+                for (i, check) in checks:
+                    if not check(ob[i]):
+                        return False
+                return True
+            else:
+                return False
+        return array_matches
+    elif isinstance(pattern, type):
+        return lambda ob: isinstance(ob, pattern)
+    elif callable(pattern):
+        return pattern
+    elif eql is equal:
+        return lambda ob: ob == pattern
+    else:
+        return lambda ob: eql(ob, pattern)
+
 def every_element(pattern, tp=None, eql=equal):
     """Return a predicate which will check every element in an iterable.
 
@@ -76,10 +143,11 @@ def every_element(pattern, tp=None, eql=equal):
     This then returns a function of one argument which validate_object
     will use to check the object.
     """
+    check = compile_test(pattern, eql)
     def eep(ob):
         if tp is None or isinstance(ob, tp):
             for e in ob:
-                if not validate_object(e, pattern, eql=eql):
+                if not check(e):
                     return False
             return True
         else:
@@ -89,9 +157,10 @@ def every_element(pattern, tp=None, eql=equal):
 def one_of(patterns, eql=equal):
     """Return a predicate which checks an object matches one of the patterns.
     """
+    checks = tuple(compile_test(p, eql) for p in patterns)
     def oop(ob):
-        for p in patterns:
-            if validate_object(ob, p, eql=eql):
+        for check in checks:
+            if check(ob):
                 return True
         return False
     return oop
@@ -99,9 +168,10 @@ def one_of(patterns, eql=equal):
 def all_of(patterns, eql=equal):
     """Return a predicate which checks an object matches all of the patterns.
     """
+    checks = tuple(compile_test(p, eql) for p in patterns)
     def aop(ob):
-        for p in patterns:
-            if not validate_object(ob, p, eql=eql):
+        for check in checks:
+            if not check(ob):
                 return False
         return True
     return aop
@@ -7,14 +7,19 @@
 
 # Package interface
 
-__all__ = ('BadParse', 'BadJSON', 'BadSyntax', 'read_request')
+__all__ = ('BadParse', 'BadJSON', 'BadSyntax', 'read_request',
+           'read_request_stream')
 
 # Interface
 # - read_request
+# - read_request_stream
 # - validate_toplevel_request
 # - validate_single_request
 
-from json import load
+from json import load, loads, JSONDecoder
+from json.decoder import scanstring
+from json.scanner import py_make_scanner
+from re import compile as compile_re
 from low import ExternalException
 from low import stringlike, arraylike
 
@@ -27,6 +32,11 @@ from low import stringlike, arraylike
 #
 # This reads the JSON and does syntactic, but no semantic, validation.
 #
+# A request can also be read incrementally, one single-request at a
+# time, from either a JSON array or from JSON Lines (a sequence of
+# single-request objects, one per line, although any whitespace will
+# do to separate them): see read_request_stream.
+#
 
 class BadParse(ExternalException):
     pass
@@ -54,6 +64,159 @@ def read_request(fp):
         raise BadJSON("bad JSON request", e)
     return validate_toplevel_request(request)
 
+def read_request_stream(fp, chunk=1 << 16):
+    """Read a JSON request from a stream incrementally.
+
+    This is a generator which yields each single-request in the
+    request as soon as it has been read, so only as much of the input
+    as is needed to hold one single-request is buffered.  The request
+    is either a JSON array of single-requests or a sequence of
+    single-request objects (JSON Lines).
+
+    fp is the file-like object to read from, and chunk is how much to
+    read at a time.
+
+    Each single-request is checked to be an object (as
+    validate_toplevel_request does for a whole request): BadSyntax is
+    raised at the first one which is not, and BadJSON at the first
+    thing which is not JSON.  Since this is a generator, these only
+    happen when the bad part of the input is reached.
+    """
+    return RequestStream(fp, chunk).single_requests()
+
+class RequestStream(object):
+    # The state of reading a request incrementally: buf is the text
+    # read so far which has not been dropped, pos where reading has
+    # got to in it, and eof is true when fp has no more.
+    #
+    decoder = JSONDecoder()
+
+    # The decoder's own scanner doesn't always say where it failed: this
+    # slower one does, and is used to find out when it matters
+    locator = staticmethod(py_make_scanner(decoder))
+
+    # Where in the text a ValueError from a scanner says it failed
+    failed_at = compile_re(r"\(char (\d+)")
+
+    # How close to the end of what has been read a failure can be and
+    # still be because a token has been cut short: '-Infinity' is the
+    # longest token other than a string
+    cut_short = 16
+
+    def __init__(self, fp, chunk):
+        self.fp = fp
+        self.chunk = chunk
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        # Read more into buf, at least as much as is unread already
+        # (so a big single-request costs only a few attempts to
+        # decode), dropping what has been read.  Return false at EOF.
+        if self.eof:
+            return False
+        more = self.fp.read(max(self.chunk, len(self.buf) - self.pos))
+        self.buf = self.buf[self.pos:] + more
+        self.pos = 0
+        if not more:
+            self.eof = True
+        return bool(more)
+
+    def peek(self):
+        # Skip whitespace and return the next character, or None at
+        # EOF
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return None
+
+    def value(self):
+        # Decode the next JSON value.  A value which runs up to the end
+        # of what has been read (which might be a number which goes on)
+        # or which fails to decode near the end might just be
+        # incomplete, so read more and try again in that case.
+        self.peek()
+        while True:
+            try:
+                (v, end) = self.decoder.scan_once(self.buf, self.pos)
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return v
+            except (StopIteration, ValueError) as e:
+                if self.eof or not self.truncated():
+                    raise BadJSON("bad JSON request", e)
+            self.fill()
+
+    def truncated(self):
+        # Decoding failed: might this be only because not enough has
+        # been read yet?  It might if it failed near the end of what
+        # has been read (the scanner may say it failed before
+        # whitespace at the end), or in a string which runs off the
+        # end of it; anywhere else reading more can't help, so the
+        # request is bad and there is no point in reading the rest of
+        # it first.
+        try:
+            self.locator(self.buf, self.pos)
+            return True
+        except StopIteration:
+            at = self.pos
+        except ValueError as e:
+            m = self.failed_at.search(str(e))
+            if m is None:
+                return True
+            at = int(m.group(1))
+        if len(self.buf[at:].strip()) <= self.cut_short:
+            return True
+        if self.buf[at] == '"':
+            try:
+                scanstring(self.buf, at + 1)
+            except ValueError:
+                return True
+        return False
+
+    def single_request(self):
+        s = self.value()
+        if not isinstance(s, dict):
+            raise BadSyntax("JSON request should be a list of objects")
+        return s
+
+    def single_requests(self):
+        c = self.peek()
+        if c == "[":
+            # a JSON array
+            self.pos += 1
+            if self.peek() == "]":
+                self.pos += 1
+            else:
+                while True:
+                    yield self.single_request()
+                    c = self.peek()
+                    self.pos += 1
+                    if c == "]":
+                        break
+                    elif c != ",":
+                        raise BadJSON("bad JSON request: expected , or ]")
+            if self.peek() is not None:
+                raise BadJSON("bad JSON request: extra data")
+        elif c == "{":
+            # JSON lines
+            while self.peek() is not None:
+                yield self.single_request()
+        else:
+            # Something else, which can't be a valid request, but
+            # decode it all for the right exception
+            while self.fill():
+                pass
+            try:
+                r = loads(self.buf[self.pos:])
+            except Exception as e:
+                raise BadJSON("bad JSON request", e)
+            validate_toplevel_request(r)
+
 def validate_toplevel_request(r):
     """Check an object is valid as a request at toplevel.
 
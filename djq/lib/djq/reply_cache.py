@@ -0,0 +1,165 @@
+# (C) British Crown Copyright 2018, Met Office.
+# See LICENSE.md in the top directory for license details.
+#
+
+"""A persistent cache of replies
+"""
+
+# The reply to a single-request depends only on the contents of the
+# DREQ, the MIP and experiment, the implementations used and the
+# feature bundle, so it can be kept between runs.  This is the store
+# for that: it knows nothing about how keys are made (see
+# djq.toplevel for that), only how to keep things under them.
+#
+# The cache lives in a directory given by the reply_cache_directory
+# fluid (by default from the DJQ_REPLY_CACHE_DIR environment
+# variable): if this is None no cache is used.  Each entry is a file
+# whose name is the key (a hex digest) with a .djqr suffix, holding a
+# header line and a pickle of the cached value.  Entries are written
+# to a temporary name and renamed into place, so readers never see a
+# partial one, and several processes can share a cache.  Anything
+# which can't be read is treated as missing.
+#
+# The cache is bounded by reply_cache_bytes (by default from
+# DJQ_REPLY_CACHE_BYTES, or 1GB): trim_reply_cache removes the least
+# recently used entries until the total size of the files is within
+# it.  Reading an entry touches it, so use is measured by mtime.
+# Trimming is not done on every write, since it has to look at every
+# entry, but by whoever is writing entries when they have written a
+# batch of them.
+#
+
+# Package interface
+__all__ = ('reply_cache_directory', 'reply_cache_bytes')
+
+# Interface
+# - read_cached_reply
+# - reply_cached
+# - write_cached_reply
+# - trim_reply_cache
+
+from os import getenv, getpid, rename, remove, stat, utime, listdir
+from os.path import join, isdir, exists
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+from low import fluid, globalize
+from low import mutter, debug
+
+reply_cache_directory = globalize(fluid(),
+                                  getenv("DJQ_REPLY_CACHE_DIR") or None,
+                                  threaded=True)
+
+reply_cache_bytes = globalize(fluid(),
+                              int(getenv("DJQ_REPLY_CACHE_BYTES")
+                                  or 1 << 30),
+                              threaded=True)
+
+# This is incremented whenever the structure of entries changes
+format_version = 1
+
+magic = "djq-reply"
+
+suffix = ".djqr"
+
+def entry_path(key, directory=None):
+    # The path of the entry for key, or None if there is no cache
+    if directory is None:
+        directory = reply_cache_directory()
+    if directory is None:
+        return None
+    return join(directory, key + suffix)
+
+def reply_cached(key):
+    """Is there an entry for key?  This does not read it."""
+    path = entry_path(key)
+    return path is not None and exists(path)
+
+def read_cached_reply(key):
+    """Return the value cached under key, or None.
+
+    None is returned if there is no cache directory, no entry or the
+    entry can't be read.  Reading an entry counts as using it.
+    """
+    path = entry_path(key)
+    if path is None or not exists(path):
+        return None
+    try:
+        with open(path, 'rb') as fp:
+            line = fp.readline().split()
+            if (len(line) != 2 or line[0] != magic
+                or line[1] != str(format_version)):
+                mutter("[reply cache entry {} is in the wrong format]", path)
+                return None
+            value = loads(fp.read())
+        utime(path, None)
+    except Exception as e:
+        mutter("[failed to read reply cache entry {}: {}]", path, e)
+        return None
+    debug("read reply cache entry {}", path)
+    return value
+
+def write_cached_reply(key, value):
+    """Cache value, which must be picklable, under key.
+
+    Return the name of the entry, or None if there is no cache
+    directory or it can't be written: failing to write an entry is not
+    an error.
+    """
+    directory = reply_cache_directory()
+    if directory is None:
+        return None
+    if not isdir(directory):
+        mutter("[reply cache {} is not a directory]", directory)
+        return None
+    path = entry_path(key, directory)
+    tmp = "{}.{}.tmp".format(path, getpid())
+    try:
+        try:
+            with open(tmp, 'wb') as out:
+                out.write("{} {}\n".format(magic, format_version))
+                out.write(dumps(value, HIGHEST_PROTOCOL))
+            rename(tmp, path)
+        finally:
+            if exists(tmp):
+                remove(tmp)
+    except Exception as e:
+        mutter("[failed to write reply cache entry {}: {}]", path, e)
+        return None
+    debug("wrote reply cache entry {}", path)
+    return path
+
+def trim_reply_cache(max_bytes=None):
+    """Remove the least recently used entries until the cache is small enough.
+
+    max_bytes defaults to reply_cache_bytes().  Return the number of
+    entries removed.
+    """
+    directory = reply_cache_directory()
+    if directory is None or not isdir(directory):
+        return 0
+    if max_bytes is None:
+        max_bytes = reply_cache_bytes()
+    entries = []
+    total = 0
+    for name in listdir(directory):
+        if name.endswith(suffix):
+            path = join(directory, name)
+            try:
+                st = stat(path)
+            except OSError:
+                # someone else removed it
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    removed = 0
+    for (mtime, size, path) in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            remove(path)
+            removed += 1
+        except OSError:
+            pass
+        total -= size
+    if removed > 0:
+        debug("trimmed {} reply cache entries", removed)
+    return removed
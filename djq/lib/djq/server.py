@@ -0,0 +1,142 @@
+# (C) British Crown Copyright 2018, Met Office.
+# See LICENSE.md in the top directory for license details.
+#
+
+"""A djq server, and a client for it
+"""
+
+# A server listens on a Unix-domain socket.  Each connection carries
+# one request: the client sends it (as a JSON array or JSON Lines, as
+# for process_stream) and then shuts down its side of the connection,
+# the server answers it with process_stream and closes the
+# connection, and the client copies the reply to wherever it wants it.
+# So, as far as the client is concerned, talking to the server is
+# just like running djq, except that the server's arguments decide
+# how requests are processed, since there is nowhere for the client to
+# say.
+#
+# The point of this is that the server process lives on, so the DREQs
+# it has loaded (the ensure_dq cache) and the indexes built for them
+# are kept from one request to the next, and only the first request
+# for a DREQ pays for loading it.  By default the server also uses
+# session memos, so things memoized while answering one request for a
+# DREQ are reused by later ones (see djq.toplevel).
+#
+# Each connection is handled in its own thread, with the fluid
+# bindings the server was started with (fluids are otherwise only
+# inherited by threads from their global values).  Everything shared
+# between requests is safe for this.  Forking from a threaded process
+# is not, so the server never preloads DREQs in a pool of processes.
+#
+
+# Package interface
+__all__ = ('make_server', 'serve', 'query_server')
+
+# Interface
+# - ServerRunning
+# - make_server
+# - serve
+# - query_server
+
+from sys import exc_info
+from os import unlink
+from os.path import exists
+from shutil import copyfileobj
+from socket import socket, error as socket_error, AF_UNIX, SOCK_STREAM, SHUT_WR
+from SocketServer import ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+from low import ExternalException
+from low import mutter, debug, fluids
+from toplevel import (process_stream, inherited_bindings, session_memos,
+                      preload_processes)
+
+class ServerRunning(ExternalException):
+    def __init__(self, path):
+        super(ServerRunning, self).__init__(
+            "a server is already listening on {}".format(path))
+
+class DJQServer(ThreadingMixIn, UnixStreamServer):
+    # The server: path is where it listens, bindings are the fluid
+    # bindings for each thread, and process_kws are the keyword
+    # arguments for process_stream
+    daemon_threads = True
+
+    def __init__(self, path, bindings, process_kws):
+        self.path = path
+        self.bindings = bindings
+        self.process_kws = process_kws
+        UnixStreamServer.__init__(self, path, DJQRequestHandler)
+
+    def handle_error(self, request, client_address):
+        # Something went wrong with a connection, most likely the
+        # client going away: not the server's problem
+        mutter("[trouble with a connection: {}]", exc_info()[1])
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        if exists(self.path):
+            unlink(self.path)
+
+class DJQRequestHandler(StreamRequestHandler):
+    def handle(self):
+        debug("connection on {}", self.server.path)
+        with fluids(*self.server.bindings):
+            process_stream(self.rfile, self.wfile, **self.server.process_kws)
+
+def make_server(path, session=True, **process_kws):
+    """Make a server which will listen on the Unix-domain socket path.
+
+    process_kws are keyword arguments for process_stream, which
+    answers each request.  If session is true (the default) session
+    memos are used for requests, regardless of session_memos(), and
+    DREQs are never preloaded: see djq.toplevel.  Return the server:
+    its serve_forever method will serve requests until its shutdown
+    method is called, after which its server_close method should be
+    called to remove the socket.
+
+    If there is already a socket at path with a server listening on
+    it raise ServerRunning, otherwise remove it.
+    """
+    if exists(path):
+        probe = socket(AF_UNIX, SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket_error:
+            # a dead server's socket
+            unlink(path)
+        else:
+            raise ServerRunning(path)
+        finally:
+            probe.close()
+    process_kws.setdefault('backtrace', False)
+    bindings = (tuple((f, (v if f is not session_memos else v or session))
+                      for (f, v) in inherited_bindings())
+                + ((preload_processes, 0),))
+    return DJQServer(path, bindings, process_kws)
+
+def serve(path, **process_kws):
+    """Serve requests on the Unix-domain socket path until interrupted.
+
+    process_kws are as for make_server.  No useful return value.
+    """
+    server = make_server(path, **process_kws)
+    mutter("serving on {}", path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def query_server(path, input, output):
+    """Send the request read from input to the server on path.
+
+    The reply is written to output.  No useful return value.
+    """
+    connection = socket(AF_UNIX, SOCK_STREAM)
+    try:
+        connection.connect(path)
+        request = connection.makefile('wb')
+        copyfileobj(input, request)
+        request.close()         # flushes, leaves connection open
+        connection.shutdown(SHUT_WR)
+        copyfileobj(connection.makefile('rb'), output)
+    finally:
+        connection.close()
@@ -0,0 +1,413 @@
+# (C) British Crown Copyright 2018, Met Office.
+# See LICENSE.md in the top directory for license details.
+#
+
+"""Persistent snapshots of loaded DREQs
+"""
+
+# Parsing the DREQ XML is by far the most expensive thing that
+# happens when running small queries.  A snapshot is a file holding
+# the contents of a loaded DREQ in a form which is much faster to
+# read: it contains the items of each section as plain dicts, the
+# cross-reference index (iref_by_sect) and enough information about
+# section headers and attribute definitions to reconstruct objects
+# which behave, as far as djq's back ends are concerned, like the
+# ones dreqPy makes.
+#
+# Snapshots live in a directory given by the snapshot_directory fluid
+# (by default from the DJQ_SNAPSHOT_DIR environment variable): if
+# this is None then no snapshots are used.  Each snapshot is keyed on
+# the effective path of the XML directory, and records a stamp of the
+# XML and configuration files (size, mtime and an MD5 hash of their
+# contents) together with the format, Python and dreqPy versions.  A
+# snapshot whose stamp does not match the files is stale and is
+# ignored (and will be overwritten by the next load), so updating a
+# checkout invalidates any snapshots of it automatically.
+#
+# The file format is a single header line, followed by a pickled
+# header dict, followed by one pickle per section.  The header
+# records the offset and length of each section's pickle so sections
+# can be read individually, and the uids of the items in each
+# section.
+#
+# This makes it possible to read only some sections of a snapshot,
+# which is much faster and uses much less memory than reading all of
+# them, as many sections are never looked at by djq.  The resulting
+# DREQ is a view: the sections asked for (and the meta sections,
+# which are always read) are complete, while every item of the other
+# sections is represented by a stub, which knows its uid and its
+# section (so inx.uid has the same keys and _h.label works, which is
+# enough to check what sort of thing a uid refers to), but nothing
+# else: trying to get any other attribute of a stub raises
+# SectionNotLoaded.  Neither coll nor inx has entries for the other
+# sections, and iref_by_sect only knows about references from the
+# sections which were read.  The sections attribute of a view is the
+# set of sections read, and is None for a complete DREQ.
+#
+# Nothing in here knows how to find the files: see djq.load for that.
+#
+
+# Package interface
+__all__ = ('snapshot_directory',)
+
+# Interface
+# - SnapshotFailure
+# - SectionNotLoaded
+# - meta_sections
+# - snapshot_of_dreq
+# - dreq_of_snapshot
+# - read_snapshot
+# - write_snapshot
+# - Snapshot
+
+from os import getenv, getpid, rename, remove, stat
+from os.path import join, realpath, isdir, exists
+from sys import version_info
+from collections import defaultdict
+from hashlib import md5, sha1
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+from dreqPy.dreq import version as dreqPy_version
+from low import fluid, globalize
+from low import ExternalException, InternalException
+from low import mutter, debug
+
+snapshot_directory = globalize(fluid(), getenv("DJQ_SNAPSHOT_DIR") or None,
+                               threaded=True)
+
+# This is incremented whenever the structure of snapshots changes
+format_version = 2
+
+magic = "djq-snapshot"
+
+# Sections which are always read: the others refer to them
+meta_sections = frozenset(('__core__', '__main__', '__sect__'))
+
+class SnapshotFailure(ExternalException):
+    def __init__(self, message, wrapped=None):
+        super(SnapshotFailure, self).__init__(message)
+        self.wrapped = wrapped
+
+class SectionNotLoaded(InternalException):
+    def __init__(self, section, uid, attribute):
+        super(SectionNotLoaded, self).__init__(
+            "{} of {} in section {}, which was not loaded".format(
+                attribute, uid, section))
+        self.section = section
+        self.uid = uid
+        self.attribute = attribute
+
+# Stamps & names
+#
+
+def file_stamp(path):
+    # (size, mtime, content hash) for a file
+    st = stat(path)
+    h = md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ""):
+            h.update(chunk)
+    return (st.st_size, st.st_mtime, h.hexdigest())
+
+def snapshot_stamp(top, files):
+    # The stamp for a snapshot of top, built from files
+    return ((format_version, tuple(version_info[:2]), dreqPy_version,
+             realpath(top))
+            + tuple(file_stamp(f) for f in files))
+
+def snapshot_path(top, directory=None):
+    """The path of the snapshot for top in directory.
+
+    directory defaults from snapshot_directory().  Return None if
+    there is no directory.
+    """
+    if directory is None:
+        directory = snapshot_directory()
+    if directory is None:
+        return None
+    return join(directory,
+                "{}.djqs".format(sha1(realpath(top)).hexdigest()))
+
+# Converting a loaded DREQ into a snapshot and back
+#
+
+def snapshot_of_dreq(dq):
+    """Return a snapshot of a loaded dq as a tuple of (version, sections).
+
+    sections is a tuple of (name, section) in the order dq.coll
+    iterates, where each section is a dict containing only strings,
+    numbers, tuples, lists & dicts.  dq should be something loaded by
+    dreqPy, but snapshots of snapshots also work.
+    """
+    # Cross references, regrouped by the section doing the referring
+    irefs = defaultdict(dict)
+    for (target, c) in dq.inx.iref_by_sect.iteritems():
+        for (sect, uids) in c.a.iteritems():
+            irefs[sect][target] = tuple(uids)
+
+    def public(item):
+        return {k: v for (k, v) in item.__dict__.iteritems()
+                if not k.startswith("_")}
+
+    def section(name, c):
+        # Items in a section all share a class, and the class holds
+        # both the header (_h) and the attribute definitions (whose
+        # names are attributes of the class).  The header is usually
+        # an item of the __sect__ section, but for the meta sections
+        # is a named tuple: record which.
+        if len(c.items) > 0:
+            h = c.items[0]._h
+            hdr = (('uid', h.uid)
+                   if h.uid in dq.inx.uid and dq.inx.uid[h.uid] is h
+                   else ('record', dict(h._asdict()
+                                        if hasattr(h, '_asdict')
+                                        else public(h))))
+        else:
+            hdr = None
+        return {'header': dict(c.header._asdict()
+                               if hasattr(c.header, '_asdict')
+                               else public(c.header)),
+                'item-header': hdr,
+                'attributes': {k: a.uid for (k, a) in c.attDefn.iteritems()},
+                'items': tuple(public(i) for i in c.items),
+                'irefs': irefs[name]}
+
+    return (dq.version,
+            tuple((name, section(name, c))
+                  for (name, c) in dq.coll.iteritems()))
+
+class Record(object):
+    # Just a thing with attributes
+    def __init__(self, attributes):
+        self.__dict__.update(attributes)
+
+class SnapshotItem(object):
+    # The superclass of all items in a snapshot
+    def __repr__(self):
+        return "<{} {}: {}>".format(self.__class__.__name__,
+                                    self._h.label,
+                                    self.__dict__.get('label'))
+
+class StubItem(SnapshotItem):
+    # An item in a section which was not read: it has a uid and the
+    # class has _h, but nothing else
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        raise SectionNotLoaded(self._h.label, self.uid, name)
+
+class Section(object):
+    # Like dreqPy's sect named tuple
+    def __init__(self, header, attDefn, items):
+        self.header = header
+        self.attDefn = attDefn
+        self.items = items
+
+class Container(object):
+    # Per-section index, like dreqPy's container
+    def __init__(self, sn=False):
+        self.uid = {}
+        self.label = defaultdict(list)
+        if sn:
+            self.sn = defaultdict(list)
+
+class IRef(object):
+    # An entry in iref_by_sect
+    def __init__(self):
+        self.a = defaultdict(tuple)
+
+class Index(object):
+    # Like (the parts we need of) dreqPy's index
+    def __init__(self):
+        self.uid = {}
+        self.iref_by_sect = defaultdict(IRef)
+
+class Snapshot(object):
+    """A DREQ reconstructed from a snapshot.
+
+    This has the parts of the interface of dreqPy.dreq.loadDreq that
+    djq's back ends use: version, coll (sections with header, attDefn
+    & items) and inx (uid, iref_by_sect and a per-section container
+    with uid & label indices).  Items are instances of a class per
+    section, whose _h attribute is the section header and whose other
+    class attributes are the attribute definitions, as in dreqPy.
+
+    If stubs is given it is a dict mapping the names of sections which
+    were not read to the uids of their items, and the result is a
+    view: see above.
+    """
+    def __init__(self, version, sections, source=None, stubs=None):
+        self.version = version
+        self.source = source
+        self.sections = (frozenset(name for (name, s) in sections)
+                         if stubs is not None
+                         else None)
+        self.coll = {}
+        self.inx = Index()
+        classes = []
+        for (name, s) in sections:
+            cls = type("dqitem_{}".format(name.encode('ascii', 'replace')),
+                       (SnapshotItem,), {})
+            items = []
+            for d in s['items']:
+                i = cls.__new__(cls)
+                i.__dict__.update(d)
+                items.append(i)
+            self.coll[name] = Section(Record(s['header']), {}, items)
+            container = Container(sn=('sn' in s['attributes']))
+            setattr(self.inx, name, container)
+            for i in items:
+                # later sections win, as in dreqPy
+                self.inx.uid[i.uid] = i
+                container.uid[i.uid] = i
+                container.label[i.label].append(i.uid)
+                if hasattr(container, 'sn') and 'sn' in i.__dict__:
+                    container.sn[i.sn].append(i.uid)
+            for (target, uids) in s['irefs'].iteritems():
+                self.inx.iref_by_sect[target].a[name] = uids
+            classes.append((name, cls, s))
+        # Now every item exists, hook up headers & attribute
+        # definitions
+        uid = self.inx.uid
+        for (name, cls, s) in classes:
+            hdr = s['item-header']
+            if hdr is not None:
+                (kind, h) = hdr
+                cls._h = uid[h] if kind == 'uid' else Record(h)
+            attdefn = self.coll[name].attDefn
+            for (k, a) in s['attributes'].iteritems():
+                attdefn[k] = uid[a]
+                setattr(cls, k.encode('ascii'), uid[a])
+            cls._a = attdefn
+        if stubs is not None:
+            # Stubs for the other sections, whose header is the
+            # __sect__ item for the section if there is one
+            headers = self.inx.__sect__.label
+            for (name, uids) in stubs.iteritems():
+                cls = type("dqstub_{}".format(name.encode('ascii',
+                                                          'replace')),
+                           (StubItem,),
+                           {'_h': (uid[headers[name][0]]
+                                   if name in headers
+                                   else Record({'label': name}))})
+                for u in uids:
+                    i = cls.__new__(cls)
+                    i.uid = u
+                    uid[u] = i
+
+def dreq_of_snapshot(snapshot, source=None, stubs=None):
+    """Reconstruct a DREQ from a snapshot made by snapshot_of_dreq.
+
+    If stubs is given the result is a view: see Snapshot.
+    """
+    (version, sections) = snapshot
+    return Snapshot(version, sections, source=source, stubs=stubs)
+
+# Reading and writing
+#
+
+def write_snapshot(dq, top, files, directory=None):
+    """Write a snapshot of dq, loaded from files under top.
+
+    Return the name of the snapshot file, or None if there is no
+    snapshot directory.  Raise SnapshotFailure if something goes
+    wrong.
+
+    The file is written to a temporary name and then renamed into
+    place, so readers never see a partial snapshot.  dq should be a
+    complete DREQ, not a view.
+    """
+    if directory is None:
+        directory = snapshot_directory()
+    if directory is None:
+        return None
+    if not isdir(directory):
+        raise SnapshotFailure("{} is not a directory".format(directory))
+    path = snapshot_path(top, directory)
+    try:
+        (version, sections) = snapshot_of_dreq(dq)
+        pickles = tuple((name, dumps(s, HIGHEST_PROTOCOL))
+                        for (name, s) in sections)
+        offsets = []
+        offset = 0
+        for (name, p) in pickles:
+            offsets.append((name, offset, len(p)))
+            offset += len(p)
+        header = dumps({'stamp': snapshot_stamp(top, files),
+                        'version': version,
+                        'sections': tuple(offsets),
+                        'uids': {name: tuple(i['uid'] for i in s['items'])
+                                 for (name, s) in sections}},
+                       HIGHEST_PROTOCOL)
+        tmp = "{}.{}.tmp".format(path, getpid())
+        try:
+            with open(tmp, 'wb') as out:
+                out.write("{} {} {}\n".format(magic, format_version,
+                                              len(header)))
+                out.write(header)
+                for (name, p) in pickles:
+                    out.write(p)
+            rename(tmp, path)
+        finally:
+            if exists(tmp):
+                remove(tmp)
+        debug("wrote snapshot {} for {}", path, top)
+        return path
+    except SnapshotFailure:
+        raise
+    except Exception as e:
+        raise SnapshotFailure("failed to write snapshot {}".format(path), e)
+
+def read_snapshot_header(fp):
+    # Read the header of a snapshot from fp, returning the header
+    # dict and leaving fp at the start of the sections, or None if
+    # it's not a snapshot in the right format.
+    line = fp.readline().split()
+    if (len(line) != 3 or line[0] != magic
+        or line[1] != str(format_version)):
+        return None
+    return loads(fp.read(int(line[2])))
+
+def read_snapshot(top, files, directory=None, sections=None):
+    """Read a snapshot of the DREQ under top, built from files.
+
+    Return the reconstructed DREQ, or None if there is no snapshot
+    directory, no snapshot or the snapshot is stale.  A snapshot which
+    can't be read is treated as missing.
+
+    If sections is given it is an iterable of the names of the
+    sections to read, and the result is a view containing only those
+    sections and the meta sections: see above.
+    """
+    path = snapshot_path(top, directory)
+    if path is None or not exists(path):
+        return None
+    try:
+        with open(path, 'rb') as fp:
+            header = read_snapshot_header(fp)
+            if header is None:
+                mutter("[snapshot {} is in the wrong format]", path)
+                return None
+            if header['stamp'] != snapshot_stamp(top, files):
+                mutter("[snapshot {} is stale]", path)
+                return None
+            if sections is None:
+                wanted = None
+                stubs = None
+            else:
+                wanted = meta_sections | frozenset(sections)
+                stubs = {name: uids
+                         for (name, uids) in header['uids'].iteritems()
+                         if name not in wanted}
+            base = fp.tell()
+            loaded = []
+            for (name, offset, length) in header['sections']:
+                if wanted is None or name in wanted:
+                    fp.seek(base + offset)
+                    loaded.append((name, loads(fp.read(length))))
+    except Exception as e:
+        mutter("[failed to read snapshot {}: {}]", path, e)
+        return None
+    debug("read snapshot {} for {}{}", path, top,
+          " (sections {})".format(sorted(wanted)) if wanted else "")
+    return dreq_of_snapshot((header['version'], tuple(loaded)),
+                            source=path, stubs=stubs)
@@ -6,9 +6,11 @@
 #
 
 from StringIO import StringIO
-from json import load
+from json import load, loads, dumps
+from cPickle import dumps as pickle_dumps, loads as pickle_loads
 from djq.parse import read_request
-from djq.emit import emit_reply, emit_catastrophe
+from djq.emit import emit_reply, emit_catastrophe, ReplyStream
+from djq.variables.jsonify import encoded_variable
 
 # This just tests that we can round-trip it: it doesn't check
 # exceptions or anything yet.
@@ -52,3 +54,78 @@ def test_catastrophe():
     cd = string2catastrophe(catastrophe2string("doom"))
     assert isinstance(cd, dict)
     assert 'catastrophe' in cd and cd['catastrophe'] == "doom"
+
+# Tests of streaming replies
+#
+
+def stream2string(replies, json_lines=False, catastrophe=None,
+                  compact=False):
+    stream = StringIO()
+    rs = ReplyStream(stream, json_lines=json_lines, compact=compact)
+    for reply in replies:
+        rs.emit(reply)
+    if catastrophe is None:
+        rs.close()
+    else:
+        rs.catastrophe(catastrophe)
+    return stream.getvalue()
+
+def lines2replies(s):
+    return tuple(loads(line) for line in s.splitlines())
+
+def test_stream_round_trips():
+    def check(r):
+        assert tuple(string2request(stream2string(r))) == r
+        assert lines2replies(stream2string(r, json_lines=True)) == r
+    for request in requests + ((), requests[0] * 3):
+        yield (check, request)
+
+def test_stream_catastrophe():
+    # before anything is emitted it is just a catastrophe
+    cd = string2catastrophe(stream2string((), catastrophe="doom"))
+    assert isinstance(cd, dict) and cd['catastrophe'] == "doom"
+    # after, it is the last reply
+    rs = string2catastrophe(stream2string(requests[0], catastrophe="doom"))
+    assert (isinstance(rs, list) and len(rs) == 2
+            and rs[-1]['catastrophe'] == "doom")
+    rs = lines2replies(stream2string(requests[0], json_lines=True,
+                                     catastrophe="doom"))
+    assert len(rs) == 2 and rs[-1]['catastrophe'] == "doom"
+
+def test_compact():
+    for request in requests + ((), requests[0] * 3):
+        s = stream2string(request, compact=True)
+        assert "\n" not in s.rstrip("\n") and ": " not in s
+        assert tuple(string2request(s)) == request
+        stream = StringIO()
+        emit_reply(request, stream, compact=True)
+        assert stream.getvalue() == s
+
+def test_fragments():
+    # pre-encoded variables are spliced in, and the result is what
+    # encoding the reply would have produced
+    variables = ({'uid': "u1", 'label': "tas", 'priority': 1,
+                  'mips': ({'mip': "CMIP", 'priority': 1},)},
+                 {'uid': "u2", 'label': u"caf\xe9", 'priority': 2.5,
+                  'mips': ()})
+    reply = {'mip': "CMIP", 'experiment': None,
+             'reply-status': "ok",
+             'reply-metadata': {'a': [1, {'b': 2}], 3: "c"},
+             'reply-variables': tuple(encoded_variable(v)
+                                      for v in variables)}
+    assert (pickle_loads(pickle_dumps(reply['reply-variables'][1], 2))
+            .json_fragment == dumps(variables[1], separators=(',', ':')))
+    encoded = dumps(reply, separators=(',', ':'))
+    assert stream2string((reply,), compact=True) == "[{}]\n".format(encoded)
+    assert (stream2string((reply,), json_lines=True)
+            == "{}\n".format(encoded))
+    stream = StringIO()
+    emit_reply((reply,), stream, compact=True)
+    assert stream.getvalue() == "[{}]\n".format(encoded)
+    # the fragment really is what is written
+    reply['reply-variables'] = (encoded_variable(variables[0], '"fake"'),)
+    assert ('"reply-variables":["fake"]'
+            in stream2string((reply,), compact=True))
+    stream = StringIO()
+    emit_reply((reply,), stream, compact=True)
+    assert '"reply-variables":["fake"]' in stream.getvalue()
@@ -10,12 +10,24 @@ import djq
 from djq.low import validate_package_interface, report_package_interface
 
 categories = {'instances': {FunctionType: ('process_stream', 'process_request',
-                                           'read_request',
+                                           'read_request', 'read_request_stream',
                                            'default_dqroot', 'valid_dqroot',
                                            'default_dqtag','valid_dqtag',
                                            'default_dqpath',
+                                           'selective_loading',
+                                           'snapshot_directory',
+                                           'rebuild_snapshot',
+                                           'reply_cache_directory',
+                                           'reply_cache_bytes',
                                            'ensure_dq', 'invalidate_dq_cache',
-                                           'dq_info'),
+                                           'dq_info',
+                                           'configure_dq_cache',
+                                           'dq_cache_stats',
+                                           'session_memos',
+                                           'preload_processes',
+                                           'request_window',
+                                           'make_server', 'serve',
+                                           'query_server'),
                             ModuleType: ('low', 'variables')},
               'types': {Exception: ('BadJSON', 'BadParse', 'BadSyntax')}}
 
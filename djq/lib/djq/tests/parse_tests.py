@@ -8,8 +8,8 @@
 from StringIO import StringIO
 from nose.tools import raises
 from djq.parse import BadParse, BadJSON, BadSyntax
-from djq.parse import (read_request, validate_toplevel_request,
-                       validate_single_request)
+from djq.parse import (read_request, read_request_stream,
+                       validate_toplevel_request, validate_single_request)
 
 # Tests of the top-level reader
 #
@@ -58,6 +58,79 @@ def test_hopless_toplevels():
     for j in hopeless_toplevels:
         yield (read_hopeless, j)
 
+# Tests of the incremental reader, which should agree with the
+# top-level reader, however small its chunks
+#
+def read_stringy_request_stream(s, chunk=1 << 16):
+    return list(read_request_stream(StringIO(s), chunk=chunk))
+
+def test_good_toplevel_streams():
+    def check(j, chunk):
+        assert (read_stringy_request_stream(j, chunk)
+                == read_stringy_request(j))
+    for j in good_toplevels:
+        for chunk in (1, 7, 1 << 16):
+            yield (check, j, chunk)
+
+def test_bad_toplevel_streams():
+    @raises(BadSyntax)
+    def read_bad(json):
+        return read_stringy_request_stream(json)
+    for j in bad_toplevels:
+        yield (read_bad, j)
+
+def test_hopeless_toplevel_streams():
+    @raises(BadJSON)
+    def read_hopeless(json, chunk):
+        return read_stringy_request_stream(json, chunk)
+    for j in hopeless_toplevels + ("[{}", "[{},]", "[{}] {}", "{} x"):
+        for chunk in (1, 1 << 16):
+            yield (read_hopeless, j, chunk)
+
+json_lines = (
+    ("{}", [{}]),
+    ("""{"mip": "one", "experiment": "two"}
+{"mip": "three", "experiment": 12345}
+
+{"mip": "four",
+ "experiment": true}
+""",
+     [{'mip': "one", 'experiment': "two"},
+      {'mip': "three", 'experiment': 12345},
+      {'mip': "four", 'experiment': True}]))
+
+def test_json_lines():
+    def check(j, r, chunk):
+        assert read_stringy_request_stream(j, chunk) == r
+    for (j, r) in json_lines:
+        for chunk in (1, 7, 1 << 16):
+            yield (check, j, r, chunk)
+
+def test_incremental():
+    # single-requests come out before the rest has been read
+    stream = read_request_stream(StringIO("[{}, {}, x"), chunk=1)
+    assert next(stream) == {} and next(stream) == {}
+
+def test_early_failure():
+    # bad JSON is noticed without reading the rest of the input
+    class Endless(object):
+        def __init__(self, start):
+            self.start = start
+        def read(self, n):
+            (r, self.start) = (self.start, "")
+            assert r, "read too far"
+            return r
+    for bad in ('[{"mip": x}, ', '[{"mip" "x"}, ', '[{"mip": "x" "y"}, ',
+                '[{}, x', '{"mip":\n"x"}\n{"a\tb": 1}\n'):
+        stream = read_request_stream(Endless(bad + '{"mip": "ok"},\n' * 10),
+                                     chunk=1 << 16)
+        try:
+            list(stream)
+        except BadJSON:
+            pass
+        else:
+            assert False, "no BadJSON for {}".format(bad)
+
 # Tests of request at toplevel
 #
 
@@ -0,0 +1,84 @@
+# (C) British Crown Copyright 2018, Met Office.
+# See LICENSE.md in the top directory for license details.
+#
+
+# Tests for the reply cache
+#
+# The later ones need the DREQ which comes with dreqPy, and loading it
+# takes a few seconds.
+#
+
+from os import utime
+from os.path import join, split
+from shutil import rmtree
+from tempfile import mkdtemp
+from dreqPy.dreq import defaultDreqPath
+from djq.low import fluids, feature_bundle, FeatureBundle
+from djq.reply_cache import (reply_cache_directory, reply_cached,
+                             read_cached_reply, write_cached_reply,
+                             trim_reply_cache)
+from djq.toplevel import process_request, ensure_dq, reply_key
+from djq.variables import jsonify_implementation
+import djq.variables.jsonify_simple as jsonify_simple
+
+dirs = {}
+
+def setup():
+    dirs['cache'] = mkdtemp()
+
+def teardown():
+    rmtree(dirs['cache'])
+
+def test_store():
+    with fluids((reply_cache_directory, dirs['cache'])):
+        assert read_cached_reply("a") is None
+        assert not reply_cached("a")
+        assert write_cached_reply("a", {'x': [1, 2]}) is not None
+        assert reply_cached("a")
+        assert read_cached_reply("a") == {'x': [1, 2]}
+        with open(join(dirs['cache'], "b.djqr"), 'w') as out:
+            out.write("not an entry\n")
+        assert read_cached_reply("b") is None
+    with fluids((reply_cache_directory, None)):
+        assert write_cached_reply("a", 1) is None
+        assert read_cached_reply("a") is None
+
+def test_trim():
+    with fluids((reply_cache_directory, dirs['cache'])):
+        keys = tuple("t{}".format(i) for i in range(10))
+        for (i, key) in enumerate(keys):
+            utime(write_cached_reply(key, "x" * 1000), (i, i))
+        assert trim_reply_cache(max_bytes=1 << 20) == 0
+        # the oldest go first
+        assert trim_reply_cache(max_bytes=5500) > 0
+        assert not reply_cached(keys[0])
+        assert reply_cached(keys[-1])
+
+def test_replies():
+    xml = split(defaultDreqPath)[0]
+    request = ({'mip': "CMIP", 'experiment': "historical"},
+               {'mip': "CMIP", 'experiment': "no-such-experiment"})
+    with fluids((reply_cache_directory, dirs['cache'])):
+        first = process_request(request, dqpath=xml)
+        second = process_request(request, dqpath=xml)
+    assert not any(r['reply-metadata']['reply-cached'] for r in first)
+    assert all(r['reply-metadata']['reply-cached'] for r in second)
+    for (f, s) in zip(first, second):
+        assert f['reply-status'] == s['reply-status']
+        assert f['reply-variables'] == s['reply-variables']
+
+def test_keys():
+    dq = ensure_dq(dqpath=split(defaultDreqPath)[0])
+    rc = {'mip': "CMIP", 'experiment': "historical"}
+    with fluids((reply_cache_directory, None)):
+        assert reply_key(dq, rc) is None
+    with fluids((reply_cache_directory, dirs['cache'])):
+        key = reply_key(dq, rc)
+        assert key is not None and key == reply_key(dq, dict(rc))
+        assert key != reply_key(dq, {'mip': "CMIP", 'experiment': "amip"})
+        with fluids((feature_bundle, FeatureBundle(source={'x': 1}))):
+            assert key != reply_key(dq, rc)
+        with fluids((jsonify_implementation, jsonify_simple)):
+            assert key != reply_key(dq, rc)
+        # something which was never loaded can't be fingerprinted
+        assert reply_key(object(), rc) is None
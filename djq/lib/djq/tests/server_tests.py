@@ -0,0 +1,72 @@
+# (C) British Crown Copyright 2018, Met Office.
+# See LICENSE.md in the top directory for license details.
+#
+
+# Tests for the server
+#
+# These run a server in a thread, on a socket in a temporary
+# directory, and only send it requests which need no DREQ.
+#
+
+from StringIO import StringIO
+from os.path import join, exists
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread
+from json import loads, dumps
+from nose.tools import raises
+from djq.server import make_server, query_server, ServerRunning
+from djq.toplevel import preload_processes
+
+state = {}
+
+def setup():
+    state['dir'] = mkdtemp()
+    state['path'] = join(state['dir'], "djq.sock")
+    state['server'] = make_server(state['path'], json_lines=True)
+    state['thread'] = Thread(target=state['server'].serve_forever)
+    state['thread'].start()
+
+def teardown():
+    state['server'].shutdown()
+    state['thread'].join()
+    state['server'].server_close()
+    assert not exists(state['path'])
+    rmtree(state['dir'])
+
+def query(request):
+    out = StringIO()
+    query_server(state['path'], StringIO(request), out)
+    return tuple(loads(line) for line in out.getvalue().splitlines())
+
+def test_queries():
+    request = ({'mip': 1, 'experiment': "ok"},
+               {'mip': "ok", 'experiment': "ok", 'extra': "not allowed"})
+    for i in range(3):
+        replies = query(dumps(request))
+        assert len(replies) == len(request)
+        assert all(r['reply-status'] == "bad-request" for r in replies)
+
+def test_concurrent_queries():
+    results = [None] * 4
+    def run(i):
+        results[i] = query(dumps(({'mip': i, 'experiment': "ok"},)))
+    threads = [Thread(target=run, args=(i,)) for i in range(len(results))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert all(len(r) == 1 and r[0]['mip'] == i
+               for (i, r) in enumerate(results))
+
+def test_catastrophe():
+    replies = query("not even trying")
+    assert len(replies) == 1 and 'catastrophe' in replies[0]
+
+@raises(ServerRunning)
+def test_running():
+    make_server(state['path'])
+
+def test_no_preloading():
+    # the server must never fork a pool of processes
+    assert (preload_processes, 0) in state['server'].bindings
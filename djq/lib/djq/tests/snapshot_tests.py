@@ -0,0 +1,131 @@
+# (C) British Crown Copyright 2018, Met Office.
+# See LICENSE.md in the top directory for license details.
+#
+
+# Tests for snapshots
+#
+# These need the XML files which come with dreqPy, which they copy
+# into a temporary directory so they can be altered.  Loading the DREQ
+# takes a few seconds.
+#
+
+from os import utime, stat, makedirs, symlink
+from os.path import split, join
+from shutil import copy, rmtree
+from tempfile import mkdtemp
+from nose.tools import raises
+from dreqPy.dreq import defaultDreqPath, defaultConfigPath
+from djq.low import fluids
+from djq.load import dqload, rebuild_snapshot, default_dqroot
+from djq.snapshot import (snapshot_directory, read_snapshot, Snapshot,
+                          SnapshotFailure, SectionNotLoaded)
+from djq.toplevel import (preload_dqs, preload_processes, ensure_dq,
+                          invalidate_dq_cache)
+
+dirs = {}
+
+def setup():
+    dirs['xml'] = mkdtemp()
+    dirs['snapshots'] = mkdtemp()
+    for f in (defaultDreqPath, defaultConfigPath):
+        copy(f, dirs['xml'])
+    # a root with two tags which are the same DREQ
+    dirs['root'] = mkdtemp()
+    makedirs(join(dirs['root'], "trunk"))
+    for tag in ("a", "b"):
+        makedirs(join(dirs['root'], "tags", tag, "dreqPy"))
+        symlink(dirs['xml'], join(dirs['root'], "tags", tag, "dreqPy", "docs"))
+
+def teardown():
+    for d in dirs.itervalues():
+        rmtree(d)
+
+def files():
+    return tuple(join(dirs['xml'], split(f)[1])
+                 for f in (defaultDreqPath, defaultConfigPath))
+
+def public(item):
+    return {k: v for (k, v) in item.__dict__.iteritems()
+            if not k.startswith("_")}
+
+def test_round_trip():
+    with fluids((snapshot_directory, dirs['snapshots'])):
+        dq = dqload(dqpath=dirs['xml'], snapshot=False)
+        sdq = dqload(dqpath=dirs['xml'])
+    assert isinstance(sdq, Snapshot)
+    assert sdq.version == dq.version
+    assert set(sdq.inx.uid.keys()) == set(dq.inx.uid.keys())
+    for (uid, item) in dq.inx.uid.iteritems():
+        sitem = sdq.inx.uid[uid]
+        assert public(sitem) == public(item)
+        assert sitem._h.label == item._h.label
+    for (uid, iref) in dq.inx.iref_by_sect.iteritems():
+        for (sect, uids) in iref.a.iteritems():
+            assert sdq.inx.iref_by_sect[uid].a[sect] == tuple(uids)
+    assert (dict(sdq.inx.experiment.label)
+            == dict(dq.inx.experiment.label))
+    assert (set(i.uid for i in sdq.coll['CMORvar'].items)
+            == set(i.uid for i in dq.coll['CMORvar'].items))
+
+def test_stale():
+    with fluids((snapshot_directory, dirs['snapshots'])):
+        rebuild_snapshot(dqpath=dirs['xml'])
+        assert read_snapshot(dirs['xml'], files()) is not None
+        xml = files()[0]
+        mtime = stat(xml).st_mtime
+        utime(xml, (mtime + 10, mtime + 10))
+        assert read_snapshot(dirs['xml'], files()) is None
+
+def test_selective():
+    with fluids((snapshot_directory, dirs['snapshots'])):
+        dq = dqload(dqpath=dirs['xml'])
+        vdq = dqload(dqpath=dirs['xml'], sections=("CMORvar", "mip"))
+    assert getattr(dq, 'sections', None) is None
+    assert vdq.sections == frozenset(("CMORvar", "mip", "__core__",
+                                      "__main__", "__sect__"))
+    assert set(vdq.inx.uid.keys()) == set(dq.inx.uid.keys())
+    assert set(vdq.coll.keys()) == vdq.sections
+    for cmv in vdq.coll['CMORvar'].items:
+        assert public(cmv) == public(dq.inx.uid[cmv.uid])
+        # var is not loaded, but what sort of thing vid is is known
+        var = vdq.inx.uid[cmv.vid]
+        assert var._h.label == dq.inx.uid[cmv.vid]._h.label
+    for iref in vdq.inx.iref_by_sect.itervalues():
+        assert set(iref.a.keys()) <= vdq.sections
+
+@raises(SectionNotLoaded)
+def test_stub():
+    with fluids((snapshot_directory, dirs['snapshots'])):
+        vdq = dqload(dqpath=dirs['xml'], sections=("CMORvar",))
+    vdq.inx.uid[vdq.coll['CMORvar'].items[0].vid].label
+
+@raises(SnapshotFailure)
+def test_no_directory():
+    with fluids((snapshot_directory, None)):
+        rebuild_snapshot(dqpath=dirs['xml'])
+
+def test_preload():
+    invalidate_dq_cache()
+    request = ({'mip': "CMIP", 'experiment': "historical", 'dreq': "a"},
+               {'mip': "CMIP", 'experiment': "historical", 'dreq': "b"},
+               {'mip': "CMIP", 'experiment': "historical", 'dreq': "c"},
+               {'mip': "CMIP"})
+    try:
+        with fluids((snapshot_directory, dirs['snapshots']),
+                    (default_dqroot, dirs['root'])):
+            # off by default
+            assert preload_dqs(request) == ()
+        with fluids((snapshot_directory, None),
+                    (preload_processes, 2),
+                    (default_dqroot, dirs['root'])):
+            # nothing without a snapshot directory
+            assert preload_dqs(request) == ()
+        with fluids((snapshot_directory, dirs['snapshots']),
+                    (preload_processes, 2),
+                    (default_dqroot, dirs['root'])):
+            assert set(preload_dqs(request)) == set(("a", "b"))
+            assert preload_dqs(request) == ()
+            for tag in ("a", "b"):
+                assert isinstance(ensure_dq(tag), Snapshot)
+    finally:
+        invalidate_dq_cache()
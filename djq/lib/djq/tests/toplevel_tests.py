@@ -9,10 +9,18 @@
 #
 
 from StringIO import StringIO
+from threading import Thread, Event
+from time import sleep
 from json import loads, dumps
 from nose.tools import raises
+from os.path import split
+from dreqPy.dreq import defaultDreqPath
 from djq.toplevel import process_stream, process_request
-from djq.low import ExternalException
+from djq.toplevel import DQCache, dq_info, DREQLoadFailure
+from djq.toplevel import ensure_dq, invalidate_dq_cache, dq_cache
+from djq.toplevel import session_memos
+from djq.toplevel import derivations, request_window
+from djq.low import ExternalException, fluids
 
 # These should result in a catastrophe and perhaps raise an exception
 # if debugging
@@ -77,6 +85,22 @@ def stream_test_bad_request():
     for r in loads(out.getvalue()):
         yield (check_bad_reply, r)
 
+def stream_test_bad_request_lines():
+    out = StringIO()
+    process_stream(StringIO(dumps(bad_request)), out, json_lines=True)
+    replies = tuple(loads(line) for line in out.getvalue().splitlines())
+    assert len(replies) == len(bad_request)
+    assert all(r['reply-status'] == "bad-request" for r in replies)
+
+def stream_test_late_catastrophe():
+    # a catastrophe after some replies ends the array
+    out = StringIO()
+    with fluids((request_window, 1)):
+        process_stream(StringIO(dumps(bad_request)[:-1] + ", 1]"), out)
+    replies = loads(out.getvalue())
+    assert len(replies) == len(bad_request) + 1
+    assert 'catastrophe' in replies[-1]
+
 def object_test_bad_request():
     def check_bad_reply(reply):
         assert (isinstance(reply, dict)
@@ -112,3 +136,210 @@ def object_test_error_request():
                 and reply['reply-status'] == "error")
     for r in process_request(error_request):
         yield (check_error_reply, r)
+
+# Tests of the DREQ cache, using fake DREQs
+#
+
+class FakeInx(object):
+    def __init__(self, n):
+        self.uid = {i: FakeItem() for i in range(n)}
+        self.iref_by_sect = {}
+
+class FakeItem(object):
+    pass
+
+class FakeDQ(object):
+    def __init__(self, n=10):
+        self.inx = FakeInx(n)
+
+def test_dq_cache_lru():
+    cache = DQCache(max_entries=2)
+    (a, b, c) = (FakeDQ(), FakeDQ(), FakeDQ())
+    cache.put('a', a, "a")
+    cache.put('b', b, "b")
+    assert cache.get('a') is a     # a is now most recent
+    cache.put('c', c, "c")         # so b goes
+    assert cache.get('b') is None
+    assert cache.get('a') is a and cache.get('c') is c
+    stats = cache.stats()
+    assert stats['entries'] == 2 and stats['evictions'] == 1
+    assert stats['hits'] == 3 and stats['misses'] == 1
+    # b was evicted but is still referenced
+    assert cache.info.get(b) == "b"
+
+def test_dq_cache_note_miss():
+    cache = DQCache()
+    a = FakeDQ()
+    cache.put('a', a, "a")
+    assert cache.get('b', note_miss=False) is None
+    assert cache.get('a', note_miss=False) is a
+    stats = cache.stats()
+    assert stats['hits'] == 1 and stats['misses'] == 0
+
+def test_dq_cache_bytes():
+    (small, big) = (FakeDQ(10), FakeDQ(1000))
+    cache = DQCache()
+    cache.put('small', small, None)
+    assert cache.stats()['bytes'] == 0 # not computed yet
+    cache.configure(max_bytes=0)
+    size = cache.stats()['bytes']
+    assert size > 0
+    cache.configure(max_bytes=size)
+    cache.put('big', big, None)
+    # the big one is never evicted as it's the newest
+    assert cache.get('small') is None and cache.get('big') is big
+    cache.clear()
+    assert cache.stats()['entries'] == 0 and cache.stats()['bytes'] == 0
+
+def test_dq_cache_session_memos():
+    cache = DQCache(max_entries=1)
+    (a, b) = (FakeDQ(), FakeDQ())
+    assert cache.session_memos(a) is None
+    cache.put('a', a, "a")
+    memos = cache.session_memos(a)
+    assert memos is not None and cache.session_memos(a) is memos
+    assert cache.memo_stats() == {'a': memos.stats()}
+    cache.put('b', b, "b")      # evicts a, and its memos
+    assert cache.session_memos(a) is None
+    assert cache.session_memos(b) is not memos
+    cache.clear()
+    assert len(cache.memos) == 0
+
+def without_metadata(replies):
+    return tuple({k: v for (k, v) in r.iteritems() if k != 'reply-metadata'}
+                 for r in replies)
+
+def test_session_memos():
+    import djq.variables.cv_default as cv_default
+    import djq.variables.jsonify_simple as jsonify_simple
+    path = split(defaultDreqPath)[0]
+    name = "djq.variables.jsonify_simple.jsonify_cmvid"
+    request = ({'mip': "CMIP", 'experiment': "historical"},)
+    try:
+        with fluids((session_memos, True)):
+            first = process_request(request, dqpath=path,
+                                    cvimpl=cv_default, jsimpl=jsonify_simple)
+            memos = dq_cache.session_memos(ensure_dq(dqpath=path))
+            before = memos.stats()[name]
+            second = process_request(request, dqpath=path,
+                                     cvimpl=cv_default, jsimpl=jsonify_simple)
+            after = memos.stats()[name]
+            assert memos.stats() in dq_cache.memo_stats().values()
+        assert first[0]['reply-status'] == "ok"
+        assert without_metadata(first) == without_metadata(second)
+        assert after['misses'] == before['misses']
+        assert after['hits'] > before['hits']
+    finally:
+        invalidate_dq_cache()
+
+def test_json_fragments():
+    import djq.variables.cv_default as cv_default
+    import djq.variables.jsonify_simple as jsonify_simple
+    from djq.variables import json_fragments
+    path = split(defaultDreqPath)[0]
+    request = ({'mip': "CMIP", 'experiment': "historical"},)
+    plain = process_request(request, dqpath=path,
+                            cvimpl=cv_default, jsimpl=jsonify_simple)
+    with fluids((json_fragments, True)):
+        encoded = process_request(request, dqpath=path,
+                                  cvimpl=cv_default, jsimpl=jsonify_simple)
+    assert encoded[0]['reply-status'] == "ok"
+    assert without_metadata(plain) == without_metadata(encoded)
+    assert not any(hasattr(v, 'json_fragment')
+                   for v in plain[0]['reply-variables'])
+    for v in encoded[0]['reply-variables']:
+        assert v.json_fragment == dumps(v, separators=(',', ':'))
+
+def test_validated_once():
+    import djq.toplevel as toplevel
+    path = split(defaultDreqPath)[0]
+    request = ({'mip': "CMIP", 'experiment': "historical"},
+               {'mip': "CMIP", 'experiment': "historical"},
+               {'mip': 1, 'experiment': "bad"})
+    validate = toplevel.validate_single_request
+    calls = []
+    def counting(r):
+        calls.append(r)
+        return validate(r)
+    try:
+        toplevel.validate_single_request = counting
+        replies = process_request(request, dqpath=path)
+    finally:
+        toplevel.validate_single_request = validate
+    assert [r['reply-status'] for r in replies] == ["ok", "ok", "bad-request"]
+    assert len(calls) == len(request)
+
+def test_dq_info_unknown():
+    assert dq_info(FakeDQ()) is None
+    assert dq_info(1) is None
+
+def run_loads(cache, loader, n=5):
+    # Run n threads all asking cache for the same key, with loader
+    # blocked until they have all asked.  Return a list of what
+    # each thread got.
+    results = [None] * n
+    go = Event()
+    def blocked_loader():
+        go.wait()
+        return loader()
+    def load(i):
+        try:
+            results[i] = cache.load('k', blocked_loader, "k")
+        except BaseException as e:
+            results[i] = e
+    threads = [Thread(target=load, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    while cache.stats()['waits'] < n - 1:
+        sleep(0.01)
+    go.set()
+    for t in threads:
+        t.join()
+    return results
+
+def test_single_flight():
+    calls = []
+    def loader():
+        calls.append(1)
+        return FakeDQ()
+    cache = DQCache()
+    results = run_loads(cache, loader)
+    assert len(calls) == 1
+    assert all(r is results[0] for r in results)
+    assert cache.get('k') is results[0]
+
+def test_single_flight_failure():
+    calls = []
+    def loader():
+        calls.append(1)
+        raise DREQLoadFailure(dqpath="/nowhere")
+    cache = DQCache()
+    results = run_loads(cache, loader)
+    assert len(calls) == 1
+    assert all(isinstance(r, DREQLoadFailure) for r in results)
+    assert cache.get('k') is None and len(cache.flights) == 0
+
+def test_single_flight_interrupted():
+    # something which is not an Exception still reaches the waiters
+    class Interrupted(BaseException):
+        pass
+    def loader():
+        raise Interrupted()
+    cache = DQCache()
+    results = run_loads(cache, loader)
+    assert all(isinstance(r, Interrupted) for r in results)
+    assert cache.get('k') is None and len(cache.flights) == 0
+
+# Planning
+#
+
+def test_derivations():
+    (a, b, c) = (frozenset(("a",)), frozenset(("b",)), frozenset(("c",)))
+    groups = (("dq", "M", a | b), ("dq", "M", a), ("dq", "M", b),
+              ("dq", "M", frozenset()),
+              ("dq", "N", a | b | c), ("dq", "N", a), ("dq", "N", b),
+              ("other", "M", a | b), ("other", "M", a))
+    derived = derivations(groups)
+    assert set(derived.keys()) == set((("dq", "M", a | b),))
+    assert set(derived[("dq", "M", a | b)]) == set((("dq", "M", a),
+                                                    ("dq", "M", b)))
@@ -6,25 +6,50 @@
 """
 
 __all__ = ('ensure_dq', 'invalidate_dq_cache', 'dq_info',
+           'configure_dq_cache', 'dq_cache_stats', 'preload_processes',
+           'session_memos',
+           'request_window',
            'process_stream', 'process_request')
 
-from collections import defaultdict
+from os import getenv, walk
+from os.path import join, exists
+from sys import getsizeof, version_info
+from types import ModuleType
+from inspect import getmodule
+from hashlib import md5, sha1
+from json import dumps
+from collections import OrderedDict, defaultdict
+from weakref import WeakKeyDictionary
+from threading import RLock, Event
+from multiprocessing import Pool
+from dreqPy.dreq import version as dreqPy_version
 from low import DJQException, InternalException, ExternalException, Scram
 from low import mutter, debug, verbosity_level, debug_level
-from low import memos, Memos
+from low import memos, Memos, memo_stats
 from low import feature_bundle, FeatureBundle
-from low import fluids
-from emit import emit_reply, emit_catastrophe
-from parse import (read_request, validate_toplevel_request,
+from low import fluid, globalize, fluids
+from low import stringlike
+from low import checks_minpri, checks_enabled, check_stats
+from low import checks_fraction, checks_first
+from emit import ReplyStream
+from parse import (read_request_stream, validate_toplevel_request,
                    validate_single_request)
 from load import (default_dqroot, valid_dqroot,
                   default_dqtag, valid_dqtag,
-                  default_dqpath,
-                  effective_dqpath, dqload)
+                  default_dqpath, selective_loading,
+                  effective_dqpath, quiet_dqpath, dreq_files, dqload)
 from variables import (compute_variables, jsonify_variables,
                        cv_implementation, validate_cv_implementation,
                        jsonify_implementation, validate_jsonify_implementation,
+                       cv_dreq_sections, jsonify_dreq_sections,
+                       json_fragments,
+                       cv_compositional, compute_exids_batch,
+                       resolve_experiment, cmvids_batch,
                        NoMIP, NoExperiment, WrongExperiment)
+from snapshot import snapshot_directory, snapshot_of_dreq, dreq_of_snapshot
+from reply_cache import (reply_cache_directory, reply_cached,
+                         read_cached_reply, write_cached_reply,
+                         trim_reply_cache)
 from metadata import reply_metadata, note_reply_metadata
 from . import __path__ as djq_path
 
@@ -33,7 +58,8 @@ def process_stream(input, output, backtrace=False,
                    dq=None,
                    dbg=None, verbosity=None,
                    cvimpl=None, jsimpl=None,
-                   fbundle=None):
+                   fbundle=None, json_lines=False,
+                   compact=False):
     """Process a request stream, emitting results on a reply stream.
 
     This reads a request from input, and from this generates a reply
@@ -41,6 +67,19 @@ def process_stream(input, output, backtrace=False,
     detailed checking of ceach single-request takes place further down
     the stack.
 
+    The request may be a JSON array or JSON Lines, and is read
+    incrementally: the single-requests are processed in windows of
+    request_window() of them as they are read, so work starts before
+    all of it has been read.  The single-requests, and the variables
+    batched for them, are held only for the window they are in; the
+    reply cache and the memo tables persist across windows, and grow
+    unless they are bounded: see trim_reply_cache and memo_entries.
+    The reply is written in the same way, each single-reply as soon as
+    it is ready, as a JSON array or, if json_lines is true, as JSON
+    Lines: see djq.emit.  If compact is true the reply is written
+    without indentation.  Compact replies and JSON Lines are written
+    using pre-encoded variables: see json_fragments.
+
     This function is the custodian of exceptions: it has handlers for
     anything which should happen and emits suitable replies in that
     case.  If backtrace is true it also reraises the exception so a
@@ -54,7 +93,8 @@ def process_stream(input, output, backtrace=False,
 
     You can explicitly pass a dreq as the dq argument, in which case
     it it used, rather than whatever dqroot and dqtag would cause to
-    be loaded.
+    be loaded.  Otherwise the DREQs the request needs may be loaded in
+    parallel before anything else happens: see preload_dqs.
 
     There's no useful return value.
 
@@ -88,33 +128,49 @@ def process_stream(input, output, backtrace=False,
                  (validate_jsonify_implementation(jsimpl)
                   if jsimpl is not None
                   else jsonify_implementation())),
+                (json_fragments, (json_fragments()
+                                  or compact or json_lines)),
                 (reply_metadata, dict()),
-                (memos, Memos()),
+                (memos, Memos(max_entries=memo_entries)),
                 (feature_bundle, FeatureBundle(source=fbundle))):
+        replies = ReplyStream(output, json_lines=json_lines,
+                              compact=compact)
         try:
-            emit_reply(tuple(process_single_request(s, dq=dq)
-                             for s in read_request(input)),
-                       output)
+            for window in windows(read_request_stream(input),
+                                  request_window()):
+                # Each window gets its own batch table, so the batched
+                # results for one window are dropped with it
+                with fluids((cmvids_batch, dict())):
+                    checked = check_single_requests(window)
+                    if dq is None:
+                        preload_dqs(window, checked=checked)
+                    batch_single_requests(window, dq=dq, checked=checked)
+                    for reply in process_single_requests(window, dq=dq,
+                                                         checked=checked):
+                        replies.emit(reply)
+                trim_reply_cache()
+            replies.close()
+            report_stats()
         except Scram as e:
             raise
         except ExternalException as e:
-            emit_catastrophe("{}".format(e), output,
-                             note="external error")
+            replies.catastrophe("{}".format(e),
+                                note="external error")
             if backtrace:
                 raise
         except InternalException as e:
-            emit_catastrophe("{}".format(e), output,
-                             note="internal error")
+            replies.catastrophe("{}".format(e),
+                                note="internal error")
             if backtrace:
                 raise
         except DJQException as e:
-            emit_catastrophe("{}".format(e), output,
-                             note="unexpected error")
+            replies.catastrophe("{}".format(e),
+                                note="unexpected error")
             if backtrace:
                 raise
         except Exception as e:
-            emit_catastrophe("{}".format(e), output,
-                             note="completely unexpected error")
+            replies.catastrophe("{}".format(e),
+                                note="completely unexpected error")
             if backtrace:
                 raise
 
@@ -138,7 +194,8 @@ def process_request(request, dqroot=None, dqtag=None, dqpath=None,
       variables.
 
     - if dq is given then it should be the dreq to use, and in this
-      case dqroot and dqtag are ignored.
+      case dqroot and dqtag are ignored.  Otherwise the DREQs the
+      request needs may be loaded in parallel first: see preload_dqs.
 
     This returns a tuple of the results for each single-request in the
     request argument.
@@ -173,10 +230,66 @@ def process_request(request, dqroot=None, dqtag=None, dqpath=None,
                   if jsimpl is not None
                   else jsonify_implementation())),
                 (reply_metadata, dict()),
-                (memos, Memos()),
+                (memos, Memos(max_entries=memo_entries)),
+                (cmvids_batch, dict()),
                 (feature_bundle, FeatureBundle(source=fbundle))):
-        return tuple(process_single_request(s, dq=dq)
-                     for s in validate_toplevel_request(request))
+        request = validate_toplevel_request(request)
+        checked = check_single_requests(request)
+        if dq is None:
+            preload_dqs(request, checked=checked)
+        batch_single_requests(request, dq=dq, checked=checked)
+        replies = tuple(process_single_requests(request, dq=dq,
+                                                checked=checked))
+        trim_reply_cache()
+        report_stats()
+        return replies
+
+def report_stats():
+    # Report what memoization did for a request, and what checks have
+    # cost so far, if debugging.  With session memos most of the
+    # memoization is in the memos of the cached DREQs, which are
+    # reported as well, and are cumulative since each was cached.
+    if not debug_level():
+        return
+    def report_memos(stats, where=""):
+        for (name, s) in sorted(stats.iteritems()):
+            debug("memo {}{}: {} hits, {} misses, {} evictions,"
+                  " {} entries, {:.3f}s",
+                  name, where, s['hits'], s['misses'], s['evictions'],
+                  s['entries'], s['seconds'])
+    stats = memo_stats()
+    if stats is not None:
+        report_memos(stats)
+    if session_memos():
+        for (key, stats) in sorted(dq_cache.memo_stats().iteritems()):
+            report_memos(stats, " for {}".format(key))
+    for ((path, pri, name), s) in sorted(check_stats().iteritems()):
+        debug("check {}/{}/{}: {} calls, {} failures, {} skipped, {:.3f}s",
+              path, pri, name, s['calls'], s['failures'], s['skipped'],
+              s['seconds'])
+
+# Reading requests in windows.  process_stream reads its request
+# incrementally, and deals with it request_window single-requests at
+# a time: all the preloading, planning and processing for one window
+# is done before the next is read.  Larger windows give planning more
+# to work with, smaller ones mean work starts sooner and less of the
+# request is held at once.  None means the whole request is one
+# window.
+#
+
+request_window = globalize(fluid(), 1000, threaded=True)
+
+def windows(iterable, size):
+    # Yield successive tuples of at most size elements of iterable
+    # (all of it if size is None)
+    window = []
+    for e in iterable:
+        window.append(e)
+        if size is not None and len(window) >= size:
+            yield tuple(window)
+            window = []
+    if len(window) > 0:
+        yield tuple(window)
 
 class DREQLoadFailure(DJQException):
     """Failure to load the DREQ: it is indeterminate whose fault this is."""
@@ -194,39 +307,274 @@ class DREQLoadFailure(DJQException):
                                                   dqtag=self.dqtag,
                                                   dqpath=self.dqpath)))
 
-# Caching loaded DREQs.  There are two caches: a cache by root & tag,
-# and a separate cache for dreqs specified by path.
+# Caching loaded DREQs.  There is a single cache object, dq_cache,
+# which maps keys to loaded DREQs, where a key is either ('root-tag',
+# root, tag) for DREQs loaded by root & tag, or ('path', path) for
+# DREQs loaded by path.  Since roots are thread-local, including the
+# root in the key means identical tags for different roots will not be
+# treated as the same.
 #
-# The root & tag cache. The cache has two levels, indexed on root and
-# then tag: since roots are thread-local this means there won't be
-# false positives: identical tags for different roots will not be
-# treated as the same.  This depends on dicts being low-level
-# thread-safe: x[y] = z should never yield junk in x.  The FAQ
-# (https://docs.python.org/2/faq/library.html#what-kinds-of-global-value-mutation-are-thread-safe)
-# says that this is true.  Given that, this might end up overwriting
-# the same cache entry due to an obvious race, but assuming the DREQ
-# files don't change this is just extra work, and won't result in
-# anything bad.
+# The cache can be bounded, either by the number of DREQs it holds, or
+# by an approximate size in bytes, or both: when either bound is
+# exceeded the least-recently-used DREQs are evicted until it is not
+# (except that the most recent DREQ is never evicted, even if it is on
+# its own bigger than the byte budget).  By default it is unbounded,
+# but the DJQ_DQCACHE_ENTRIES and DJQ_DQCACHE_BYTES environment
+# variables set the bounds, and configure_dq_cache changes them.
 #
-# The path cache.  This is just a dictionary, indexed on path.
+# The size of a DREQ is estimated by adding up sys.getsizeof of its
+# items, their dicts and their attribute values, and of its
+# cross-reference index.  This undercounts, but it is roughly
+# proportional to the real size, which is what matters.  Estimating
+# the size is not free, so it is only done when there is a byte
+# budget.
 #
-# There's a potential problem if a huge number of requests come in for
-# different tags or paths: I don't think this is likely in practice.  A fix
-# would be to use weak references.
+# Information about where each DREQ came from is kept in a weak
+# dictionary indexed by the DREQ, so dq_info keeps working for DREQs
+# which have been evicted but are still referenced.
 #
+# The cache also holds session memos for the DREQs in it.  Normally
+# each request binds its own memos (see djq.low.memoize), so nothing
+# memoized is reused by later requests.  If session_memos is true
+# then the memoized functions used to compute and jsonify the
+# variables for a single-request instead use memos belonging to its
+# DREQ, which last as long as the DREQ is in the cache: they are
+# discarded when it is evicted or replaced, or the cache is
+# invalidated.  Session memos are bounded by DJQ_MEMO_ENTRIES just as
+# per-request ones are.
+#
+# The cache has a lock, so its structure is safe in a threaded
+# environment.  The lock is not held while loading, but loading is
+# single-flight: the first thread to miss on a key starts a 'flight'
+# for it and loads the DREQ, while any other thread asking for the
+# same key while the flight is in progress waits for it and gets the
+# same DREQ, or the same exception if the load fails.  So a DREQ is
+# only loaded once however many threads want it at the same time.
+# Reply metadata about the load is only recorded for the thread that
+# did it.
+#
+
+class Flight(object):
+    # An in-progress load
+    def __init__(self):
+        self.done = Event()
+        self.dq = None
+        self.failure = None
+
+class DQCache(object):
+    """A bounded LRU cache of loaded DREQs.
+
+    max_entries and max_bytes are bounds on the number and
+    approximate total size of the cached DREQs: None means unbounded.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.entries = OrderedDict() # key -> (dq, size), oldest first
+        self.info = WeakKeyDictionary() # dq -> info
+        self.memos = {}                 # key -> session Memos
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.waits = 0
+        self.flights = {}       # key -> Flight
+        self.lock = RLock()
+        self.configure(max_entries=max_entries, max_bytes=max_bytes)
+
+    def configure(self, max_entries=None, max_bytes=None):
+        with self.lock:
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            if max_bytes is not None:
+                # sizes are only computed when there is a byte budget
+                for (key, (dq, size)) in self.entries.items():
+                    if size is None:
+                        size = approximate_dq_size(dq)
+                        self.entries[key] = (dq, size)
+                        self.bytes += size
+            self.evict()
+
+    def get(self, key, note_miss=True):
+        # Return the dq for key, or None, noting the hit, or the miss
+        # if note_miss is true.  This never starts a load.
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                entry = self.entries.pop(key)
+                self.entries[key] = entry
+                return entry[0]
+            else:
+                if note_miss:
+                    self.misses += 1
+                return None
+
+    def cached(self, key):
+        # Is there a dq for key?  This does not count as a hit or miss
+        with self.lock:
+            return key in self.entries
+
+    def load(self, key, loader, info, force=False):
+        # Return the dq for key, calling loader to load it if need be
+        # (or always if force is true).  Only one thread loads any key
+        # at once: see above.  Any exception from loader, even one
+        # which is not an Exception, is propagated to all the threads
+        # waiting for it.
+        with self.lock:
+            dq = self.get(key) if not force else None
+            if dq is not None:
+                return dq
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = self.flights[key] = Flight()
+                leader = True
+            else:
+                self.waits += 1
+                leader = False
+        if leader:
+            try:
+                flight.dq = self.put(key, loader(), info)
+            except BaseException as e:
+                flight.failure = e
+                raise
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                flight.done.set()
+            return flight.dq
+        else:
+            debug("waiting for in-flight load of {}", key)
+            flight.done.wait()
+            if flight.failure is not None:
+                raise flight.failure
+            return flight.dq
+
+    def put(self, key, dq, info):
+        # Cache dq under key, remembering info for it
+        size = approximate_dq_size(dq) if self.max_bytes is not None else None
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1] or 0
+                self.memos.pop(key, None)
+            self.entries[key] = (dq, size)
+            self.bytes += size or 0
+            self.info[dq] = info
+            self.evict()
+        return dq
+
+    def evict(self):
+        # Evict entries until within bounds.  Call with the lock held.
+        while (len(self.entries) > 1
+               and ((self.max_entries is not None
+                     and len(self.entries) > self.max_entries)
+                    or (self.max_bytes is not None
+                        and self.bytes > self.max_bytes))):
+            (key, (dq, size)) = self.entries.popitem(last=False)
+            self.memos.pop(key, None)
+            self.bytes -= size or 0
+            self.evictions += 1
+            debug("evicted {} ({} bytes)", key, size)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.info.clear()
+            self.memos.clear()
+            self.bytes = 0
+
+    def session_memos(self, dq):
+        # The session memos for dq, or None if it is not cached
+        with self.lock:
+            for (key, (cdq, size)) in self.entries.iteritems():
+                if cdq is dq:
+                    if key not in self.memos:
+                        self.memos[key] = Memos(max_entries=memo_entries)
+                    return self.memos[key]
+            return None
 
+    def memo_stats(self):
+        # A dict mapping the key of each dq with session memos to
+        # their statistics (see Memos.stats)
+        with self.lock:
+            smemos = self.memos.items()
+        return {key: m.stats() for (key, m) in smemos}
 
-dqrs = defaultdict(dict)        # root & tag cache
-dqps = {}                       # path cache
-dqinfo = {}                     # info, indexed by dq
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'bytes': self.bytes,
+                    'max-entries': self.max_entries,
+                    'max-bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'waits': self.waits}
+
+def approximate_dq_size(dq):
+    """Return the approximate size of dq in bytes.
+
+    This is very approximate: see above.
+    """
+    size = getsizeof(dq.inx.uid)
+    for item in dq.inx.uid.itervalues():
+        size += getsizeof(item) + getsizeof(item.__dict__)
+        for v in item.__dict__.itervalues():
+            size += getsizeof(v)
+    for iref in dq.inx.iref_by_sect.itervalues():
+        for refs in iref.a.itervalues():
+            size += getsizeof(refs)
+    return size
+
+def getenv_int(name):
+    # an integer from the environment, or None
+    value = getenv(name)
+    return int(value) if value else None
+
+# The bound on the number of memoized results for a request or a
+# session (see djq.low.memoize): by default unbounded
+memo_entries = getenv_int("DJQ_MEMO_ENTRIES")
+
+# Whether to use session memos: see above
+session_memos = globalize(fluid(), bool(getenv("DJQ_SESSION_MEMOS")),
+                          threaded=True)
+
+dq_cache = DQCache(max_entries=getenv_int("DJQ_DQCACHE_ENTRIES"),
+                   max_bytes=getenv_int("DJQ_DQCACHE_BYTES"))
+
+def configure_dq_cache(max_entries=None, max_bytes=None):
+    """Set the bounds on the cache of loaded DREQs.
+
+    max_entries is the maximum number of DREQs to keep, max_bytes the
+    approximate maximum total size.  None means no bound.  If the
+    cache is now too big DREQs are evicted immediately.
+    """
+    dq_cache.configure(max_entries=max_entries, max_bytes=max_bytes)
+
+def dq_cache_stats():
+    """Return a dict of statistics about the cache of loaded DREQs.
+
+    The keys are 'entries', 'bytes' (the approximate total size, which
+    is only known if there is a byte budget), 'max-entries',
+    'max-bytes', and counts of 'hits', 'misses', 'evictions' and
+    'waits' (times a thread waited for another thread's load) since
+    the process started.
+    """
+    return dq_cache.stats()
 
 def invalidate_dq_cache():
-    """Invalidate the cache of loaded DREQs."""
-    dqrs.clear()
-    dqps.clear()
-    dqinfo.clear()
+    """Invalidate the cache of loaded DREQs, and their session memos."""
+    dq_cache.clear()
 
-def ensure_dq(dqtag=None, dqroot=None, dqpath=None, force=False):
+def dq_memos(dq):
+    # The memos to use for dq: its session memos if they are on and
+    # it is cached, otherwise the request's
+    if session_memos():
+        smemos = dq_cache.session_memos(dq)
+        if smemos is not None:
+            return smemos
+    return memos()
+
+def ensure_dq(dqtag=None, dqroot=None, dqpath=None, force=False,
+              sections=None):
     """Ensure the dreq corresponding to a dqtag is loaded, returning it.
 
     Arguments:
@@ -235,9 +583,17 @@ def ensure_dq(dqtag=None, dqroot=None, dqpath=None, force=False):
     - dqpath is the path, defaulted from default_dqpath();
     - force, if true, will bypass the cache and force the dreq to be
       loaded, and the loaded copy to be cached.
+    - sections, if given, is an iterable of the names of the sections
+      needed, and the result may be a view of the dreq with only
+      those sections (see djq.snapshot).  Views are cached separately
+      for each set of sections, but a complete dreq which is already
+      cached is returned in preference.
 
     Multiple requests for the same dqtag will return the same instance
-    of the dreq, unless force is true.
+    of the dreq, unless force is true or it has been evicted from the
+    cache.  If several threads ask for the same dreq at once it is
+    only loaded once, and if loading fails they all get the same
+    DREQLoadFailure.
 
     """
     if dqroot is None:
@@ -247,17 +603,22 @@ def ensure_dq(dqtag=None, dqroot=None, dqpath=None, force=False):
     if dqpath is None:
         dqpath = default_dqpath()
 
+    if sections is not None and snapshot_directory() is not None:
+        sections = frozenset(sections)
+    else:
+        # only snapshots can be read selectively
+        sections = None
+
     if dqpath is None:
         # The normal case: load by root & tag
-        dqs = dqrs[dqroot]
-        if force or (dqtag not in dqs):
+        key = ('root-tag', dqroot, dqtag)
+        def load():
             debug("missed {} for {}, loading dreq", dqtag, dqroot)
             if dqtag is not None:
                 if valid_dqtag(dqtag):
                     try:
-                        dq = dqload(dqroot=dqroot, dqtag=dqtag)
-                        dqs[dqtag] = dq
-                        dqinfo[dq] = (dqroot, dqtag)
+                        return dqload(dqroot=dqroot, dqtag=dqtag,
+                                      sections=sections)
                     except Exception as e:
                         raise DREQLoadFailure(wrapped=e, dqroot=dqroot,
                                               dqtag=dqtag)
@@ -267,23 +628,370 @@ def ensure_dq(dqtag=None, dqroot=None, dqpath=None, force=False):
             else:
                 # dqtag is None
                 try:
-                    dq = dqload(dqroot=dqroot)
-                    dqs[None] = dq
-                    dqinfo[dq] = (dqroot, None)
+                    return dqload(dqroot=dqroot, sections=sections)
                 except Exception as e:
                     raise DREQLoadFailure(wrapped=e, dqroot=dqroot)
-        return dqs[dqtag]
+        info = (dqroot, dqtag)
     else:
         # dqpath is given, load directly
-        if force or (dqpath not in dqps):
+        key = ('path', dqpath)
+        def load():
             debug("missed path {}, loading dreq", dqpath)
             try:
-                dq = dqload(dqpath=dqpath)
-                dqps[dqpath] = dq
-                dqinfo[dq] = dqpath
+                return dqload(dqpath=dqpath, sections=sections)
             except Exception as e:
                 raise DREQLoadFailure(wrapped=e, dqpath=dqpath)
-        return dqps[dqpath]
+        info = dqpath
+    if sections is not None:
+        # A complete one is returned in preference.  Look it up in one
+        # go: if it were checked for and then fetched it could be
+        # evicted in between, and load, which only reads sections,
+        # would cache a view under the complete one's key.  Not
+        # finding it is not a miss, as the view may still be cached.
+        dq = dq_cache.get(key, note_miss=False) if not force else None
+        if dq is not None:
+            return dq
+        key = key + (sections,)
+    return dq_cache.load(key, load, info, force=force)
+
+# Preloading DREQs in parallel.  A request may name several tags, and
+# loading each one is expensive and involves no shared state, so
+# before computing anything process_stream and process_request scan
+# the request for the tags it needs which are not already cached, and
+# if there is more than one load them concurrently in a pool of
+# processes.  Loaded DREQs can't be pickled, so each worker sends
+# back a snapshot (see djq.snapshot) which is turned back into a DREQ
+# and put into the cache, after which the single-requests find them
+# there as normal.  Any tag which fails to load in a worker is simply
+# left out: it will be loaded (and fail) again, in the normal way,
+# when its single-requests are processed, so errors are reported
+# exactly as they would be without preloading.
+#
+# This only happens when loading by root & tag (if there's a path
+# everything uses the same DREQ anyway), and only when there is a
+# snapshot directory, since otherwise the cache would end up holding
+# snapshots where it would normally hold real DREQs.  It is off by
+# default: preload_processes is the largest number of processes to
+# use (by default DJQ_PRELOAD_PROCESSES, or 0), and if it is less than
+# 2 there is no preloading.  The server never preloads, since forking
+# from a threaded process is not safe.
+#
+
+preload_processes = globalize(fluid(),
+                              getenv_int("DJQ_PRELOAD_PROCESSES") or 0,
+                              threaded=True)
+
+def preload_snapshot(args):
+    # Run in a worker: load a tag and return a snapshot of it, or
+    # None if it fails.  Fluids are passed explicitly as they may not
+    # survive into the worker.
+    (dqroot, dqtag, directory) = args
+    try:
+        with fluids((snapshot_directory, directory),
+                    (reply_metadata, dict())):
+            return snapshot_of_dreq(dqload(dqroot=dqroot, dqtag=dqtag))
+    except Exception:
+        return None
+
+def preload_dqs(request, checked=None):
+    """Load, in parallel, the DREQs needed by the single-requests in request.
+
+    request should be a toplevel request, but single-requests in it
+    which are not valid are ignored.  checked, if given, is what
+    check_single_requests returned for it.  Return a tuple of the
+    tags loaded, which is empty if there was nothing worth doing in
+    parallel.  See above for details.
+    """
+    processes = preload_processes()
+    if (processes < 2 or default_dqpath() is not None
+        or snapshot_directory() is None):
+        return ()
+    dqroot = default_dqroot()
+    tags = set()
+    for rc in (checked if checked is not None
+               else check_single_requests(request)):
+        if not isinstance(rc, ExternalException):
+            tags.add(rc['dreq'] if 'dreq' in rc else default_dqtag())
+    wanted = tuple(tag for tag in tags
+                   if (tag is not None
+                       and not dq_cache.cached(('root-tag', dqroot, tag))
+                       and valid_dqtag(tag, dqroot)))
+    if len(wanted) < 2:
+        return ()
+    mutter("preloading {} in {} processes",
+           wanted, min(processes, len(wanted)))
+    pool = Pool(min(processes, len(wanted)))
+    try:
+        # map_async & a timeout so the wait can be interrupted
+        snapshots = pool.map_async(preload_snapshot,
+                                   tuple((dqroot, tag, snapshot_directory())
+                                         for tag in wanted)).get(1 << 30)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    loaded = []
+    for (tag, snapshot) in zip(wanted, snapshots):
+        if snapshot is not None:
+            dq_cache.load(('root-tag', dqroot, tag),
+                          lambda: dreq_of_snapshot(snapshot),
+                          (dqroot, tag))
+            loaded.append(tag)
+        else:
+            mutter("[failed to preload {}]", tag)
+    return tuple(loaded)
+
+# Planning.  Before processing the single-requests in a request one
+# at a time, the toplevel plans the computation of the variables for
+# all of them.  Each single-request is resolved to its dreq, its MIP
+# and the set of experiment ids its experiment refers to, and
+# single-requests which resolve to the same (dq, mip, exids) group
+# are computed only once.  If the back end is compositional (see
+# djq.variables.compute), a group whose exids are the union of the
+# exids of other groups for the same dreq and MIP (which is what
+# happens for an experiment of true when all of a MIP's experiments
+# are also asked for individually) is just the union of their
+# variables, and is not computed at all.  The rest of the groups are
+# computed together, in batches if the back end can do that.
+#
+# The results go into the table bound to cmvids_batch under (dq, mip,
+# experiment) for each single-request, together with its exids, where
+# compute_variables finds them, and the single-requests are then
+# processed in their original order.  Single-requests which are not
+# valid, or whose dreq can't be loaded, or whose computation fails
+# are just left out and fail in the normal way later.
+#
+
+def plan_single_requests(request, dq=None, checked=None):
+    """Plan the computation of variables for the single-requests in request.
+
+    If dq is given it is the dreq for all of them, and checked, if
+    given, is what check_single_requests returned for request.
+    Return a dict mapping each group (dq, mip, exids) to a list of the
+    indices and experiments of the single-requests in it.
+    Single-requests whose results are already in the table bound to
+    cmvids_batch or in the reply cache are left out.
+    """
+    sections = needed_dreq_sections()
+    table = cmvids_batch()
+    plan = OrderedDict()
+    for (i, rc) in enumerate(checked if checked is not None
+                             else check_single_requests(request)):
+        if isinstance(rc, ExternalException):
+            continue
+        try:
+            rdq = (dq if dq is not None
+                   else ensure_dq(rc['dreq'] if 'dreq' in rc else None,
+                                  sections=sections))
+            if (table is not None
+                and (rdq, rc['mip'], rc['experiment']) in table):
+                continue
+            key = reply_key(rdq, rc)
+            if key is not None and reply_cached(key):
+                continue
+            exids = resolve_experiment(rdq, rc['mip'], rc['experiment'])
+        except DJQException:
+            continue
+        plan.setdefault((rdq, rc['mip'], exids),
+                        []).append((i, rc['experiment']))
+    return plan
+
+def derivations(groups):
+    # For an iterable of groups (dq, mip, exids) return a dict mapping
+    # groups which are unions of smaller groups for the same dq & mip
+    # to those groups.  Smaller groups come first, so they can be
+    # computed (or derived) in size order.
+    derived = OrderedDict()
+    seen = defaultdict(list)
+    for group in sorted(groups, key=lambda g: len(g[2])):
+        (gdq, mip, exids) = group
+        parts = tuple(g for g in seen[(gdq, mip)]
+                      if len(g[2]) > 0 and g[2] < exids)
+        if (len(parts) > 0
+            and frozenset().union(*(g[2] for g in parts)) == exids):
+            derived[group] = parts
+        seen[(gdq, mip)].append(group)
+    return derived
+
+def batch_single_requests(request, dq=None, checked=None):
+    """Compute the variables for the single-requests in request.
+
+    If dq is given it is the dreq for all of them, and checked, if
+    given, is what check_single_requests returned for request.
+    Results go into the table bound to cmvids_batch: see above.
+    Return a tuple of the number of groups computed and the number
+    derived, or None if cmvids_batch is not bound.
+    """
+    table = cmvids_batch()
+    if table is None:
+        return None
+    plan = plan_single_requests(request, dq=dq, checked=checked)
+    derived = derivations(plan.iterkeys()) if cv_compositional() else {}
+    bydq = OrderedDict()
+    for group in plan.iterkeys():
+        if group not in derived:
+            (gdq, mip, exids) = group
+            bydq.setdefault(gdq, []).append((mip, exids))
+    mutter("planned {} single-requests as {} groups, {} derived",
+           sum(len(members) for members in plan.itervalues()),
+           len(plan), len(derived))
+    results = {}
+    for (gdq, groups) in bydq.iteritems():
+        for ((mip, exids), cmvids) in compute_exids_batch(gdq,
+                                                          groups).iteritems():
+            results[(gdq, mip, exids)] = cmvids
+    for (group, parts) in derived.iteritems():
+        if all(part in results for part in parts):
+            results[group] = set().union(*(results[part] for part in parts))
+    for (group, members) in plan.iteritems():
+        if group in results:
+            (gdq, mip, exids) = group
+            for (i, experiment) in members:
+                table[(gdq, mip, experiment)] = (exids, results[group])
+    return (len(plan) - len(derived), len(derived))
+
+# Caching replies across runs.  If reply_cache_directory is not None
+# replies are kept in a persistent cache (see djq.reply_cache), keyed
+# on a fingerprint of everything they depend on:
+# - the contents of the DREQ's XML and configuration files, together
+#   with the Python and dreqPy versions;
+# - the name and a hash of the source of the cv and jsonify
+#   implementations, and a hash of djq's own source;
+# - the feature bundle, as canonical JSON;
+# - the MIP and experiment.
+# Anything whose fingerprint can't be made (a dq not loaded by
+# ensure_dq, an implementation with no source file) is not cached.
+# Only replies which are ok or not-found are cached: errors may be
+# transient.  The cached part of a reply is its status, detail and
+# variables: everything else comes from the single-request, and the
+# metadata is always made afresh.
+#
+# Hashes of source files are computed once per process, so they are
+# of the code which is running.  The hash of a DREQ is computed the
+# first time it is needed for that DREQ: if its files change between
+# it being loaded and then this will be wrong, but nothing else copes
+# with that either.
+#
+# Planning skips single-requests whose replies are cached, so nothing
+# is computed for them, but their DREQs are still loaded.
+#
+
+# This is incremented whenever what goes into a fingerprint changes
+reply_key_version = 1
+
+# The parts of a reply which are cached
+reply_cache_slots = ('reply-status', 'reply-status-detail', 'reply-variables')
+
+source_stamps = {}              # filename -> hash
+dq_stamps = WeakKeyDictionary() # dq -> hash
+
+def files_stamp(filenames):
+    # A hash of the contents of some files
+    h = md5()
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), ""):
+                h.update(chunk)
+    return h.hexdigest()
+
+def source_stamp(filename):
+    # A hash of the source of filename (the .py for a .pyc), memoized
+    if filename.endswith((".pyc", ".pyo")) and exists(filename[:-1]):
+        filename = filename[:-1]
+    if filename not in source_stamps:
+        source_stamps[filename] = files_stamp((filename,))
+    return source_stamps[filename]
+
+def djq_stamp():
+    # A hash of djq's source, excluding tests
+    top = djq_path[0]
+    if top not in source_stamps:
+        sources = []
+        for (directory, subdirs, files) in walk(top):
+            subdirs[:] = sorted(d for d in subdirs if d != "tests")
+            sources.extend(join(directory, f)
+                           for f in sorted(files) if f.endswith(".py"))
+        source_stamps[top] = files_stamp(sources)
+    return source_stamps[top]
+
+def implementation_stamp(impl):
+    # (name, source hash) for an implementation, or None
+    module = impl if isinstance(impl, ModuleType) else getmodule(impl)
+    if module is None or getattr(module, '__file__', None) is None:
+        return None
+    try:
+        return ((module.__name__
+                 if module is impl
+                 else "{}.{}".format(module.__name__,
+                                     getattr(impl, '__name__',
+                                             type(impl).__name__))),
+                source_stamp(module.__file__))
+    except (IOError, OSError):
+        return None
+
+def dq_stamp(dq):
+    # A hash of the files dq was loaded from, or None if unknown
+    info = dq_info(dq)
+    if info is None:
+        return None
+    if dq not in dq_stamps:
+        top = (quiet_dqpath(dqpath=info)
+               if stringlike(info)
+               else quiet_dqpath(dqroot=info[0], dqtag=info[1]))
+        try:
+            dq_stamps[dq] = files_stamp(dreq_files(top))
+        except (IOError, OSError):
+            return None
+    return dq_stamps[dq]
+
+def reply_key(dq, rc):
+    """Return the reply cache key for a valid single-request rc in dq.
+
+    Return None if there is no reply cache, or if the reply can't be
+    cached: see above.
+    """
+    if reply_cache_directory() is None:
+        return None
+    stamps = (dq_stamp(dq),
+              implementation_stamp(cv_implementation()),
+              implementation_stamp(jsonify_implementation()))
+    if None in stamps:
+        return None
+    return sha1(dumps(((reply_key_version, tuple(version_info[:2]),
+                        dreqPy_version, djq_stamp())
+                       + stamps
+                       + (feature_bundle(), rc['mip'], rc['experiment'])),
+                      sort_keys=True, default=repr)).hexdigest()
+
+# The fluids a server thread (see djq.server) needs bound as they are
+# where the server was started
+inherited_fluids = (debug_level, verbosity_level,
+                    default_dqroot, default_dqtag, default_dqpath,
+                    snapshot_directory, selective_loading,
+                    reply_cache_directory, session_memos,
+                    cv_implementation, jsonify_implementation,
+                    json_fragments,
+                    feature_bundle, memos, cmvids_batch,
+                    checks_minpri, checks_enabled,
+                    checks_fraction, checks_first)
+
+def inherited_bindings():
+    # A tuple of bindings of inherited_fluids to their current values,
+    # suitable for fluids
+    return tuple((f, f()) for f in inherited_fluids)
+
+def process_single_requests(request, dq=None, checked=None):
+    """Process the single-requests in request, yielding their replies.
+
+    This is a generator, which yields each reply, in order, as soon as
+    it is ready.  If dq is given it is the dreq for all of them, and
+    checked, if given, is what check_single_requests returned for
+    request.
+    """
+    if checked is None:
+        checked = check_single_requests(request)
+    for (s, rc) in zip(request, checked):
+        yield process_single_request(s, dq=dq, rc=rc)
 
 def dq_info(dq):
     """Return a tuple of (root, tag) for dq if it was loaded by root
@@ -292,60 +1000,80 @@ def dq_info(dq):
 
     The dq will be unknown if it wasn't loaded with ensure_dq, or if
     the cache has been invalidated between when it was loaded and the
-    call to this function.
+    call to this function.  A dq which has been evicted from the cache
+    but is still referenced is still known.
     """
-    return dqinfo[dq] if dq in dqinfo else None
+    try:
+        return dq_cache.info.get(dq)
+    except TypeError:
+        # not something we can refer to weakly, so not a dq
+        return None
+
+def needed_dreq_sections():
+    # The sections of the dreq needed by the current implementations,
+    # or None if they are all needed or selective loading is off
+    if not selective_loading():
+        return None
+    cvs = cv_dreq_sections()
+    jss = jsonify_dreq_sections()
+    return cvs | jss if cvs is not None and jss is not None else None
 
-def process_single_request(r, dq=None):
+def check_single_requests(request):
+    """Validate each of the single-requests in request, once.
+
+    Return a tuple with, for each single-request, either its validated
+    form or the ExternalException validating it raised.  This is what
+    the checked arguments to the functions which handle a request
+    want, so that each single-request is validated only once.
+    """
+    checked = []
+    for r in request:
+        try:
+            checked.append(validate_single_request(r))
+        except ExternalException as e:
+            checked.append(e)
+    return tuple(checked)
+
+def process_single_request(r, dq=None, rc=None):
     """Process a single request, returning a suitable result for JSONisation.
 
     This returns either the computed result, or a bad-request response
     if the request was bogus, or an error response if the dreq could
-    not be loaded.
+    not be loaded.  rc, if given, is what check_single_requests
+    returned for r, so it is not validated again.
     """
     # Outer try/except block catches obviously bad requests and dreq
     # load failures
     #
     try:
-        rc = validate_single_request(r)
+        if rc is None:
+            rc = validate_single_request(r)
+        elif isinstance(rc, ExternalException):
+            raise rc
         if dq is None:
+            sections = needed_dreq_sections()
             if 'dreq' in rc:
                 mutter("* single-request tag {}", rc['dreq'])
-                dq = ensure_dq(rc['dreq'])
+                dq = ensure_dq(rc['dreq'], sections=sections)
             else:
                 mutter("* single-request")
-                dq = ensure_dq(None)
+                dq = ensure_dq(None, sections=sections)
         note_reply_metadata(djq_path=djq_path)
         note_reply_metadata(dq_info=dq_info(dq))
         reply = dict(rc)
         reply['dreq'] = dq.version # this that the dreq has this slot
-        # inner block handles semantic errors with the request and has
-        # a fallback for other errors
-        try:
-            variables = jsonify_variables(dq,
-                                          compute_variables(dq, rc['mip'],
-                                                            rc['experiment']))
-            reply.update({'reply-status': "ok",
-                          'reply-variables': variables})
-        except NoMIP as e:
-            reply.update({'reply-variables': None,
-                          'reply-status': "not-found",
-                          'reply-status-detail': "no MIP {}".format(e.mip)})
-        except NoExperiment as e:
-            reply.update({'reply-variables': None,
-                          'reply-status': "not-found",
-                          'reply-status-detail':
-                          "no experiment {}".format(e.experiment)})
-        except WrongExperiment as e:
-            reply.update({'reply-variables': None,
-                          'reply-status': "not-found",
-                          'reply-status-detail':
-                          "experiment {} not in MIP {}" .format(e.experiment,
-                                                                e.mip)})
-        except (ExternalException, InternalException) as e:
-            reply.update({'reply-variables': None,
-                          'reply-status': "error",
-                          'reply-status-detail': "{}".format(e)})
+        key = reply_key(dq, rc)
+        cached = read_cached_reply(key) if key is not None else None
+        note_reply_metadata(reply_cached=cached is not None)
+        if cached is not None:
+            reply.update(cached)
+        else:
+            with fluids((memos, dq_memos(dq))):
+                reply.update(compute_single_reply(dq, rc))
+            if key is not None and reply['reply-status'] != "error":
+                write_cached_reply(key, {k: reply[k]
+                                         for k in reply_cache_slots
+                                         if k in reply})
         reply.update({'reply-metadata': reply_metadata()})
         return reply
     except DREQLoadFailure as e:
@@ -371,6 +1099,39 @@ def process_single_request(r, dq=None):
                 'reply-status-detail': "{}".format(e),
                 'reply-metadata': reply_metadata()}
 
+def compute_single_reply(dq, rc):
+    # Compute the reply for a valid single-request rc in dq, returning
+    # a dict of its status, detail and variables.  This handles
+    # semantic errors with the request and has a fallback for other
+    # errors.
+    reply = {}
+    try:
+        variables = jsonify_variables(dq,
+                                      compute_variables(dq, rc['mip'],
+                                                        rc['experiment']))
+        reply.update({'reply-status': "ok",
+                      'reply-variables': variables})
+    except NoMIP as e:
+        reply.update({'reply-variables': None,
+                      'reply-status': "not-found",
+                      'reply-status-detail': "no MIP {}".format(e.mip)})
+    except NoExperiment as e:
+        reply.update({'reply-variables': None,
+                      'reply-status': "not-found",
+                      'reply-status-detail':
+                      "no experiment {}".format(e.experiment)})
+    except WrongExperiment as e:
+        reply.update({'reply-variables': None,
+                      'reply-status': "not-found",
+                      'reply-status-detail':
+                      "experiment {} not in MIP {}" .format(e.experiment,
+                                                            e.mip)})
+    except (ExternalException, InternalException) as e:
+        reply.update({'reply-variables': None,
+                      'reply-status': "error",
+                      'reply-status-detail': "{}".format(e)})
+    return reply
+
 class BadRoot(ExternalException):
     def __init__(self, dqroot):
         self.dqroot = dqroot
@@ -19,18 +19,47 @@
 #  - a set of experiment ids belonging to that MIP
 # and should return an iterable of cmvids
 #
+# A back end module may also have a dreq_sections attribute, which is
+# an iterable of the names of the sections of the dreq it uses: if it
+# does the dreq may be a view containing only those sections (see
+# djq.snapshot and cv_dreq_sections).
+#
+# A back end module may also have a function named
+# compute_cmvids_for_all, which is called with:
+#  - the dreq
+#  - a dict mapping MIP names to sets of experiment ids, as would be
+#    passed to compute_cmvids_for_exids
+# and should return a dict mapping each of those MIPs to what
+# compute_cmvids_for_exids would return for it, ideally in a single
+# pass over the dreq.  compute_variables_batch uses this to compute
+# the variables for many (MIP, experiment) pairs at once: a batch may
+# need several calls if it has several experiments for the same MIP.
+# The results of a batch can be put into a table bound to the
+# cmvids_batch fluid, mapping (dq, mip, experiment) to (exids,
+# cmvids), where exids is what resolve_experiment returned for it,
+# and compute_variables will find them there rather than resolving
+# the experiment and calling the back end: this is how the toplevel
+# routes requests through batches.
+#
+# Finally a back end module may have a compositional attribute: if
+# this is true it is promising that the variables for a union of sets
+# of experiment ids are the union of the variables for each set.  The
+# toplevel uses this to avoid computing things it can derive.
+#
 # There is no abstraction from the dreq interface at all here
 #
 
 __all__ = ('cv_implementation', 'validate_cv_implementation',
-           'compute_variables',
+           'compute_variables', 'cv_dreq_sections', 'mip_experiment_index',
+           'compute_variables_batch', 'cv_batchable', 'cmvids_batch',
+           'compute_exids_batch', 'resolve_experiment', 'cv_compositional',
            'NoMIP', 'WrongExperiment', 'NoExperiment',
            'BadCVImplementation')
 
 from collections import defaultdict
 from djq.low import fluid, boundp, globalize
 from djq.low import ExternalException, InternalException, Disaster, Scram
-from djq.low import mutter, mumble, make_checktree
+from djq.low import mutter, mumble, enabled, make_checktree, weakly_memoized
 from djq.low import stringlike, arraylike, setlike
 
 class NoMIP(ExternalException):
@@ -59,8 +88,12 @@ class BadCVImplementation(ExternalException):
 # post checkers are responsible for checking that things coming out
 # are sane, and get called with dq, mip cmvids
 #
-pre_checks = defaultdict(make_checktree)
-post_checks = defaultdict(make_checktree)
+# When checks are sampled, calls are counted for each dq.
+#
+pre_checks = defaultdict(lambda: make_checktree(
+    sample_key=lambda dq, *args, **kwargs: dq))
+post_checks = defaultdict(lambda: make_checktree(
+    sample_key=lambda dq, *args, **kwargs: dq))
 
 # The fluid for the implementation: created unbound
 cv_implementation = fluid()
@@ -76,6 +109,39 @@ def effective_cv_implementation():
     else:
         raise Scram("no cv implementation")
 
+# The sections this module uses itself
+dreq_sections = ('experiment',)
+
+def cv_dreq_sections():
+    """Return the sections of the dreq needed to compute variables.
+
+    This is a frozenset of section names, or None if the current back
+    end does not say what it needs, in which case it needs all of
+    them.
+    """
+    (cv, impl) = effective_cv_implementation()
+    sections = getattr(impl, 'dreq_sections', None)
+    return (frozenset(sections) | frozenset(dreq_sections)
+            if sections is not None
+            else None)
+
+def cv_compositional():
+    """Is the current back end set-union-compositional?
+
+    A back end is compositional if the variables for a set of
+    experiment ids are the union of the variables for any sets of
+    experiment ids whose union it is.  Back ends say they are by
+    having a true compositional attribute.
+    """
+    (cv, impl) = effective_cv_implementation()
+    return getattr(impl, 'compositional', False) is True
+
+def cv_batchable():
+    """Can the current back end compute batches of variables?"""
+    (cv, impl) = effective_cv_implementation()
+    return (hasattr(impl, 'compute_cmvids_for_all')
+            and callable(impl.compute_cmvids_for_all))
+
 def validate_cv_implementation(impl, bootstrap=False):
     """Validate a back end for computing variables, returning it.
 
@@ -104,7 +170,11 @@ def validate_cv_implementation(impl, bootstrap=False):
 def compute_variables(dq, mip, experiment):
     """Compute the variables for a MIP and generalised experiment name.
 
-    This is the only public function in this module.
+    This is how the variables for a single-request are computed: the
+    other public functions in this module are for planning and
+    batching the computation for many single-requests at once.  If
+    the table bound to cmvids_batch has results for (dq, mip,
+    experiment) they are used rather than being computed again.
 
     returns a set of cmvids suitable for JSONification.
 
@@ -115,14 +185,24 @@ def compute_variables(dq, mip, experiment):
            mip, experiment, (impl.__name__
                              if hasattr(impl, '__name__')
                              else impl))
-    validate_mip_experiment(dq, mip, experiment, impl)
+    stringy = (stringlike(experiment) or experiment is None
+               or isinstance(experiment, bool))
+    batch = cmvids_batch() if stringy else None
+    key = (dq, mip, experiment)
+    if batch is not None and key in batch:
+        # resolved, and so validated and pre-checked, when batched
+        (exids, cmvids) = batch[key]
+        mutter("  (batched)")
+    else:
+        exids = validate_mip_experiment(dq, mip, experiment, impl)
+        cmvids = None
 
-    if (stringlike(experiment) or experiment is None
-        or isinstance(experiment, bool)):
-        exids = exids_of_mip(dq, mip, experiment)
-        for label in sorted(dq.inx.uid[exid].label for exid in exids):
-            mumble("      {}", label)
-        cmvids = cv(dq, mip, exids)
+    if stringy:
+        if enabled(2):
+            for label in sorted(dq.inx.uid[exid].label for exid in exids):
+                mumble("      {}", label)
+        if cmvids is None:
+            cmvids = cv(dq, mip, exids)
         mutter("  -> {} variables", len(cmvids))
         for v in cmvids:
             if v not in dq.inx.uid:
@@ -136,10 +216,101 @@ def compute_variables(dq, mip, experiment):
     else:
         raise Disaster("this can't happen")
 
+# The table of batched results: see above
+cmvids_batch = globalize(fluid(), None, threaded=True)
+
+def compute_variables_batch(dq, pairs):
+    """Compute the variables for many MIPs and experiments at once.
+
+    pairs is an iterable of (mip, experiment), where experiment is a
+    generalised experiment name as for compute_variables.  Return a
+    dict mapping each pair which is valid to a set of cmvids.  Pairs
+    which are not valid, or whose computation fails, are simply left
+    out: compute_variables will fail in the usual way for them.
+
+    Pairs which resolve to the same experiment ids for a MIP are only
+    computed once: see compute_exids_batch.
+
+    This runs the pre checks but not the post checks.  If
+    cmvids_batch is bound the results also go into its table, so
+    calling compute_variables for each pair then runs the post checks
+    without computing anything again.
+    """
+    resolved = {}
+    for (mip, experiment) in pairs:
+        try:
+            hash(experiment)
+            resolved[(mip, experiment)] = (mip, resolve_experiment(dq, mip,
+                                                                   experiment))
+        except (TypeError, ExternalException, InternalException) as e:
+            mumble("[not batching {} {}: {}]", mip, experiment, e)
+    results = compute_exids_batch(dq, set(resolved.itervalues()))
+    table = cmvids_batch()
+    found = {}
+    for (pair, group) in resolved.iteritems():
+        if group in results:
+            found[pair] = results[group]
+            if table is not None:
+                table[(dq,) + pair] = (group[1], results[group])
+    return found
+
+def compute_exids_batch(dq, groups):
+    """Compute the variables for many MIPs and sets of experiment ids.
+
+    groups is an iterable of (mip, exids), where exids is a frozenset
+    of experiment ids of mip.  Return a dict mapping each group to a
+    set of cmvids, leaving out any whose computation fails.
+
+    If the back end has a compute_cmvids_for_all function, this is
+    used, once for each distinct set of experiment ids of a MIP,
+    otherwise the back end is called for each group.
+    """
+    (cv, impl) = effective_cv_implementation()
+    # mip -> set of exids
+    wanted = defaultdict(set)
+    for (mip, exids) in groups:
+        wanted[mip].add(exids)
+    results = {}
+    if cv_batchable():
+        # Each round does the next set of exids for each MIP
+        rounds = {mip: list(exidss) for (mip, exidss) in wanted.iteritems()}
+        while len(rounds) > 0:
+            now = {mip: exidss.pop() for (mip, exidss) in rounds.iteritems()}
+            rounds = {mip: exidss for (mip, exidss) in rounds.iteritems()
+                      if len(exidss) > 0}
+            mutter("  batch of {} mips", len(now))
+            try:
+                got = impl.compute_cmvids_for_all(
+                    dq, {mip: set(exids) for (mip, exids) in now.iteritems()})
+            except (ExternalException, InternalException) as e:
+                mutter("[batch failed: {}]", e)
+                continue
+            for (mip, exids) in now.iteritems():
+                results[(mip, exids)] = got[mip]
+    else:
+        for (mip, exidss) in wanted.iteritems():
+            for exids in exidss:
+                try:
+                    results[(mip, exids)] = cv(dq, mip, set(exids))
+                except (ExternalException, InternalException) as e:
+                    mumble("[{} failed: {}]", mip, e)
+    return results
+
+def resolve_experiment(dq, mip, experiment):
+    """Resolve a generalised experiment name for a MIP to experiment ids.
+
+    Return a frozenset of experiment ids, raising the same exceptions
+    as compute_variables if mip or experiment is bad.  The pre checks
+    for the current back end are run.
+    """
+    (cv, impl) = effective_cv_implementation()
+    return frozenset(validate_mip_experiment(dq, mip, experiment, impl))
+
 def validate_mip_experiment(dq, mip, experiment, impl):
     """Validate a MIP and an experiment if it is stringy.
 
-    Raise suitable exceptions on failure, return value undefined.
+    Raise suitable exceptions on failure, otherwise return the set of
+    exids of mip matched by experiment.
     """
     if mip not in dq.inx.uid or dq.inx.uid[mip]._h.label != 'mip':
         raise NoMIP(mip)
@@ -157,6 +328,7 @@ def validate_mip_experiment(dq, mip, experiment, impl):
         exids = exids_of_mip(dq, mip, experiment)
     if pre_checks[impl](args=(dq, mip, exids)) is False:
         raise Disaster("failed pre checks")
+    return exids
 
 def exids_of_mip(dq, mip, match):
     """Find all the names of the experiments of mip matched by match.
@@ -167,15 +339,33 @@ def exids_of_mip(dq, mip, match):
     This is more general than the system needs (you never get lists or
     sets of experiments, currently).
 
+    This uses mip_experiment_index, so it does not search the
+    experiments.
+
     """
-    def expt_matches(expt):
-        # there must be a more idiomatic way of doing type dispatch
-        if stringlike(match):
-            return expt.label == match
-        elif arraylike(match) or setlike(match):
-            return True if expt.label in match else False
-        else:
-            return True if match else False
+    labels = mip_experiment_index(dq).get(mip, {})
+    # there must be a more idiomatic way of doing type dispatch
+    if stringlike(match):
+        return set(labels.get(match, ()))
+    elif arraylike(match) or setlike(match):
+        return set(exid for label in match for exid in labels.get(label, ()))
+    elif match:
+        return set(exid for exids in labels.itervalues() for exid in exids)
+    else:
+        return set()
 
-    return set(expt.uid for expt in dq.coll['experiment'].items
-               if expt.mip == mip and expt_matches(expt))
+@weakly_memoized
+def mip_experiment_index(dq):
+    """Return an index of the experiments of dq by MIP and label.
+
+    This is a dict mapping from each MIP with experiments to a dict
+    mapping from experiment label to a frozenset of the uids of the
+    experiments of that MIP with that label.  It is computed once per
+    dq, and must not be altered.
+    """
+    index = defaultdict(lambda: defaultdict(set))
+    for expt in dq.coll['experiment'].items:
+        index[expt.mip][expt.label].add(expt.uid)
+    return {mip: {label: frozenset(exids)
+                  for (label, exids) in labels.iteritems()}
+            for (mip, labels) in index.iteritems()}
@@ -33,6 +33,13 @@ from djq.low import checker
 from djq.low import mutter, mumble
 from compute import pre_checks, post_checks
 
+# The sections of the dreq this uses
+dreq_sections = ('requestLink', 'requestVar', 'requestItem', 'experiment')
+
+# The variables for a union of sets of exids are the union of the
+# variables for each set (see compute)
+compositional = True
+
 impl = modules[__name__]
 pre_checktree = pre_checks[impl]
 post_checktree = post_checks[impl]
@@ -5,13 +5,19 @@
 """Computing variables by inverting the map from variables to mips
 """
 
-__all__ = ('compute_cmvids_for_exids',)
+__all__ = ('compute_cmvids_for_exids', 'compute_cmvids_for_all')
 
 from sys import modules
-from collections import defaultdict
-from djq.low import checker, mutter, mumble
+from djq.low import checker, mutter, mumble, enabled
 from compute import pre_checks, post_checks
-from varmip import mips_of_cmv, validp
+from varmip import cmv_mip_index, mips_of_contributions, dreq_sections
+
+# This only uses the dreq via varmip, so it needs the sections varmip
+# does (dreq_sections is imported for this)
+
+# The variables for a union of sets of exids are the union of the
+# variables for each set (see compute)
+compositional = True
 
 impl = modules[__name__]
 pre_checktree = pre_checks[impl]
@@ -22,25 +28,46 @@ def compute_cmvids_for_exids(dq, mip, exids):
 
     This is the interface function for the back end.
 
-    This is a fairly rudimentary hack.
+    This is a fairly rudimentary hack.  It used to compute the MIPs of
+    every variable each time, but now looks them up in an index which
+    is built once for each dq (see varmip).
     """
-    mipcmvids = defaultdict(set)
-    bads = set()
-    dubious = set()
-    for cmv in dq.coll['CMORvar'].items:
-        if validp(dq.inx.uid[cmv.vid]):
-            mips = mips_of_cmv(dq, cmv, exids)
-            if len(mips) > 0:
-                for m in mips:
-                    mipcmvids[m].add(cmv.uid)
-            else:
-                dubious.add(cmv)
-                mumble("[{} ({}) belongs to no MIPs?]", cmv.label, cmv.uid)
-        else:
-            bads.add(cmv)
-            mumble("[pruned {} ({}): var not valid]", cmv.label, cmv.uid)
-    if len(bads) > 0:
-        mutter("[pruned {} invalid vars]", len(bads))
+    index = cmv_mip_index(dq)
+    report_pruned(dq, index, exids)
+    return index.cmvids_of_mip(mip, exids)
+
+def compute_cmvids_for_all(dq, mipexids):
+    """Compute the cmvids for a number of MIPs at once.
+
+    mipexids maps MIPs to sets of experiment ids: return a dict
+    mapping each MIP to its cmvids.
+
+    This is the batch interface function for the back end.
+    """
+    index = cmv_mip_index(dq)
+    for exids in set(frozenset(exids) for exids in mipexids.itervalues()):
+        report_pruned(dq, index, exids)
+    return {mip: index.cmvids_of_mip(mip, exids)
+            for (mip, exids) in mipexids.iteritems()}
+
+def report_pruned(dq, index, exids):
+    # Report on the invalid variables and those which belong to no
+    # MIPs given exids.  Finding the dubious ones is not free, so
+    # don't if nothing would be said.
+    if not enabled(1):
+        return
+    if enabled(2):
+        for cmvid in index.invalid:
+            mumble("[pruned {} ({}): var not valid]",
+                   dq.inx.uid[cmvid].label, cmvid)
+    dubious = tuple(cmvid for cmvid in index.linkless
+                    if len(mips_of_contributions(index.contributions[cmvid],
+                                                 exids)) == 0)
+    if enabled(2):
+        for cmvid in dubious:
+            mumble("[{} ({}) belongs to no MIPs?]", dq.inx.uid[cmvid].label,
+                   cmvid)
+    if len(index.invalid) > 0:
+        mutter("[pruned {} invalid vars]", len(index.invalid))
     if len(dubious) > 0:
         mutter("[pruned {} dubious vars]", len(dubious))
-    return mipcmvids[mip]
@@ -6,11 +6,14 @@
 """
 
 __all__ = ('jsonify_variables', 'jsonify_implementation',
+           'jsonify_dreq_sections', 'json_fragments',
            'validate_jsonify_implementation', 'BadJSONifyImplementation')
 
 from collections import defaultdict
+from os import getenv
+from json import dumps
 from djq.low import fluid, boundp, globalize
-from djq.low import whisper, ExternalException, Scram, Disaster
+from djq.low import whisper, enabled, ExternalException, Scram, Disaster
 from djq.low import make_checktree
 
 class BadJSONifyImplementation(ExternalException):
@@ -20,13 +23,46 @@ class BadJSONifyImplementation(ExternalException):
 # called with the dq, cmvids, and the JSON structure resulting.
 #
 # Implementations can know about this variable, but it's not really
-# public
+# public.  When checks are sampled, calls are counted for each dq.
 #
-checks = defaultdict(make_checktree)
+checks = defaultdict(lambda: make_checktree(
+    sample_key=lambda dq, *args, **kwargs: dq))
 
 # The fluid for the implementation, created unbound
 jsonify_implementation = fluid()
 
+# Pre-encoded variables.  The same variable appears in many replies,
+# and is encoded as JSON in each of them.  If json_fragments() is true
+# an implementation may instead return EncodedVariables (made by
+# encoded_variable): dicts which also carry their compact JSON
+# encoding, which the emitter (see djq.emit) splices into compact
+# output rather than encoding the variable again.  This is only worth
+# it for implementations which memoize their variables, so each is
+# encoded once for each set of memos (for each request, or for each dq
+# with session memos): jsonify_simple does this.  json_fragments
+# defaults from DJQ_JSON_FRAGMENTS, and process_stream turns it on
+# when it writes compact output.
+#
+json_fragments = globalize(fluid(),
+                           bool(getenv("DJQ_JSON_FRAGMENTS")),
+                           threaded=True)
+
+class EncodedVariable(dict):
+    # A variable which carries its compact JSON encoding
+    __slots__ = ('json_fragment',)
+
+    def __reduce__(self):
+        # dicts with slots don't pickle by default
+        return (encoded_variable, (dict(self), self.json_fragment))
+
+def encoded_variable(variable, json_fragment=None):
+    # Return an EncodedVariable for variable, a dict, encoding it
+    # unless json_fragment is given
+    ev = EncodedVariable(variable)
+    ev.json_fragment = (json_fragment if json_fragment is not None
+                        else dumps(variable, separators=(',', ':')))
+    return ev
+
 def effective_jsonify_implementation():
     # return a tuple of (function, impl), where function is the
     # callable thing, and impl is the thing to key checks from. Scram
@@ -37,6 +73,17 @@ def effective_jsonify_implementation():
     else:
         raise Scram("no jsonify implementation")
 
+def jsonify_dreq_sections():
+    """Return the sections of the dreq needed to jsonify variables.
+
+    This is a frozenset of section names, taken from the
+    implementation's dreq_sections attribute, or None if it has none,
+    in which case it needs all of them.
+    """
+    (jsonify_cmvids, impl) = effective_jsonify_implementation()
+    sections = getattr(impl, 'dreq_sections', None)
+    return frozenset(sections) if sections is not None else None
+
 def validate_jsonify_implementation(impl, bootstrap=False):
     """Validate a jsonify implementation, returning it.
 
@@ -65,10 +112,14 @@ def validate_jsonify_implementation(impl, bootstrap=False):
 def jsonify_variables(dq, cmvids):
     """Return a suitable dict for a bunch of cmv uids"""
     (jsonify_cmvids, impl) = effective_jsonify_implementation()
+    # Sort by label and then uid: cmvids is a set, whose order
+    # depends on how it was computed, so the label alone would leave
+    # the order of variables with the same label to chance
     results = sorted(jsonify_cmvids(dq, cmvids),
-                     key=lambda j: j['label'])
+                     key=lambda j: (j['label'], j.get('uid')))
     if checks[impl](args=(dq, cmvids, results)) is False:
         raise Disaster("failed JSONify checks")
-    for r in results:
-        whisper("     {}", r['label'])
+    if enabled(3):
+        for r in results:
+            whisper("     {}", r['label'])
     return results
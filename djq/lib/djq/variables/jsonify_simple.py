@@ -9,48 +9,59 @@ __all__ = ('jsonify_cmvids',)
 
 from sys import modules
 from djq.low import checker
-from djq.low import validate_object, every_element, one_of, all_of, stringlike
+from djq.low import compile_pattern, every_element, one_of, stringlike
 from djq.low import memoizable
-from jsonify import checks
-from varmip import mips_of_cmv, priority_of_cmv_in_mip
+from jsonify import checks, json_fragments, encoded_variable
+from varmip import cmv_mip_priorities, dreq_sections
+
+# This only uses the dreq via varmip, so it needs the sections varmip
+# does (dreq_sections is imported for this)
 
 impl = modules[__name__]
 checktree = checks[impl]
 
+# The shape results should have, compiled once since it is checked
+# for every reply
+number = one_of((int, float)) # a JSON number
+valid_results = compile_pattern(
+    every_element({'uid': stringlike,
+                   'label': stringlike,
+                   'miptable': stringlike,
+                   'priority': number,
+                   'mips': every_element(
+                       {'mip': stringlike,
+                        'priority': number})}))
+
 @checker(checktree, "variables.jsonify/validate-results")
 def validate_results(dq, cmvids, results):
     # This checker looks at results and checks they smell basically
     # good: it could actually just be in jsonify itself, since any
     # implementation should pass this.
-    number = one_of((int, float)) # a JSON number
-    return validate_object(
-        results,
-        every_element({'uid': all_of((stringlike,
-                                      lambda u: u in cmvids)),
-                       'label': stringlike,
-                       'miptable': stringlike,
-                       'priority': number,
-                       'mips': every_element(
-                           {'mip': stringlike,
-                            'priority': number})}))
+    return (valid_results(results)
+            and all(r['uid'] in cmvids for r in results))
 
 
 def jsonify_cmvids(dq, cmvids):
     """Convert a bunch of CMORvar IDs to JSON."""
-    return tuple(jsonify_cmvid(dq, cmvid) for cmvid in cmvids)
+    encoded = json_fragments()
+    return tuple(jsonify_cmvid(dq, cmvid, encoded) for cmvid in cmvids)
 
-@memoizable(spread=True)
-def jsonify_cmvid(dq, cmvid):
+# A DREQ has a few thousand CMORvars, so this is enough for several.
+# If encoded is true the result is pre-encoded (see jsonify), and,
+# since it is memoized, it is encoded only once.
+@memoizable(spread=True, maxsize=1 << 14)
+def jsonify_cmvid(dq, cmvid, encoded=False):
     cmv = dq.inx.uid[cmvid]
-    return {'uid': cmvid,
-            'label': cmv.label,
-            'miptable': cmv.mipTable,
-            'priority': cmv.defaultPriority,
-            'mips': mipinfo_of_cmv(dq, cmv)}
+    variable = {'uid': cmvid,
+                'label': cmv.label,
+                'miptable': cmv.mipTable,
+                'priority': cmv.defaultPriority,
+                'mips': mipinfo_of_cmv(dq, cmv)}
+    return encoded_variable(variable) if encoded else variable
 
 def mipinfo_of_cmv(dq, cmv):
-    # compute the mipinfo for a variable.  This could easily be cached
-    # as it gets called many many times for the same MIPs
-    return tuple({'mip': mip,
-                  'priority': priority_of_cmv_in_mip(dq, cmv, mip)}
-                 for mip in mips_of_cmv(dq, cmv))
+    # compute the mipinfo for a variable: the MIPs and priorities are
+    # in a table built once for each dq (see varmip)
+    return tuple({'mip': mip, 'priority': priority}
+                 for (mip, priority)
+                 in cmv_mip_priorities(dq).mipinfo[cmv.uid])
@@ -14,7 +14,17 @@ categories = {'instances': {FunctionType: ('compute_variables',
                                            'cv_implementation',
                                            'validate_cv_implementation',
                                            'jsonify_implementation',
-                                           'validate_jsonify_implementation')},
+                                           'validate_jsonify_implementation',
+                                           'cv_dreq_sections',
+                                           'jsonify_dreq_sections',
+                                           'json_fragments',
+                                           'mip_experiment_index',
+                                           'compute_variables_batch',
+                                           'cv_batchable',
+                                           'cmvids_batch',
+                                           'compute_exids_batch',
+                                           'resolve_experiment',
+                                           'cv_compositional')},
               'types': {Exception: ('NoExperiment', 'NoMIP',
                                     'WrongExperiment', 'BadCVImplementation',
                                     'BadJSONifyImplementation')}}
@@ -0,0 +1,194 @@
+# (C) British Crown Copyright 2018, Met Office.
+# See LICENSE.md in the top directory for license details.
+#
+
+# Tests of the CMORvar -> MIP index
+#
+# These check the index against computing the MIPs of every variable
+# directly, which is what it replaces, and batches against computing
+# variables one MIP at a time.  They load the DREQ which comes
+# with dreqPy, which takes a few seconds.
+#
+# The MIPs of variables are checked against a copy of mips_of_cmv as
+# it was before the index existed, so they don't depend on the code
+# they are checking.
+#
+
+from dreqPy.dreq import loadDreq
+from djq.low import fluids
+from djq.variables import (cv_implementation, compute_variables,
+                           compute_variables_batch, cmvids_batch,
+                           resolve_experiment)
+from djq.variables import cv_invert_varmip
+from djq.variables.varmip import (cmv_mip_index, cmv_mip_priorities,
+                                  mips_of_cmv, priority_of_cmv_in_mip,
+                                  validp, dqtype, BadDreq)
+
+dqs = {}
+
+def baseline_mips_of_cmv(dq, cmv, exids=True):
+    # Return a set of the mips of a CMORvar in dq.  If exids is given
+    # it should be a set of experiment IDs, and only MIPs for those
+    # experiments are included.  If it is True (specifically True, not
+    # just something which is not false) then all experiments are
+    # included, and if it is false then no experiments are included.
+    #
+    # This is a simplified version of vrev.checkVar.chkCmv (in
+    # vrev.py) But it is simpler in the sense that I do not understand
+    # what the original code really does, so I have just tried to make
+    # something which is a bit less horrible and which might do
+    # something useful.
+    #
+    # This originated in dqi.walker but has been changed since then.
+    # The argument convention is slightly mutant (cmv as an object,
+    # but ids of experiments).
+    #
+
+    # requestVar ids which refer to cmv and whose groups are valid
+    rvids = set(rvid for rvid in dq.inx.iref_by_sect[cmv.uid].a['requestVar']
+                if validp(dq.inx.uid[dq.inx.uid[rvid].vgid]))
+
+    # construct a dict mapping from variable group id to the highest
+    # priority in that group
+    #
+    #|his code just adds all the priorities it finds to a set and then
+    #|uses max below: this is better I think.
+    vgpri = dict()
+    for rvid in rvids:
+        rv = dq.inx.uid[rvid]   # the requestVar
+        rvp = rv.priority       # its priority
+        vgid = rv.vgid          # its group
+        if vgid not in vgpri or rvp > vgpri[vgid]:
+            vgpri[vgid] = rvp
+
+    linkids = set()
+    for (vgid, pri) in vgpri.iteritems():
+        if dq.inx.iref_by_sect[vgid].a.has_key('requestLink'):
+            for rlid in dq.inx.iref_by_sect[vgid].a['requestLink']:
+                rl = dq.inx.uid[rlid] # requestLink
+                if rl.opt == 'priority':
+                    # if it has a priority, add it if it is high
+                    # enough. This is what he does: rounding?
+                    #
+                    #|he has the comparison the other way around
+                    #|remember that 'a <= b' is the same as 'b >= a'
+                    #|or 'not (a > b)', but *not* the same as 'b > a',
+                    #|which is what this said for a long time
+                    if int(float(rl.opar)) >= pri:
+                        linkids.add(rlid)
+                else:
+                    # no priority, just add it
+                    linkids.add(rlid)
+
+    # OK, so here is the first chunk of mips: just the mip fields of
+    # all these requestLink objects
+    mips = set(dq.inx.uid[rlid].mip for rlid in linkids)
+
+    if exids:
+        # Now deal with experiments, if asked
+        #
+
+        # The IDs of all the experimenty things corresponding to the
+        # requestLinks, I think
+        esids = set(dq.inx.uid[u].esid
+                    for rlid in linkids
+                    for u in dq.inx.iref_by_sect[rlid].a['requestItem'])
+
+        # Empty IDs can leak in (which is looks like is a bug?)
+        esids.discard('')
+
+        for esid in (esid for esid in esids
+                     if validp(dq.inx.uid[esid])):
+            # what sort of thing is this
+            dqt = dqtype(dq.inx.uid[esid])
+            if dqt == 'mip':
+                # it's a MIP, directly, just add this
+                mips.add(esid)
+            elif dqt == 'experiment':
+                # It's an experiment
+                if exids is True or esid in exids:
+                    mips.add(dq.inx.uid[esid].mip)
+            elif dqt == 'exptgroup':
+                # It's a group
+                for exid in dq.inx.iref_by_sect[esid].a['experiment']:
+                    if exids is True or exid in exids:
+                       mips.add(dq.inx.uid[exid].mip)
+            else:
+                raise BadDreq("{} isn't an experiment, group or mip"
+                              .format(dqt))
+    return mips
+
+
+def setup():
+    dqs['dq'] = loadDreq()
+
+def teardown():
+    dqs.clear()
+
+def cmvids_of_mip(dq, mip, exids):
+    # the old way
+    return set(cmv.uid for cmv in dq.coll['CMORvar'].items
+               if (validp(dq.inx.uid[cmv.vid])
+                   and mip in baseline_mips_of_cmv(dq, cmv, exids)))
+
+def test_index():
+    def check(mip, exids):
+        dq = dqs['dq']
+        assert (cmv_mip_index(dq).cmvids_of_mip(mip, exids)
+                == cmvids_of_mip(dq, mip, exids))
+    dq = dqs['dq']
+    for mip in ("CMIP", "DAMIP", "ScenarioMIP"):
+        exids = set(e.uid for e in dq.coll['experiment'].items
+                    if e.mip == mip)
+        for x in (True, False, None, exids, set(list(exids)[:1])):
+            yield (check, mip, x)
+
+def test_once():
+    dq = dqs['dq']
+    assert cmv_mip_index(dq) is cmv_mip_index(dq)
+    assert cmv_mip_priorities(dq) is cmv_mip_priorities(dq)
+
+def test_mips():
+    def check(exids):
+        dq = dqs['dq']
+        for cmv in dq.coll['CMORvar'].items:
+            assert (mips_of_cmv(dq, cmv, exids)
+                    == baseline_mips_of_cmv(dq, cmv, exids))
+    dq = dqs['dq']
+    exids = set(e.uid for e in dq.coll['experiment'].items
+                if e.mip == "CMIP")
+    for x in (True, False, exids, set(list(exids)[:1])):
+        yield (check, x)
+
+def test_priorities():
+    # the table agrees with walking the dreq for every variable, and
+    # its MIPs are sorted
+    dq = dqs['dq']
+    mipinfo = cmv_mip_priorities(dq).mipinfo
+    for cmv in dq.coll['CMORvar'].items:
+        assert mipinfo[cmv.uid] == tuple(
+            (mip, priority_of_cmv_in_mip(dq, cmv, mip))
+            for mip in sorted(baseline_mips_of_cmv(dq, cmv)))
+
+def test_batch():
+    dq = dqs['dq']
+    pairs = tuple((mip, experiment)
+                  for mip in ("CMIP", "DAMIP", "NOSUCHMIP")
+                  for experiment in (True, None, "historical", "bogus"))
+    with fluids((cv_implementation, cv_invert_varmip)):
+        results = compute_variables_batch(dq, pairs)
+        assert set(results.keys()) == set((("CMIP", True), ("CMIP", None),
+                                           ("CMIP", "historical"),
+                                           ("DAMIP", True), ("DAMIP", None)))
+        for ((mip, experiment), cmvids) in results.iteritems():
+            assert cmvids == compute_variables(dq, mip, experiment)
+        # with a table bound the results go into it, with their exids
+        with fluids((cmvids_batch, dict())):
+            assert compute_variables_batch(dq, pairs) == results
+            table = cmvids_batch()
+            assert set(table.keys()) == set((dq,) + pair for pair in results)
+            for ((mip, experiment), cmvids) in results.iteritems():
+                assert (table[(dq, mip, experiment)]
+                        == (resolve_experiment(dq, mip, experiment), cmvids))
+                assert (compute_variables(dq, mip, experiment)
+                        is table[(dq, mip, experiment)][1])
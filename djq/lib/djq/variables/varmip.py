@@ -11,9 +11,18 @@
 #
 
 __all__ = ('mips_of_cmv', 'priority_of_cmv_in_mip',
-           'validp', 'dqtype')
+           'validp', 'dqtype', 'dreq_sections',
+           'cmv_mip_index', 'cmv_mip_priorities')
 
-from djq.low import DJQException
+from collections import namedtuple, defaultdict
+from djq.low import DJQException, weakly_memoized
+
+# The sections of the dreq the functions here look inside, or follow
+# references from.  Other sections are only used to know what sort of
+# thing a uid refers to.
+#
+dreq_sections = ('CMORvar', 'requestVar', 'requestLink', 'requestItem',
+                 'experiment')
 
 class BadDreq(DJQException):
     # bad dreq (is this internal or external?)
@@ -34,6 +43,35 @@ def mips_of_cmv(dq, cmv, exids=True):
     # just something which is not false) then all experiments are
     # included, and if it is false then no experiments are included.
     #
+    # The work is done by mip_contributions_of_cmv.
+    #
+    return mips_of_contributions(mip_contributions_of_cmv(dq, cmv), exids)
+
+class MIPContributions(namedtuple('MIPContributions',
+                                  ('links', 'esids', 'exids'))):
+    # Where the MIPs of a CMORvar come from:
+    # - links is a frozenset of MIPs it has whatever experiments are
+    #   included;
+    # - esids is a frozenset of MIPs it has if any experiments are
+    #   included;
+    # - exids is a tuple of (exid, mip): it has mip if exid is
+    #   included.
+    __slots__ = ()
+
+def mips_of_contributions(contributions, exids=True):
+    # Return a set of the MIPs from a MIPContributions, with exids as
+    # for mips_of_cmv.
+    mips = set(contributions.links)
+    if exids:
+        mips.update(contributions.esids)
+        mips.update(mip for (exid, mip) in contributions.exids
+                    if exids is True or exid in exids)
+    return mips
+
+def mip_contributions_of_cmv(dq, cmv):
+    # Return the MIPContributions of a CMORvar in dq, from which its
+    # MIPs can be computed for any set of experiments.
+    #
     # This is a simplified version of vrev.checkVar.chkCmv (in
     # vrev.py) But it is simpler in the sense that I do not understand
     # what the original code really does, so I have just tried to make
@@ -83,41 +121,148 @@ def mips_of_cmv(dq, cmv, exids=True):
 
     # OK, so here is the first chunk of mips: just the mip fields of
     # all these requestLink objects
-    mips = set(dq.inx.uid[rlid].mip for rlid in linkids)
+    links = frozenset(dq.inx.uid[rlid].mip for rlid in linkids)
 
-    if exids:
-        # Now deal with experiments, if asked
-        #
-
-        # The IDs of all the experimenty things corresponding to the
-        # requestLinks, I think
-        esids = set(dq.inx.uid[u].esid
-                    for rlid in linkids
-                    for u in dq.inx.iref_by_sect[rlid].a['requestItem'])
-
-        # Empty IDs can leak in (which is looks like is a bug?)
-        esids.discard('')
-
-        for esid in (esid for esid in esids
-                     if validp(dq.inx.uid[esid])):
-            # what sort of thing is this
-            dqt = dqtype(dq.inx.uid[esid])
-            if dqt == 'mip':
-                # it's a MIP, directly, just add this
-                mips.add(esid)
-            elif dqt == 'experiment':
-                # It's an experiment
-                if exids is True or esid in exids:
-                    mips.add(dq.inx.uid[esid].mip)
-            elif dqt == 'exptgroup':
-                # It's a group
-                for exid in dq.inx.iref_by_sect[esid].a['experiment']:
-                    if exids is True or exid in exids:
-                       mips.add(dq.inx.uid[exid].mip)
+    # Now deal with experiments.  Which of these count depends on
+    # which experiments are asked for, so just record where they come
+    # from.
+    #
+    esids_mips = set()
+    exids_mips = []
+
+    # The IDs of all the experimenty things corresponding to the
+    # requestLinks, I think
+    esids = set(dq.inx.uid[u].esid
+                for rlid in linkids
+                for u in dq.inx.iref_by_sect[rlid].a['requestItem'])
+
+    # Empty IDs can leak in (which is looks like is a bug?)
+    esids.discard('')
+
+    for esid in (esid for esid in esids
+                 if validp(dq.inx.uid[esid])):
+        # what sort of thing is this
+        dqt = dqtype(dq.inx.uid[esid])
+        if dqt == 'mip':
+            # it's a MIP, directly, just add this
+            esids_mips.add(esid)
+        elif dqt == 'experiment':
+            # It's an experiment
+            exids_mips.append((esid, dq.inx.uid[esid].mip))
+        elif dqt == 'exptgroup':
+            # It's a group
+            for exid in dq.inx.iref_by_sect[esid].a['experiment']:
+                exids_mips.append((exid, dq.inx.uid[exid].mip))
+        else:
+            raise BadDreq("{} isn't an experiment, group or mip"
+                          .format(dqt))
+    return MIPContributions(links, frozenset(esids_mips), tuple(exids_mips))
+
+class CMVMIPIndex(object):
+    # An index of the MIPs of all the CMORvars in a dq, built once so
+    # the MIPs of a variable, or the variables of a MIP, for any set
+    # of experiments, can be found without walking the dreq.
+    #
+    # - contributions maps each cmvid to its MIPContributions;
+    # - invalid is a tuple of the cmvids whose variables are not
+    #   valid, in the order of the dreq;
+    # - links maps a MIP to a frozenset of the cmvids of valid
+    #   variables which have it in their links, esids likewise for
+    #   esids, and exids maps a MIP to a dict mapping from exid to a
+    #   frozenset of cmvids of valid variables which have (exid, mip)
+    #   in their exids;
+    # - linkless is a tuple of the cmvids of valid variables with no
+    #   links, in the order of the dreq: these are the ones which may
+    #   belong to no MIPs.
+    #
+    def __init__(self, dq):
+        self.contributions = {}
+        invalid = []
+        linkless = []
+        links = defaultdict(set)
+        esids = defaultdict(set)
+        exids = defaultdict(lambda: defaultdict(set))
+        for cmv in dq.coll['CMORvar'].items:
+            c = mip_contributions_of_cmv(dq, cmv)
+            self.contributions[cmv.uid] = c
+            if not validp(dq.inx.uid[cmv.vid]):
+                invalid.append(cmv.uid)
+                continue
+            if len(c.links) == 0:
+                linkless.append(cmv.uid)
+            for mip in c.links:
+                links[mip].add(cmv.uid)
+            for mip in c.esids:
+                esids[mip].add(cmv.uid)
+            for (exid, mip) in c.exids:
+                exids[mip][exid].add(cmv.uid)
+        self.invalid = tuple(invalid)
+        self.linkless = tuple(linkless)
+        self.links = {mip: frozenset(u) for (mip, u) in links.iteritems()}
+        self.esids = {mip: frozenset(u) for (mip, u) in esids.iteritems()}
+        self.exids = {mip: {exid: frozenset(u)
+                            for (exid, u) in m.iteritems()}
+                      for (mip, m) in exids.iteritems()}
+
+    def cmvids_of_mip(self, mip, exids=True):
+        # A set of the cmvids of valid variables with mip among their
+        # MIPs for exids, which is as for mips_of_cmv
+        cmvids = set(self.links.get(mip, ()))
+        if exids:
+            cmvids.update(self.esids.get(mip, ()))
+            byexid = self.exids.get(mip, {})
+            if exids is True:
+                for u in byexid.itervalues():
+                    cmvids.update(u)
             else:
-                raise BadDreq("{} isn't an experiment, group or mip"
-                              .format(dqt))
-    return mips
+                for exid in exids:
+                    cmvids.update(byexid.get(exid, ()))
+        return cmvids
+
+@weakly_memoized
+def cmv_mip_index(dq):
+    # The CMVMIPIndex of dq, computed once
+    return CMVMIPIndex(dq)
+
+class CMVMIPPriorities(object):
+    # A table of the MIPs of every CMORvar in a dq and its priority in
+    # each of them, built once so the MIP information for a variable
+    # is a lookup rather than a walk of the dreq.
+    #
+    # - priorities maps each cmvid to a dict mapping each MIP named
+    #   by a valid requestVar referring to it to the highest priority
+    #   of those requestVars, which is what priority_of_cmv_in_mip
+    #   computes;
+    # - mipinfo maps each cmvid to a tuple of (mip, priority) for the
+    #   MIPs from mips_of_cmv (with all experiments), sorted by MIP,
+    #   where the priority falls back to the CMORvar's default as in
+    #   priority_of_cmv_in_mip.
+    #
+    # The priorities come from a single pass over the requestVars, and
+    # the MIPs from the CMVMIPIndex of the dq.
+    #
+    def __init__(self, dq):
+        cmvs = {cmv.uid: cmv for cmv in dq.coll['CMORvar'].items}
+        priorities = defaultdict(dict)
+        for rv in dq.coll['requestVar'].items:
+            if rv.vid in cmvs and validp(dq.inx.uid[rv.vgid]):
+                mippri = priorities[rv.vid]
+                if rv.mip not in mippri or rv.priority > mippri[rv.mip]:
+                    mippri[rv.mip] = rv.priority
+        self.priorities = dict(priorities)
+        contributions = cmv_mip_index(dq).contributions
+        self.mipinfo = {}
+        for (cmvid, cmv) in cmvs.iteritems():
+            mippri = priorities.get(cmvid, {})
+            self.mipinfo[cmvid] = tuple(
+                (mip, mippri.get(mip, cmv.defaultPriority))
+                for mip in sorted(mips_of_contributions(
+                        contributions[cmvid])))
+
+@weakly_memoized
+def cmv_mip_priorities(dq):
+    # The CMVMIPPriorities of dq, computed once
+    return CMVMIPPriorities(dq)
 
 def priority_of_cmv_in_mip(dq, cmv, mip):
     # Compute the priority of a CMV in a MIP.
@@ -0,0 +1,30 @@
+#!/usr/bin/env python -
+# -*- mode: Python -*-
+#
+# (C) British Crown Copyright 2018, Met Office.
+# See LICENSE.md in the top directory for license details.
+#
+
+"""Time looking up fluids with different numbers of bindings active
+"""
+
+from timeit import timeit
+from djq.low import fluid, globalize, fluids
+
+# a fluid which is only globally bound, like verbosity_level
+level = globalize(fluid(), 0, threaded=True)
+
+def time_lookups(depth, number=200000):
+    # Time number lookups of level with depth other bindings active
+    others = tuple(fluid() for i in range(depth))
+    def nest(i):
+        if i == len(others):
+            return timeit(level, number=number)
+        with fluids((others[i], i)):
+            return nest(i + 1)
+    return nest(0)
+
+if __name__ == '__main__':
+    for depth in (0, 5, 20, 50):
+        print "depth {:3d}: {:.3f}s for 200000 lookups".format(
+            depth, time_lookups(depth))
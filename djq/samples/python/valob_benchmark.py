@@ -0,0 +1,46 @@
+#!/usr/bin/env python -
+# -*- mode: Python -*-
+#
+# (C) British Crown Copyright 2018, Met Office.
+# See LICENSE.md in the top directory for license details.
+#
+
+"""Time validating objects with validate_object and compile_pattern
+"""
+
+from timeit import timeit
+from djq.low import (validate_object, compile_pattern,
+                     every_element, one_of, stringlike)
+
+# A pattern like the one jsonify_simple checks each variable in a
+# reply against
+number = one_of((int, float))
+pattern = {'uid': stringlike,
+           'label': stringlike,
+           'miptable': stringlike,
+           'priority': number,
+           'mips': every_element({'mip': stringlike,
+                                  'priority': number})}
+
+# and a reply-sized number of variables which match it
+results = tuple({'uid': "uid-{}".format(i),
+                 'label': "v{}".format(i),
+                 'miptable': "Amon",
+                 'priority': i % 3 + 1,
+                 'mips': tuple({'mip': m, 'priority': 1}
+                               for m in ("CMIP", "AerChemMIP", "C4MIP"))}
+                for i in range(2000))
+
+def interpreted():
+    return all(validate_object(r, pattern) for r in results)
+
+def compiled(check=compile_pattern(pattern)):
+    return all(check(r) for r in results)
+
+if __name__ == '__main__':
+    number = 20
+    assert interpreted() and compiled()
+    print "validate_object:  {:.3f}s for {} replies".format(
+        timeit(interpreted, number=number), number)
+    print "compiled pattern: {:.3f}s for {} replies".format(
+        timeit(compiled, number=number), number)